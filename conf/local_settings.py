@@ -5,6 +5,7 @@
 
 # ########## AD配置, 修改为自己的
 # AD主机, 可以是IP或主机域名, 例如可以是: abc.com或172.16.122.1
+# 有多台域控时用逗号分隔, 例如: dc1.abc.com,dc2.abc.com, 会优先使用响应最快的一台, 故障时自动切换
 LDAP_HOST = r'修改成自己的'
 
 # AD域控的DOMAIN, 例如: 比如你的域名是abc.com, 那么这里的LDAP_DOMAIN就是: abc
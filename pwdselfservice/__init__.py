@@ -1,22 +1,33 @@
-import datetime
-import sys
-import traceback
 import logging
+from django.conf import settings
 from django_redis import get_redis_connection
+from utils.storage.codecs import get_codec
 from utils.storage.kvstorage import KvStorage
+from utils.storage.lazystorage import LazyStorage
+from utils.storage.memorystorage import MemoryStorage
+from utils.storage.tieredstorage import TieredStorage
 
 logger = logging.getLogger(__name__)
 
-try:
+
+def _build_redis_storage():
     redis_conn = get_redis_connection()
-    cache_storage = KvStorage(redis_conn)
-    cache_storage.set('test_redis_connection', str(datetime.datetime))
-    cache_storage.get('test_redis_connection')
-    cache_storage.delete('test_redis_connection')
-    logger.info("Redis连接成功, set/get/delete测试通过...")
-except Exception as e:
-    cache_storage = None
-    logger.error("Redis无法连接, 请排查Redis配置...")
-    logger.error("{}".format(traceback.format_exc()))
-    sys.exit(1)
+    storage = KvStorage(redis_conn, codec=get_codec(settings.CACHE_CODEC, settings.CACHE_COMPRESS_THRESHOLD))
+    if settings.CACHE_L1_ENABLED:
+        storage = TieredStorage(storage, redis_conn, max_entries=settings.CACHE_L1_MAX_ENTRIES,
+                                max_ttl=settings.CACHE_L1_TTL, channel=settings.CACHE_L1_CHANNEL)
+    return storage
+
+
+def _ping_redis():
+    get_redis_connection().ping()
+
 
+if settings.CACHE_BACKEND == 'memory':
+    # 不使用Redis, 只适合单进程部署, 多个worker之间不共享缓存和锁
+    cache_storage = MemoryStorage(max_entries=settings.MEMORY_STORAGE_MAX_ENTRIES,
+                                  max_bytes=settings.MEMORY_STORAGE_MAX_BYTES)
+    logger.info("使用进程内缓存, 不连接Redis...")
+else:
+    # 启动时不连接Redis, 第一次使用时才创建; Redis是否可用由后台检查, 见 /health
+    cache_storage = LazyStorage(_build_redis_storage, _ping_redis, interval=settings.CACHE_HEALTH_INTERVAL)
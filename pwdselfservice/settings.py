@@ -123,6 +123,151 @@ CACHES = {
 # 可能不是太准确, 如果使用者能确定还有其它状态码, 可以自行在此处添加
 AD_ACCOUNT_DISABLE_CODE = [514, 66050]
 
+# ########## AD连接池, 每个uWSGI worker进程各自维护一个 ##########
+# 最大连接数, 建议不小于uwsgi.ini中threads的数量
+LDAP_POOL_SIZE = 10
+# 从连接池取连接的最长等待时间(秒)
+LDAP_POOL_CHECKOUT_TIMEOUT = 5
+# 空闲超过该时间(秒)的连接直接回收重建
+LDAP_POOL_MAX_IDLE = 300
+# 空闲超过该时间(秒)的连接在取出时先做一次健康检查
+LDAP_POOL_CHECK_INTERVAL = 30
+
+# ########## 多域控, local_settings中的LDAP_HOST可以用逗号分隔配置多台 ##########
+# 连接域控的超时时间(秒)
+LDAP_DC_CONNECT_TIMEOUT = 1
+# 后台探测各域控响应时间的间隔(秒), 只配置了一台域控时不探测
+LDAP_DC_PROBE_INTERVAL = 10
+# 域控连接失败后停用的时间(秒), 期间优先使用其它域控
+LDAP_DC_DOWN_TIME = 30
+# 域控DSA/Schema信息的缓存目录, 为None时每个worker进程在第一次绑定时读取一次
+LDAP_SCHEMA_CACHE_DIR = None
+# 分页查询时每页的条数
+LDAP_PAGED_SIZE = 1000
+
+# ########## 域控超时与熔断, 域控无响应时不让worker线程一直等待 ##########
+# 单次LDAP操作等待域控响应的最长时间(秒)
+LDAP_RECEIVE_TIMEOUT = 10
+# 一次Web请求内全部LDAP操作的时间预算(秒)
+LDAP_REQUEST_DEADLINE = 15
+# 连续失败(超时、连接失败、连接池排队超时)多少次后熔断, 熔断期间直接返回"目录服务暂不可用"
+LDAP_BREAKER_FAILURE_THRESHOLD = 5
+# 熔断多久(秒)后放行一个探测请求, 探测成功则恢复
+LDAP_BREAKER_RECOVERY_TIME = 30
+
+# ########## 本地目录快照, 账号、邮箱等只读查询优先使用快照, 不查询域控 ##########
+# 每个worker进程各保存一份, 2万账号大约占用十几MB内存
+AD_SNAPSHOT_ENABLED = False
+# 按uSNChanged增量同步的间隔(秒)
+AD_SNAPSHOT_SYNC_INTERVAL = 60
+# 全量同步的间隔(秒), 用于清理己删除或移出SEARCH_FILTER范围的账号
+AD_SNAPSHOT_FULL_SYNC_INTERVAL = 3600 * 6
+
+# ########## 本地模拟AD(utils/ad_mock.py), 用于开发调试和压测, 生产环境必须为False ##########
+LDAP_MOCK = False
+# 模拟AD中生成的账号数量
+LDAP_MOCK_USERS = 1000
+# 模拟每次LDAP操作的网络往返时间(秒)
+LDAP_MOCK_LATENCY = 0
+
+# ########## 企业微信、钉钉API地址, 压测时可以指向本地模拟服务(python manage.py mockapi) ##########
+# 只能包含 协议://主机:端口, 钉钉SDK会忽略其中的路径
+WEWORK_API_BASE_URL = 'https://qyapi.weixin.qq.com'
+DINGTALK_API_BASE_URL = 'https://oapi.dingtalk.com'
+
+# ########## 企业微信等上游API的HTTP长连接池, 每个worker进程各自维护一个 ##########
+# 每个上游主机保留的最大连接数, 建议不小于uwsgi.ini中threads的数量
+HTTP_POOL_MAXSIZE = 10
+# 建立连接的超时时间(秒)
+HTTP_CONNECT_TIMEOUT = 3
+# 等待响应的超时时间(秒)
+HTTP_READ_TIMEOUT = 10
+
+# ########## 企业微信、钉钉API的超时与重试策略(utils/http_policy.py) ##########
+# 一次API调用(包括全部重试)的时间预算(秒)
+HTTP_CALL_DEADLINE = 15
+# 暂时性失败(连接失败、超时、5xx、系统繁忙)的最大重试次数
+HTTP_RETRIES = 2
+# 第n次重试前随机等待 0 ~ min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2**n) 秒
+HTTP_BACKOFF_BASE = 0.2
+HTTP_BACKOFF_MAX = 2
+# 上游返回这些错误码(系统繁忙)时按暂时性失败处理
+HTTP_RETRY_ERRCODES = [-1]
+# 按接口覆盖以上策略, 企业微信的键为 CORP_API_TYPE 中的名称, 钉钉的键为请求路径,
+# 可覆盖 connect_timeout、read_timeout、retries、backoff_base、backoff_max、deadline、idempotent、retry_errcodes
+HTTP_POLICY_OVERRIDES = {
+    # 临时授权码只能使用一次, 请求可能己经被上游处理时不能重试
+    'GET_USER_TICKET_OAUTH2': {'idempotent': False},
+    'GET_USER_INFO_BY_CODE': {'idempotent': False},
+    '/user/getuserinfo': {'idempotent': False},
+    # 只读的POST接口, 可以重试
+    'GET_USER_INFO_OAUTH2': {'idempotent': True},
+    'GET_USER_DETAIL': {'idempotent': True},
+}
+
+# ########## 缓存后端, redis 或 memory(进程内缓存, 只适合单进程部署, 多个worker之间不共享token和锁) ##########
+CACHE_BACKEND = 'redis'
+# memory 后端的最大记录数和最大字节数(按JSON序列化后的长度估算), 超出时淘汰最久未使用的
+MEMORY_STORAGE_MAX_ENTRIES = 100000
+MEMORY_STORAGE_MAX_BYTES = 64 * 1024 * 1024
+# redis 后端在worker中第一次使用时才连接, 后台每隔多少秒检查一次Redis是否可用(秒), 结果见 /health
+CACHE_HEALTH_INTERVAL = 10
+
+# ########## Redis中的数据的序列化方式(utils/storage/codecs.py), 用 python manage.py codecbench 比较 ##########
+# json(默认), orjson, msgpack(需要另外安装对应的库); 数据带有序列化方式的标记, 切换之后旧数据仍然可以读取
+CACHE_CODEC = 'json'
+# 序列化后超过这么多字节时压缩, None为不压缩
+CACHE_COMPRESS_THRESHOLD = 1024
+
+# ########## 进程内L1缓存(utils/storage/tieredstorage.py), 位于Redis之前, 通过Redis pub/sub保持各worker一致 ##########
+CACHE_L1_ENABLED = False
+# 每个worker最多缓存的key数量
+CACHE_L1_MAX_ENTRIES = 1024
+# L1中的记录最长保留多少秒, 收不到失效通知(Redis订阅断开)时最多读到这么久以前的值
+CACHE_L1_TTL = 30
+# 失效通知的频道, 多套部署共用一个Redis时需要区分
+CACHE_L1_CHANNEL = 'pwdselfservice:l1:invalidate'
+
+# ########## access_token 刷新, 多个worker共用缓存中的同一个token ##########
+# 过期前多少秒由后台线程提前续期
+TOKEN_REFRESH_AHEAD = 600
+# 跨worker刷新锁的过期时间(秒)
+TOKEN_REFRESH_LOCK_TTL = 10
+# 没有可用token且其它worker正在刷新时的最长等待时间(秒)
+TOKEN_REFRESH_WAIT = 3
+
+# ########## 扫码回调, 同一个临时授权码(code)的重复请求直接使用第一次的结果 ##########
+# code -> 用户信息、域账号 的缓存时间(秒), 不短于code的有效期(5分钟)
+OAUTH_CODE_CACHE_TTL = 300
+# 换取用户信息失败的结果的缓存时间(秒), 同一时间到达的重复请求返回同样的错误, 而不是"code己被使用"
+OAUTH_CODE_NEGATIVE_CACHE_TTL = 10
+# 同一个code正在被其它请求换取时的最长等待时间(秒), 超时后提示用户稍后刷新, 不会再用这个code换取一次
+OAUTH_CODE_WAIT = 20
+# 换取code的跨worker锁的过期时间(秒), 不短于最坏情况下的换取耗时, 否则锁过期后其它worker会再用一次同一个code:
+# 获取access_token + 用code换取身份 + 查询成员详情, 每次调用最多 HTTP_CALL_DEADLINE 秒
+OAUTH_CODE_LOCK_TTL = 3 * HTTP_CALL_DEADLINE + 5
+
+# ########## 企业微信JS-SDK签名, 企业微信内打开页面时使用 ##########
+# 同一个页面URL的签名的缓存时间(秒), 应小于jsapi_ticket的有效期
+JSAPI_SIGNATURE_TTL = 600
+# 每个worker进程最多缓存多少个页面URL的签名, 超出时淘汰最久未使用的
+JSAPI_SIGNATURE_MAX_ENTRIES = 1000
+
+# ########## 重置密码/解锁页面的会话凭证, 每个凭证只能提交一次 ##########
+# 认证通过后多少秒内可以提交(秒)
+SESSION_TOKEN_TTL = 300
+
+# ########## 本地通讯录索引(utils/org_directory.py), 由 python manage.py orgsync 定时同步 ##########
+# 开启后扫码回调优先使用索引中的成员信息和域账号, 只向上游换取userid
+ORG_DIRECTORY_ENABLED = False
+# 索引记录的有效期(秒), 应为同步间隔的2~3倍, 同步失败一两次不影响使用
+ORG_DIRECTORY_TTL = 3600 * 3
+
+# 邮箱 -> 域账号 的缓存时间(秒), 账号在AD中查不到或快照同步到邮箱变化时提前清除
+AD_EMAIL_CACHE_TTL = 600
+# AD中查不到的邮箱的缓存时间(秒)
+AD_EMAIL_NEGATIVE_CACHE_TTL = 300
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -9,4 +9,6 @@ urlpatterns = {
     path('resetPassword', resetpwd.views.reset_password, name='resetPassword'),
     path('unlockAccount', resetpwd.views.unlock_account, name='unlockAccount'),
     path('messages', resetpwd.views.messages, name='messages'),
+    path('jsapiSignature', resetpwd.views.jsapi_signature, name='jsapiSignature'),
+    path('health', resetpwd.views.health, name='health'),
 }
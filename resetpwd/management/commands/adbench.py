@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+AdOps 压测, 连接本地模拟AD(utils/ad_mock.py), 不会连接真实的域控
+
+    # 全部操作, 并发1/4/16, 每个操作每个并发级别调用500次, 模拟每次LDAP操作2毫秒的网络往返
+    python manage.py adbench --concurrency 1,4,16 --iterations 500 --latency 0.002 --output bench.json
+    # 只测部分操作, 并与之前保存的结果对比
+    python manage.py adbench --ops ad_auth_user,ad_get_user_record_by_account --compare bench.json
+
+每次调用都新建一个AdOps(与一次Web请求相同), 统计每次调用的耗时(p50/p95/p99/max)和吞吐量,
+结果以JSON保存, 包含代码版本和压测参数, 用 --compare 可以与另一个版本的结果对比
+
+模拟AD按过滤条件逐条匹配全部账号, 查询耗时随 --users 线性增长, 绝对值不代表真实域控的耗时,
+真实的网络往返用 --latency 模拟; 同样的参数下对比不同版本的结果才有意义
+"""
+import json
+import platform
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import ldap3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.ad_mock import DEFAULT_PASSWORD, MAIL_DOMAIN, MockAdDirectory, reset_mock_directory
+from utils.ad_ops import AdOps
+from utils.ad_pool import pools_stats
+from utils.circuit_breaker import breakers_stats
+
+
+def _iter_users(ops, account):
+    return True, sum(1 for _ in ops.ad_iter_users())
+
+
+# 操作名 -> func(AdOps实例, 账号), 返回值与AdOps的方法相同, 为 (status, result)
+OPERATIONS = OrderedDict([
+    ('ad_auth_user', lambda ops, account: ops.ad_auth_user(account, DEFAULT_PASSWORD)),
+    ('ad_verify_user', lambda ops, account: ops.ad_verify_user(account, DEFAULT_PASSWORD)[:2]),
+    ('ad_ensure_user_by_account', lambda ops, account: ops.ad_ensure_user_by_account(account)),
+    ('ad_get_user_record_by_account', lambda ops, account: ops.ad_get_user_record_by_account(account)),
+    ('ad_get_get_sAMAccountName_by_email',
+     lambda ops, account: ops.ad_get_get_sAMAccountName_by_email('{}@{}'.format(account, MAIL_DOMAIN))),
+    ('ad_get_user_dn_by_account', lambda ops, account: ops.ad_get_user_dn_by_account(account)),
+    ('ad_get_user_status_by_account', lambda ops, account: ops.ad_get_user_status_by_account(account)),
+    ('ad_get_user_locked_status_by_account', lambda ops, account: ops.ad_get_user_locked_status_by_account(account)),
+    ('ad_get_directory_usn', lambda ops, account: ops.ad_get_directory_usn()),
+    ('ad_unlock_user_by_account', lambda ops, account: ops.ad_unlock_user_by_account(account)),
+    ('ad_unlock_user_by_dn', lambda ops, account: ops.ad_unlock_user_by_dn(MockAdDirectory.account_dn(account))),
+    # 重置为同一个密码, 不影响其它操作的密码验证
+    ('ad_reset_user_pwd_by_account', lambda ops, account: ops.ad_reset_user_pwd_by_account(account, DEFAULT_PASSWORD)),
+    ('ad_iter_users', _iter_users),
+])
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    calls = len(latencies)
+    return OrderedDict([
+        ('calls', calls),
+        ('errors', errors),
+        ('mean_ms', sum(latencies) / calls * 1000 if calls else 0),
+        ('p50_ms', percentile(latencies, 50) * 1000),
+        ('p95_ms', percentile(latencies, 95) * 1000),
+        ('p99_ms', percentile(latencies, 99) * 1000),
+        ('max_ms', latencies[-1] * 1000 if calls else 0),
+        ('throughput', calls / elapsed if elapsed else 0),
+    ])
+
+
+def code_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=settings.BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'AdOps 压测(使用本地模拟AD), 统计各操作在不同并发下的耗时与吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', help='要压测的操作, 逗号分隔, 默认全部: {}'.format(', '.join(OPERATIONS)))
+        parser.add_argument('--users', type=int, default=settings.LDAP_MOCK_USERS, help='模拟AD中的账号数量')
+        parser.add_argument('--concurrency', default='1,4,16', help='并发线程数, 逗号分隔可以测多个级别')
+        parser.add_argument('--iterations', type=int, default=200, help='每个操作在每个并发级别下的调用次数')
+        parser.add_argument('--latency', type=float, default=settings.LDAP_MOCK_LATENCY,
+                            help='模拟每次LDAP操作的网络往返时间(秒)')
+        parser.add_argument('--snapshot', action='store_true', help='开启本地目录快照(AD_SNAPSHOT_ENABLED)')
+        parser.add_argument('--output', help='把结果保存为JSON文件')
+        parser.add_argument('--compare', help='与之前保存的JSON结果对比')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in (options['ops'] or ','.join(OPERATIONS)).split(',') if name.strip()]
+        unknown = [name for name in names if name not in OPERATIONS]
+        if unknown:
+            raise CommandError('未知的操作: {}'.format(', '.join(unknown)))
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency 必须是逗号分隔的整数')
+        if options['users'] < 1 or options['iterations'] < 1 or min(levels) < 1:
+            raise CommandError('--users、--iterations、--concurrency 必须大于0')
+
+        settings.LDAP_MOCK = True
+        settings.AD_SNAPSHOT_ENABLED = options['snapshot']
+        reset_mock_directory(users=options['users'], latency=options['latency'])
+        accounts = ['user{:05d}'.format(i) for i in range(1, options['users'] + 1)]
+        if options['snapshot']:
+            from utils.ad_snapshot import get_snapshot
+            get_snapshot().sync_once()
+
+        results = OrderedDict()
+        for concurrency in levels:
+            for name in names:
+                # 预热: 让连接池建立连接, 不计入结果
+                self._run(OPERATIONS[name], accounts, concurrency, concurrency)
+                result = self._run(OPERATIONS[name], accounts, options['iterations'], concurrency)
+                result['op'], result['concurrency'] = name, concurrency
+                results['{}@{}'.format(name, concurrency)] = result
+                self.stdout.write('{:<40} c={:<4} p50={:>8.2f}ms p95={:>8.2f}ms p99={:>8.2f}ms max={:>8.2f}ms '
+                                  '{:>9.1f}/s errors={}'.format(name, concurrency, result['p50_ms'], result['p95_ms'],
+                                                                result['p99_ms'], result['max_ms'],
+                                                                result['throughput'], result['errors']))
+
+        report = OrderedDict([
+            ('meta', OrderedDict([
+                ('version', code_version()),
+                ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+                ('python', platform.python_version()),
+                ('ldap3', ldap3.__version__),
+                ('users', options['users']),
+                ('iterations', options['iterations']),
+                ('latency', options['latency']),
+                ('snapshot', options['snapshot']),
+                ('pool_size', settings.LDAP_POOL_SIZE),
+            ])),
+            ('results', results),
+            ('pools', pools_stats()),
+            ('breakers', breakers_stats()),
+        ])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write('结果己保存到 {}'.format(options['output']))
+        if options['compare']:
+            self._compare(report, options['compare'])
+
+    @staticmethod
+    def _run(func, accounts, iterations, concurrency):
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def call(i):
+            started = time.perf_counter()
+            try:
+                _status, _ = func(AdOps(), accounts[i % len(accounts)])
+            except Exception:
+                _status = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if not _status:
+                    errors[0] += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='adbench') as executor:
+            list(executor.map(call, range(iterations)))
+        return summarize(latencies, errors[0], time.perf_counter() - started)
+
+    def _compare(self, report, path):
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        self.stdout.write('与 {} (版本 {}) 对比, 负数表示耗时减少/吞吐量下降:'.format(
+            path, baseline.get('meta', {}).get('version')))
+        for key, result in report['results'].items():
+            base = baseline.get('results', {}).get(key)
+            if not base:
+                continue
+            self.stdout.write('{:<46} p50 {:>+7.1f}%  p95 {:>+7.1f}%  p99 {:>+7.1f}%  吞吐量 {:>+7.1f}%'.format(
+                key, *[self._change(base[field], result[field])
+                       for field in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput')]))
+
+    @staticmethod
+    def _change(old, new):
+        return (new - old) / old * 100 if old else 0.0
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+AD账号批量操作
+
+    # 解锁文件中列出的账号(每行一个sAMAccountName)
+    python manage.py adbulk unlock --file accounts.txt
+    # 解锁某个OU下所有被锁定的账号
+    python manage.py adbulk unlock --ou "OU=RD,DC=abc,DC=com"
+    # 解锁BASE_DN下所有被锁定的账号
+    python manage.py adbulk unlock --all-locked
+    # 列出被锁定/被禁用的账号
+    python manage.py adbulk report --locked
+    python manage.py adbulk report --disabled --ou "OU=RD,DC=abc,DC=com"
+    # 导出账号状态
+    python manage.py adbulk export --output status.csv
+
+查询全部使用分页查询并以生成器的方式逐条处理, 解锁操作在有上限的线程池中并发执行,
+每个线程从LDAP连接池取连接, 所以 --workers 不要大于 LDAP_POOL_SIZE - 1 (分页查询本身占用一个连接)
+"""
+import csv
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.ad_ops import AdOps, DirectoryUnavailableError, SEARCH_FILTER
+
+# lockoutTime大于0说明账号被锁定过且还没有被解锁或登录成功
+LOCKED_FILTER = '(lockoutTime>=1)'
+# userAccountControl 的 ACCOUNTDISABLE(0x2) 位
+DISABLED_FILTER = '(userAccountControl:1.2.840.113556.1.4.803:=2)'
+ACCOUNT_DISABLE_FLAG = 0x2
+
+EXPORT_FIELDS = ['sAMAccountName', 'dn', 'mail', 'disabled', 'locked', 'userAccountControl', 'lockoutTime',
+                 'pwdLastSet']
+
+
+def run_bounded(func, items, workers):
+    """
+    在线程池中并发执行func(item), 同时在途的任务不超过workers*2个, 不会一次性把生成器全部展开
+    :return: (item, result) 生成器, 按完成的先后顺序返回
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='adbulk') as executor:
+        pending = {}
+        for item in items:
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(func, item)] = item
+        for future in list(pending):
+            yield pending.pop(future), future.result()
+
+
+class Command(BaseCommand):
+    help = 'AD账号批量操作: 解锁、锁定/禁用账号报表、导出账号状态'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+
+        unlock = subparsers.add_parser('unlock', help='批量解锁账号')
+        source = unlock.add_mutually_exclusive_group(required=True)
+        source.add_argument('--file', help='账号列表文件, 每行一个sAMAccountName, "-"表示从标准输入读取')
+        source.add_argument('--ou', help='解锁该OU下所有被锁定的账号')
+        source.add_argument('--all-locked', action='store_true', help='解锁BASE_DN下所有被锁定的账号')
+        unlock.add_argument('--workers', type=int, default=max(1, settings.LDAP_POOL_SIZE - 1),
+                            help='并发解锁的线程数')
+        unlock.add_argument('--dry-run', action='store_true', help='只列出将要解锁的账号')
+
+        report = subparsers.add_parser('report', help='列出被锁定或被禁用的账号')
+        kind = report.add_mutually_exclusive_group(required=True)
+        kind.add_argument('--locked', action='store_true')
+        kind.add_argument('--disabled', action='store_true')
+        report.add_argument('--ou', help='只查询该OU')
+
+        export = subparsers.add_parser('export', help='以CSV格式导出账号状态')
+        export.add_argument('--ou', help='只导出该OU')
+        export.add_argument('--output', default='-', help='输出文件, 默认标准输出')
+
+        for sub in (unlock, report, export):
+            sub.add_argument('--paged-size', type=int, default=settings.LDAP_PAGED_SIZE, help='分页查询每页的条数')
+
+    def handle(self, *args, **options):
+        getattr(self, 'handle_{}'.format(options['action']))(**options)
+
+    def _iter_users(self, extra_filter=None, ou=None, paged_size=None):
+        search_filter = SEARCH_FILTER.format('*')
+        if extra_filter:
+            search_filter = '(&{}{})'.format(search_filter, extra_filter)
+        return AdOps().ad_iter_users(search_filter=search_filter, search_base=ou, paged_size=paged_size)
+
+    def _iter_accounts_from_file(self, path):
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        with stream:
+            for line in stream:
+                account = line.strip()
+                if account and not account.startswith('#'):
+                    yield account
+
+    @staticmethod
+    def _unlock_account(account):
+        try:
+            return AdOps().ad_unlock_user_by_account(account)
+        except DirectoryUnavailableError as e:
+            return False, e
+
+    @staticmethod
+    def _unlock_record(record):
+        try:
+            return AdOps().ad_unlock_user_by_dn(record.dn)
+        except DirectoryUnavailableError as e:
+            return False, e
+
+    def handle_unlock(self, file=None, ou=None, all_locked=False, workers=1, dry_run=False, paged_size=None,
+                      **options):
+        if workers < 1:
+            raise CommandError('--workers 必须大于0')
+        if file:
+            items, func, name = self._iter_accounts_from_file(file), self._unlock_account, str
+        else:
+            items = self._iter_users(LOCKED_FILTER, ou=ou, paged_size=paged_size)
+            func, name = self._unlock_record, lambda record: record.sAMAccountName
+
+        if dry_run:
+            for item in items:
+                self.stdout.write(name(item))
+            return
+
+        started = time.monotonic()
+        succeeded = failed = 0
+        for item, (_status, result) in run_bounded(func, items, workers):
+            if _status:
+                succeeded += 1
+            else:
+                failed += 1
+                self.stderr.write('{}\t解锁失败: {}'.format(name(item), result))
+        elapsed = time.monotonic() - started
+        self.stdout.write('解锁完成: 成功 {}, 失败 {}, 耗时 {:.2f} 秒'.format(succeeded, failed, elapsed))
+
+    def handle_report(self, locked=False, disabled=False, ou=None, paged_size=None, **options):
+        count = 0
+        for record in self._iter_users(LOCKED_FILTER if locked else DISABLED_FILTER, ou=ou, paged_size=paged_size):
+            count += 1
+            self.stdout.write('{}\t{}\t{}'.format(record.sAMAccountName, record.mail or '', record.dn))
+        self.stderr.write('共 {} 个{}账号'.format(count, '被锁定的' if locked else '被禁用的'))
+
+    def handle_export(self, ou=None, output='-', paged_size=None, **options):
+        stream = self.stdout if output == '-' else open(output, 'w', encoding='utf-8', newline='')
+        try:
+            writer = csv.writer(stream)
+            writer.writerow(EXPORT_FIELDS)
+            for record in self._iter_users(ou=ou, paged_size=paged_size):
+                writer.writerow([record.sAMAccountName, record.dn, record.mail or '',
+                                 bool(record.userAccountControl & ACCOUNT_DISABLE_FLAG), record.locked,
+                                 record.userAccountControl, record.lockoutTime, record.pwdLastSet])
+        finally:
+            if stream is not self.stdout:
+                stream.close()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+扫码回调(/resetPassword?code=...)端到端压测, 使用本地模拟的企业微信/钉钉API(utils/api_mock.py)和模拟AD(utils/ad_mock.py),
+不会连接真实的上游和域控
+
+    # 并发1/8/32, 每个并发级别500次回调, 上游每个请求延迟50毫秒, 注入1%的5xx
+    python manage.py callbackbench --concurrency 1,8,32 --requests 500 --api-latency 0.05 --errors 5xx=0.01 --output cb.json
+    python manage.py callbackbench --compare cb.json
+
+每次回调都使用一个新的code, 经过 换取code -> 获取用户信息 -> 查询AD账号 的完整流程, 返回绑定页面即为成功;
+使用 local_settings 中的 INTEGRATION_APP_TYPE 对应的客户端
+"""
+import json
+import platform
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.test import Client
+
+from resetpwd.management.commands.adbench import Command as AdBenchCommand, summarize, code_version
+from utils.ad_mock import reset_mock_directory
+from utils.api_mock import MockApiState, start_mock_api, parse_errors, INJECTABLE_ERRORS
+from utils.http_session import sessions_stats
+from utils.storage.kvstorage import random_string
+
+
+class Command(AdBenchCommand):
+    help = '扫码回调端到端压测(使用本地模拟的企业微信/钉钉API和模拟AD), 统计不同并发下的耗时与吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=settings.LDAP_MOCK_USERS, help='模拟的成员/AD账号数量')
+        parser.add_argument('--concurrency', default='1,8,32', help='并发线程数, 逗号分隔可以测多个级别')
+        parser.add_argument('--requests', type=int, default=200, help='每个并发级别的回调次数')
+        parser.add_argument('--api-latency', type=float, default=0, help='模拟API每个请求的响应延迟(秒)')
+        parser.add_argument('--ldap-latency', type=float, default=settings.LDAP_MOCK_LATENCY,
+                            help='模拟每次LDAP操作的网络往返时间(秒)')
+        parser.add_argument('--errors', default='',
+                            help='按比例注入的错误, 例如 5xx=0.01,42001=0.02, 可选: {}'.format(', '.join(INJECTABLE_ERRORS)))
+        parser.add_argument('--token-ttl', type=int, default=7200, help='access_token的有效期(秒)')
+        parser.add_argument('--output', help='把结果保存为JSON文件')
+        parser.add_argument('--compare', help='与之前保存的JSON结果对比')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+            errors = parse_errors(options['errors'])
+        except ValueError as e:
+            raise CommandError('参数错误: {}'.format(e))
+        if options['users'] < 1 or options['requests'] < 1 or min(levels) < 1:
+            raise CommandError('--users、--requests、--concurrency 必须大于0')
+
+        state = MockApiState(users=options['users'], latency=options['api_latency'], errors=errors,
+                             token_ttl=options['token_ttl'])
+        server = start_mock_api(state)
+        settings.WEWORK_API_BASE_URL = settings.DINGTALK_API_BASE_URL = server.base_url
+        settings.LDAP_MOCK = True
+        reset_mock_directory(users=options['users'], latency=options['ldap_latency'])
+
+        results = OrderedDict()
+        try:
+            for concurrency in levels:
+                result = self._callbacks(options['users'], options['requests'], concurrency)
+                result['op'], result['concurrency'] = 'reset_password_callback', concurrency
+                results['reset_password_callback@{}'.format(concurrency)] = result
+                self.stdout.write('{:<40} c={:<4} p50={:>8.2f}ms p95={:>8.2f}ms p99={:>8.2f}ms max={:>8.2f}ms '
+                                  '{:>9.1f}/s errors={}'.format('reset_password_callback', concurrency,
+                                                                result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                                                                result['max_ms'], result['throughput'],
+                                                                result['errors']))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        report = OrderedDict([
+            ('meta', OrderedDict([
+                ('version', code_version()),
+                ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+                ('python', platform.python_version()),
+                ('users', options['users']),
+                ('requests', options['requests']),
+                ('api_latency', options['api_latency']),
+                ('ldap_latency', options['ldap_latency']),
+                ('errors', errors),
+                ('token_ttl', options['token_ttl']),
+            ])),
+            ('results', results),
+            ('upstream', state.stats),
+            ('sessions', sessions_stats()),
+        ])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write('结果己保存到 {}'.format(options['output']))
+        if options['compare']:
+            self._compare(report, options['compare'])
+
+    @staticmethod
+    def _callbacks(users, requests, concurrency):
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        local = threading.local()
+
+        def call(i):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client()
+            user_id = MockApiState.user_id(i % users + 1)
+            started = time.perf_counter()
+            try:
+                response = client.get('/resetPassword', {'code': '{}.{}'.format(user_id, random_string())})
+                # 成功时返回绑定页面, 页面中有换取到的域账号
+                ok = response.status_code == 200 and 'value="{}"'.format(user_id) in response.content.decode('utf-8')
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='callbackbench') as executor:
+            list(executor.map(call, range(requests)))
+        return summarize(latencies, errors[0], time.perf_counter() - started)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+比较 KvStorage 各序列化方式(utils/storage/codecs.py)在本项目实际数据上的耗时和大小
+
+    python manage.py codecbench
+    python manage.py codecbench --iterations 100000 --compress-threshold 256 --output codec.json
+
+数据为缓存中实际保存的几类值: access_token、扫码code绑定(username -> code)、企业微信成员详情、
+扫码回调结果(utils.storage.cache.OAuthCache)、通讯录索引记录; 没有安装的库(orjson/msgpack)跳过
+"""
+import json
+import platform
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from resetpwd.management.commands.adbench import code_version
+from utils.storage.codecs import CODECS, available_codecs, get_codec
+from utils.storage.kvstorage import random_string
+
+USER_INFO = {
+    'errcode': 0,
+    'errmsg': 'ok',
+    'userid': 'zhangsan',
+    'name': '张三',
+    'gender': '1',
+    'avatar': 'https://wework.qpic.cn/wwhead/duc2TvpEgSSjibPZlNR6chpx1W3BNvMkkeUnFQQBcHOHXRWDjJzNw/0',
+    'qr_code': 'https://open.work.weixin.qq.com/wwopen/userQRCode?vcode=vcfc13b01dfs78e981c',
+    'mobile': '13800000000',
+    'email': 'zhangsan@example.com',
+    'biz_mail': 'zhangsan@corp.example.com',
+    'address': '广州市海珠区新港中路',
+}
+
+# 名称 -> 值
+SAMPLES = OrderedDict([
+    ('access_token', {'value': random_string(62) + random_string(62)[:30], 'expires_at': 1792340091.123456}),
+    ('code_binding', random_string(32)),
+    ('user_info', USER_INFO),
+    ('oauth_result', {'ok': True, 'user_id': 'zhangsan', 'user_info': USER_INFO, 'username': 'zhangsan'}),
+    ('org_entry', {'userid': 'zhangsan', 'name': '张三', 'email': 'zhangsan@example.com',
+                   'biz_mail': 'zhangsan@corp.example.com', 'active': True, 'username': 'zhangsan'}),
+])
+
+
+class Command(BaseCommand):
+    help = '比较缓存各序列化方式在实际数据上的编码/解码耗时和大小'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codecs', help='要比较的序列化方式, 逗号分隔, 默认全部己安装的: {}'.format(
+            ', '.join(available_codecs())))
+        parser.add_argument('--iterations', type=int, default=20000, help='每个值编码、解码的次数')
+        parser.add_argument('--compress-threshold', type=int, default=settings.CACHE_COMPRESS_THRESHOLD,
+                            help='超过这么多字节时压缩, 默认与 CACHE_COMPRESS_THRESHOLD 相同')
+        parser.add_argument('--output', help='把结果保存为JSON文件')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in (options['codecs'] or ','.join(available_codecs())).split(',')
+                 if name.strip()]
+        unknown = [name for name in names if name not in CODECS]
+        if unknown:
+            raise CommandError('未知的序列化方式: {}'.format(', '.join(unknown)))
+        if options['iterations'] < 1:
+            raise CommandError('--iterations 必须大于0')
+
+        results = OrderedDict()
+        for name in names:
+            try:
+                codec = get_codec(name, options['compress_threshold'])
+            except ValueError as e:
+                self.stderr.write('跳过 {}: {}'.format(name, e))
+                continue
+            for sample, value in SAMPLES.items():
+                result = self._run(codec, value, options['iterations'])
+                if result is None:
+                    continue
+                results['{}@{}'.format(name, sample)] = result
+                self.stdout.write('{:<8} {:<14} {:>6}字节 编码{:>8.2f}us 解码{:>8.2f}us'.format(
+                    name, sample, result['bytes'], result['encode_us'], result['decode_us']))
+
+        report = OrderedDict([
+            ('meta', OrderedDict([
+                ('version', code_version()),
+                ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+                ('python', platform.python_version()),
+                ('iterations', options['iterations']),
+                ('compress_threshold', options['compress_threshold']),
+            ])),
+            ('results', results),
+        ])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write('结果己保存到 {}'.format(options['output']))
+
+    @staticmethod
+    def _run(codec, value, iterations):
+        """
+        :return: 结果, 不支持这种值(例如raw只能保存字符串)时返回None
+        """
+        try:
+            data = codec.encode(value)
+        except TypeError:
+            return None
+        if codec.decode(data) != value:
+            raise CommandError('{}编码后解码的结果与原值不同'.format(codec.name))
+        started = time.perf_counter()
+        for _ in range(iterations):
+            codec.encode(value)
+        encode_elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(iterations):
+            codec.decode(data)
+        decode_elapsed = time.perf_counter() - started
+        return OrderedDict([
+            ('bytes', len(data)),
+            ('encode_us', encode_elapsed / iterations * 1e6),
+            ('decode_us', decode_elapsed / iterations * 1e6),
+        ])
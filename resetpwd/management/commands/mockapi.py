@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+启动本地模拟的企业微信、钉钉API服务(utils/api_mock.py)
+
+    python manage.py mockapi --port 8090 --users 1000 --latency 0.05 --errors 5xx=0.01,42001=0.02 --token-ttl 600
+
+然后在 local_settings 中设置(或者在settings.py中临时修改):
+    WEWORK_API_BASE_URL = 'http://127.0.0.1:8090'
+    DINGTALK_API_BASE_URL = 'http://127.0.0.1:8090'
+
+扫码回调可以直接访问 /resetPassword?code=user00001.任意字符 模拟; 按 Ctrl+C 停止时输出各接口的请求数
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.api_mock import MockApiServer, MockApiState, parse_errors, INJECTABLE_ERRORS
+
+
+class Command(BaseCommand):
+    help = '启动本地模拟的企业微信、钉钉API服务, 用于开发调试和压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8090)
+        parser.add_argument('--users', type=int, default=1000, help='模拟的成员数量')
+        parser.add_argument('--latency', type=float, default=0, help='每个请求的响应延迟(秒)')
+        parser.add_argument('--errors', default='',
+                            help='按比例注入的错误, 例如 5xx=0.01,42001=0.02, 可选: {}'.format(', '.join(INJECTABLE_ERRORS)))
+        parser.add_argument('--token-ttl', type=int, default=7200, help='access_token的有效期(秒)')
+
+    def handle(self, *args, **options):
+        try:
+            errors = parse_errors(options['errors'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        state = MockApiState(users=options['users'], latency=options['latency'], errors=errors,
+                             token_ttl=options['token_ttl'])
+        server = MockApiServer((options['host'], options['port']), state)
+        self.stdout.write('模拟API服务己启动: {}'.format(server.base_url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for path, count in sorted(state.stats.items()):
+                self.stdout.write('{:<40} {}'.format(path, count))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+同步本地通讯录索引(utils/org_directory.py), 建议用crontab定时执行, 间隔小于 ORG_DIRECTORY_TTL 的一半
+
+    # 每小时同步一次
+    0 * * * * cd /path/to/project && APP_ENV=prod python manage.py orgsync >> log/orgsync.log 2>&1
+    # 查询某个成员在索引中的记录
+    python manage.py orgsync --show user00001
+
+使用 local_settings 中的 INTEGRATION_APP_TYPE 对应的客户端, 应用需要有通讯录的读取权限
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.ad_ops import AdOps
+from utils.org_directory import get_org_directory
+from utils.providers import get_provider
+
+
+class Command(BaseCommand):
+    help = '从企业微信/钉钉同步成员到本地通讯录索引, 并按邮箱关联AD账号'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show', metavar='USERID', help='只显示某个成员在索引中的记录, 不同步')
+
+    def handle(self, *args, **options):
+        directory = get_org_directory()
+        if options['show']:
+            self.stdout.write(json.dumps(directory.lookup(options['show']), ensure_ascii=False, indent=2))
+            synced_at = directory.synced_at()
+            self.stdout.write('最近一次同步: {}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(synced_at)) if synced_at else '无'))
+            return
+        started = time.perf_counter()
+        try:
+            stats = directory.sync(get_provider().ops, AdOps())
+        except Exception as e:
+            raise CommandError('同步失败: {}'.format(e))
+        self.stdout.write('同步完成, 成员{users}个, 关联到AD账号{resolved}个, 未激活或己禁用{inactive}个, 耗时{elapsed:.1f}秒'.format(
+            elapsed=time.perf_counter() - started, **stats))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+重置密码/解锁账号页面的端到端用例, 使用本地模拟的企业微信/钉钉API(utils/api_mock.py)和模拟AD(utils/ad_mock.py)
+
+    python manage.py test resetpwd
+
+需要 local_settings 中配置的Redis可用(CACHE_BACKEND = 'memory' 时不需要), 否则跳过
+"""
+from __future__ import absolute_import, unicode_literals
+
+import re
+import secrets
+import threading
+import unittest
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from pwdselfservice import cache_storage
+from resetpwd.utils import resolve_code
+from utils.ad_mock import reset_mock_directory, DEFAULT_PASSWORD, MAIL_DOMAIN
+from utils.api_mock import MockApiState, start_mock_api
+from utils.providers import get_provider
+
+NEW_PASSWORD = 'Abcdef123!'
+SESSION_RE = re.compile(r'name="session" readonly value="([^"]+)"')
+# 获取access_token的接口, 不计入换取code的调用次数
+TOKEN_PATHS = ('/gettoken', '/cgi-bin/gettoken')
+
+
+class ResetPasswordViewTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if hasattr(cache_storage, 'ready') and not cache_storage.ready():
+            raise unittest.SkipTest('Redis不可用')
+        super(ResetPasswordViewTest, cls).setUpClass()
+        cls.state = MockApiState(users=20)
+        cls.server = start_mock_api(cls.state)
+        cls.overrides = override_settings(ALLOWED_HOSTS=['*'], LDAP_MOCK=True,
+                                          WEWORK_API_BASE_URL=cls.server.base_url,
+                                          DINGTALK_API_BASE_URL=cls.server.base_url)
+        cls.overrides.enable()
+        # 模拟AD在建立任何LDAP连接之前生成, 各个用例使用不同的账号
+        cls.directory = reset_mock_directory(users=20)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.overrides.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(ResetPasswordViewTest, cls).tearDownClass()
+
+    @staticmethod
+    def new_code(user_id):
+        return '{}.{}'.format(user_id, secrets.token_urlsafe(8))
+
+    def callback(self, user_id):
+        """
+        扫码回调, 返回绑定页面中的会话凭证
+        """
+        response = self.client.get('/resetPassword', {'code': self.new_code(user_id)})
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertIn('value="{}"'.format(user_id), content)
+        return SESSION_RE.search(content).group(1)
+
+    def assertPassword(self, account, password):
+        _dn, code = self.directory.authenticate(self.directory.account_dn(account), password)
+        self.assertIsNone(code)
+
+    def test_reset_session_single_use(self):
+        session = self.callback('user00004')
+        data = {'username': 'user00004', 'session': session, 'new_password': NEW_PASSWORD}
+        self.assertContains(self.client.post('/resetPassword', data), '密码己修改成功')
+        # 同一个会话凭证再次提交被拒绝, 密码不会被再次修改
+        self.assertContains(self.client.post('/resetPassword', dict(data, new_password='Other123!')), '认证已经失效')
+        self.assertPassword('user00004', NEW_PASSWORD)
+
+    def test_reset_session_other_user(self):
+        session = self.callback('user00005')
+        data = {'username': 'user00006', 'session': session, 'new_password': NEW_PASSWORD}
+        self.assertContains(self.client.post('/resetPassword', data), '认证已经失效')
+        self.assertPassword('user00006', DEFAULT_PASSWORD)
+        # 篡改账号的提交不消耗凭证
+        data['username'] = 'user00005'
+        self.assertContains(self.client.post('/resetPassword', data), '密码己修改成功')
+
+    def test_unlock_session_single_use(self):
+        self.directory.lock('user00007')
+        session = self.callback('user00007')
+        self.assertContains(self.client.get('/unlockAccount', {'session': session}), 'value="user00007"')
+        data = {'username': 'user00007', 'session': session}
+        self.assertContains(self.client.post('/unlockAccount', data), '账号己解锁成功')
+        self.assertContains(self.client.post('/unlockAccount', data), '认证已经失效')
+        self.assertPassword('user00007', DEFAULT_PASSWORD)
+
+    def test_reset_locked_account(self):
+        # 锁定的账号重置密码后同时解锁
+        self.directory.lock('user00008')
+        session = self.callback('user00008')
+        data = {'username': 'user00008', 'session': session, 'new_password': NEW_PASSWORD}
+        self.assertContains(self.client.post('/resetPassword', data), '密码己修改成功')
+        self.assertPassword('user00008', NEW_PASSWORD)
+
+    def test_change_password_must_change(self):
+        # 773: 下次登录须修改密码的账号, 用旧密码验证后可以直接修改
+        self.directory.expire_password('user00009')
+        data = {'username': 'user00009@{}'.format(MAIL_DOMAIN), 'old_password': DEFAULT_PASSWORD,
+                'new_password': NEW_PASSWORD, 'ensure_password': NEW_PASSWORD}
+        self.assertContains(self.client.post('/', data), '密码己修改成功')
+        self.assertPassword('user00009', NEW_PASSWORD)
+
+    def test_change_password_wrong_old_password(self):
+        data = {'username': 'user00010@{}'.format(MAIL_DOMAIN), 'old_password': 'Wrong123!',
+                'new_password': NEW_PASSWORD, 'ensure_password': NEW_PASSWORD}
+        response = self.client.post('/', data)
+        self.assertNotContains(response, '密码己修改成功')
+        self.assertPassword('user00010', DEFAULT_PASSWORD)
+
+    def exchange_calls(self):
+        return sum(count for path, count in self.state.stats.items() if path not in TOKEN_PATHS)
+
+    def test_exchange_single_flight(self):
+        ops = get_provider().ops
+        home_url = 'http://testserver'
+        # 先换取一次, 让access_token进入缓存(缓存中的旧token会让第一次换取多重试一次)
+        self.assertTrue(resolve_code(ops, home_url, self.new_code('user00011'))[0])
+        # 一次换取需要的上游调用次数
+        before = self.exchange_calls()
+        self.assertTrue(resolve_code(ops, home_url, self.new_code('user00013'))[0])
+        per_exchange = self.exchange_calls() - before
+
+        code = self.new_code('user00012')
+        results = []
+        barrier = threading.Barrier(8)
+
+        def exchange():
+            barrier.wait()
+            results.append(resolve_code(ops, home_url, code))
+
+        before = self.exchange_calls()
+        threads = [threading.Thread(target=exchange) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(settings.OAUTH_CODE_WAIT + 5)
+        self.assertEqual(self.exchange_calls() - before, per_exchange)
+        self.assertEqual(len(results), 8)
+        for _status, result in results:
+            self.assertTrue(_status)
+            self.assertEqual(result[2], 'user00012')
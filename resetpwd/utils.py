@@ -8,9 +8,19 @@
 
 from django.shortcuts import render
 import logging
+import secrets
+import time
 from ldap3.core.exceptions import LDAPException
 from django.conf import settings
 import os
+from pwdselfservice import cache_storage
+from utils.ad_ops import AdOps, DirectoryUnavailableError
+from utils.async_ad_ops import AsyncAdOps
+from utils.circuit_breaker import Deadline
+from utils.format_username import get_user_is_active, get_email_from_userinfo, get_name_from_email, \
+    invalidate_account
+from utils.org_directory import get_org_directory
+from utils.storage.cache import OAuthCache, SessionCache
 from utils.tracecalls import decorator_logger
 
 APP_ENV = os.getenv('APP_ENV')
@@ -21,25 +31,205 @@ else:
 
 logger = logging.getLogger(__name__)
 
+oauth_cache = OAuthCache(cache_storage, 'oauth')
+# 等待其它请求换取同一个code时的轮询间隔(秒), 从最小值开始倍增
+OAUTH_CODE_POLL_MIN = 0.05
+OAUTH_CODE_POLL_MAX = 0.5
+session_cache = SessionCache(cache_storage, 'session')
+
 
 @decorator_logger(logger, log_head='AccountOps', pretty=True, indent=2, verbose=1)
-def code_2_user_detail(ops, home_url, code):
+def code_2_user_detail(ops, home_url, code, directory=None):
     """
     临时授权码换取userinfo
     """
-    _, s, e = ops.get_user_detail(code=code, home_url=home_url)
+    _, s, e = ops.get_user_detail(code=code, home_url=home_url, directory=directory)
     return _, s, e
 
 
+def resolve_code(ops, home_url, code):
+    """
+    临时授权码 -> (user_id, user_info, 域账号)
+    企业微信/钉钉的code只能使用一次, 刷新页面、浏览器重复请求时直接使用第一次的结果:
+        * 换取结果按code缓存 OAUTH_CODE_CACHE_TTL 秒, 失败的结果缓存 OAUTH_CODE_NEGATIVE_CACHE_TTL 秒
+        * 同一个code同时只有一个请求(包括其它worker)去上游换取, 其它请求等待它的结果
+        * 域账号在第一次查询成功后写回缓存, 域控不可用时不影响己缓存的用户信息
+        * 开启 ORG_DIRECTORY_ENABLED 时成员信息和域账号优先使用本地通讯录索引
+    :return: (True, (user_id, user_info, username)) 或 (False, 需要展示的错误信息context)
+    """
+    entry = oauth_cache.user_by_code.get(code)
+    if entry is None:
+        entry = _exchange_code(ops, home_url, code)
+    if not entry['status']:
+        return False, entry['context']
+    user_id, user_info, username = entry['user_id'], entry['user_info'], entry.get('username')
+    if username is None:
+        _status, username = _resolve_username(home_url, user_info)
+        if not _status:
+            return False, username
+        # 缓存返回的值可能是进程内共用的对象(MemoryStorage/TieredStorage的L1), 复制之后再修改
+        entry = dict(entry, username=username)
+        ttl = int(entry['expires_at'] - time.time())
+        if ttl > 0:
+            oauth_cache.user_by_code.set(code, entry, ttl=ttl)
+    return True, (user_id, user_info, username)
+
+
+def issue_session(username):
+    """
+    认证通过后为域账号创建一次性的会话凭证, 重置密码/解锁页面用它代替扫码的code
+    :return: 随机的凭证(secrets生成), SESSION_TOKEN_TTL 秒内有效
+    """
+    nonce = secrets.token_urlsafe(32)
+    session_cache.otp.set(nonce, username, ttl=settings.SESSION_TOKEN_TTL)
+    return nonce
+
+
+def session_user(nonce):
+    """
+    只查看不消耗, 用于展示页面
+    :return: 凭证对应的域账号, 无效或己使用时返回None
+    """
+    return session_cache.otp.get(nonce) if nonce else None
+
+
+def consume_session(nonce, username):
+    """
+    提交重置密码/解锁时调用, 凭证与域账号匹配时删除并返回True, 同一个凭证只能提交一次
+    """
+    return bool(nonce and username) and session_cache.otp.consume(nonce, username)
+
+
+def _exchange_code(ops, home_url, code):
+    """
+    同一个code只有持有锁的请求去上游换取, 锁的过期时间(OAUTH_CODE_LOCK_TTL)不短于最坏情况下的换取耗时
+    其它请求最多等待 OAUTH_CODE_WAIT 秒, 等不到时提示稍后刷新, 不再用这个code换取
+    """
+    lock_key = oauth_cache.user_by_code.key_name((code, 'lock'))
+    started = time.monotonic()
+    interval = OAUTH_CODE_POLL_MIN
+    while True:
+        lock_value = secrets.token_urlsafe(16)
+        if cache_storage.add(lock_key, lock_value, ttl=settings.OAUTH_CODE_LOCK_TTL):
+            try:
+                return _exchange_and_store(ops, home_url, code)
+            finally:
+                cache_storage.consume(lock_key, lock_value)
+        while True:
+            if time.monotonic() - started >= settings.OAUTH_CODE_WAIT:
+                logger.warning('没有等到code[{}]的换取结果'.format(code))
+                return {'status': False, 'context': {
+                    'global_title': TITLE,
+                    'msg': "⏳正在确认您的身份, 请稍后刷新页面~",
+                    'button_click': "window.location.reload()",
+                    'button_display': "刷新页面"
+                }}
+            time.sleep(interval)
+            interval = min(interval * 2, OAUTH_CODE_POLL_MAX)
+            entry = oauth_cache.user_by_code.get(code)
+            if entry is not None:
+                return entry
+            if cache_storage.get(lock_key) is None:
+                # 持有锁的请求己结束, 结果可能刚好在上一次读取之后写入
+                entry = oauth_cache.user_by_code.get(code)
+                if entry is not None:
+                    return entry
+                # 持有锁的请求异常结束, 没有留下结果, 重新竞争锁
+                break
+
+
+def _exchange_and_store(ops, home_url, code):
+    directory = get_org_directory().lookup if settings.ORG_DIRECTORY_ENABLED else None
+    _status, user_id, user_info = code_2_user_detail(ops, home_url, code, directory)
+    if _status:
+        # 来自通讯录索引的成员信息中有己经查到的域账号, 成员详情中没有username, 由 _resolve_username 查询
+        username = user_info.get('username')
+        entry = {'status': True, 'user_id': user_id, 'user_info': user_info, 'username': username,
+                 'expires_at': time.time() + settings.OAUTH_CODE_CACHE_TTL}
+        oauth_cache.user_by_code.set(code, entry, ttl=settings.OAUTH_CODE_CACHE_TTL)
+    else:
+        # 失败时第二个返回值是需要展示的错误信息
+        entry = {'status': False, 'context': user_id}
+        oauth_cache.user_by_code.set(code, entry, ttl=settings.OAUTH_CODE_NEGATIVE_CACHE_TTL)
+    return entry
+
+
+def _resolve_username(home_url, user_info):
+    """
+    :return: (True, 域账号) 或 (False, 需要展示的错误信息context)
+    """
+    # 账号在企业微信或钉钉中是否是激活的
+    _, res = get_user_is_active(user_info)
+    if not _:
+        return False, {
+            'global_title': TITLE,
+            'msg': '🥹当前扫码的用户未激活或可能己离职, 用户信息如下: %s' % user_info,
+            'button_click': "window.location.href='%s'" % home_url,
+            'button_display': "返回主页"
+        }
+    # 通过user_info拿到用户邮箱, 并格式化为username
+    _, email = get_email_from_userinfo(user_info)
+    if not _:
+        return False, {
+            'global_title': TITLE,
+            'msg': email,
+            'button_click': "window.location.href='%s'" % '/auth',
+            'button_display': "重新认证授权"
+        }
+    # 得到AD域用户名称
+    _, username = get_name_from_email(request_ad_ops(), email)
+    if _ is False:
+        return False, {
+            'global_title': TITLE,
+            'msg': username,
+            'button_click': "window.location.href='%s'" % '/auth',
+            'button_display': "重新认证授权"
+        }
+    return True, username
+
+
+def request_ad_ops():
+    """
+    一次Web请求使用的AdOps, 请求内全部LDAP操作共用 LDAP_REQUEST_DEADLINE 的时间预算
+    """
+    return AdOps(deadline=Deadline(settings.LDAP_REQUEST_DEADLINE))
+
+
+def request_async_ad_ops():
+    """
+    异步视图使用的 AsyncAdOps, 时间预算与 request_ad_ops 相同
+    """
+    return AsyncAdOps(deadline=Deadline(settings.LDAP_REQUEST_DEADLINE))
+
+
+def directory_unavailable(request, msg_template, home_url, error):
+    """
+    域控超时或熔断时快速返回, 不让用户在页面上一直等待
+    """
+    logger.error('[异常] 目录服务不可用: {}'.format(error))
+    context = {
+        'global_title': TITLE,
+        'msg': "😵目录服务暂时不可用, 请稍后再试~",
+        'button_click': "window.location.href='%s'" % home_url,
+        'button_display': "返回主页"
+    }
+    return render(request, msg_template, context, status=503)
+
+
 @decorator_logger(logger, log_head='AccountOps', pretty=True, indent=2, verbose=1)
 def ops_account(ad_ops, request, msg_template, home_url, username, new_password):
     """
     ad 账号操作, 判断账号状态, 重置密码或解锁账号
+    用户记录只查询一次(ad_get_user_record_by_account), 后续的重置、解锁都复用记录中的DN
+    所有操作共用 ad_ops 上的时间预算(request_ad_ops), 域控超时或熔断时返回"目录服务暂不可用"
     """
     try:
-        print("ops_account: {}".format(username))
-        _status, _account = ad_ops.ad_ensure_user_by_account(username=username)
+        logger.debug("ops_account: {}".format(username))
+        # 随后要修改账号, 读取域控上的最新状态, 不使用本地快照
+        _status, record = ad_ops.ad_get_user_record_by_account(username, use_snapshot=False)
         if not _status:
+            # 账号可能己改名或删除, 缓存的 邮箱 -> 域账号 不再可信
+            invalidate_account(username)
             context = {
                 'global_title': TITLE,
                 'msg': "账号[%s]在AD中不存在, 请检查账号信息是否有误~" % username,
@@ -48,8 +238,7 @@ def ops_account(ad_ops, request, msg_template, home_url, username, new_password)
             }
             return render(request, msg_template, context)
 
-        _status, account_code = ad_ops.ad_get_user_status_by_account(username)
-        if _status and account_code in settings.AD_ACCOUNT_DISABLE_CODE:
+        if record.userAccountControl in settings.AD_ACCOUNT_DISABLE_CODE:
             context = {
                 'global_title': TITLE,
                 'msg': "此账号状态为己禁用, 请联系HR确认账号是否正确~",
@@ -57,20 +246,14 @@ def ops_account(ad_ops, request, msg_template, home_url, username, new_password)
                 'button_display': "返回主页"
             }
             return render(request, msg_template, context)
-        elif not _status:
-            context = {
-                'global_title': TITLE,
-                'msg': "🥹错误: {}".format(account_code),
-                'button_click': "window.location.href='%s'" % home_url,
-                'button_display': "返回主页"
-            }
-            return render(request, msg_template, context)
 
         if new_password:
             reset_status, result = ad_ops.ad_reset_user_pwd_by_account(username=username, new_password=new_password)
             if reset_status:
-                # 重置密码并执行一次解锁, 防止重置后账号还是锁定状态
-                unlock_status, result = ad_ops.ad_unlock_user_by_account(username)
+                # 账号处于锁定状态时, 重置密码后再执行一次解锁, 防止重置后账号还是锁定状态
+                unlock_status = True
+                if record.locked:
+                    unlock_status, result = ad_ops.ad_unlock_user_by_account(username)
                 if unlock_status:
                     context = {
                         'global_title': TITLE,
@@ -105,6 +288,8 @@ def ops_account(ad_ops, request, msg_template, home_url, username, new_password)
                     'button_display': "重新认证授权"
                 }
                 return render(request, msg_template, context)
+    except DirectoryUnavailableError as d_e:
+        return directory_unavailable(request, msg_template, home_url, d_e)
     except LDAPException as l_e:
         context = {
             'global_title': TITLE,
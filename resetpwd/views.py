@@ -3,55 +3,40 @@ import logging
 import os
 import traceback
 
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
 from django.shortcuts import render
-from utils.ad_ops import AdOps
+from utils.ad_ops import DirectoryUnavailableError
+from utils.ad_pool import pools_stats
+from utils.circuit_breaker import breakers_stats
 import urllib.parse as url_encode
-from utils.format_username import format2username, get_user_is_active, get_email_from_userinfo, get_name_from_email
+from utils.format_username import format2username, get_name_from_email
 from .form import CheckForm
-from .utils import code_2_user_detail, ops_account
+from .utils import resolve_code, ops_account, request_async_ad_ops, directory_unavailable, issue_session, \
+    session_user, consume_session
 from utils.tracecalls import decorator_logger
 from pwdselfservice import cache_storage
+from utils.providers import get_provider
 
 APP_ENV = os.getenv('APP_ENV')
 if APP_ENV == 'dev':
-    from conf.local_settings_dev import INTEGRATION_APP_TYPE, DING_MO_APP_ID, WEWORK_CORP_ID, WEWORK_AGENT_ID, HOME_URL, \
-        DING_CORP_ID, TITLE
+    from conf.local_settings_dev import INTEGRATION_APP_TYPE, HOME_URL, TITLE
 else:
-    from conf.local_settings import INTEGRATION_APP_TYPE, DING_MO_APP_ID, WEWORK_CORP_ID, WEWORK_AGENT_ID, HOME_URL, \
-        DING_CORP_ID, TITLE
+    from conf.local_settings import INTEGRATION_APP_TYPE, HOME_URL, TITLE
 
 msg_template = 'messages.html'
 logger = logging.getLogger(__name__)
 
 
-class PARAMS(object):
-    if INTEGRATION_APP_TYPE == 'DING':
-        corp_id = DING_CORP_ID
-        app_id = DING_MO_APP_ID
-        agent_id = None
-        AUTH_APP = '钉钉'
-        from utils.dingding_ops import DingDingOps
-        ops = DingDingOps()
-    elif INTEGRATION_APP_TYPE == 'WEWORK':
-        corp_id = None
-        app_id = WEWORK_CORP_ID
-        agent_id = WEWORK_AGENT_ID
-        AUTH_APP = '企微'
-        from utils.wework_ops import WeWorkOps
-        ops = WeWorkOps()
-
-
-scan_params = PARAMS()
-_ops = scan_params.ops
-
-
 @decorator_logger(logger, log_head='Request', pretty=True, indent=2, verbose=1)
 def auth(request):
     home_url = '%s://%s' % (request.scheme, HOME_URL)
-    corp_id = scan_params.corp_id
-    app_id = scan_params.app_id
-    agent_id = scan_params.agent_id
-    scan_app = scan_params.AUTH_APP
+    # 身份提供方的客户端在第一次使用时才创建, 这里只用到扫码页面的参数
+    provider = get_provider()
+    corp_id = provider.corp_id
+    app_id = provider.app_id
+    agent_id = provider.agent_id
+    scan_app = provider.label
     redirect_url = url_encode.quote(home_url + '/resetPassword')
     app_type = INTEGRATION_APP_TYPE
     global_title = TITLE
@@ -61,10 +46,40 @@ def auth(request):
         logger.error('[异常]  请求方法: %s, 请求路径%s' % (request.method, request.path))
 
 
+def health(request):
+    """
+    负载均衡/容器的就绪检查, Redis不可用时返回503
+    同时返回当前worker的LDAP连接池和熔断器状态, 域控不可用时页面会快速提示, 不影响就绪状态
+    """
+    storage = cache_storage.health() if hasattr(cache_storage, 'health') else {'ready': True}
+    ldap = {'pools': pools_stats(), 'breakers': breakers_stats()}
+    return JsonResponse({'status': 'ok' if storage['ready'] else 'unavailable', 'storage': storage, 'ldap': ldap},
+                        status=200 if storage['ready'] else 503)
+
+
 @decorator_logger(logger, log_head='Request', pretty=True, indent=2, verbose=1)
-def index(request):
+async def jsapi_signature(request):
+    """
+    企业微信内打开页面时, 前端用返回的签名调用 wx.config / wx.agentConfig
+    GET参数url为当前页面的完整URL, 只为本站(HOME_URL)的页面签名
+    """
+    provider = get_provider()
+    if not hasattr(provider.async_ops, 'jsapi_signature'):
+        return JsonResponse({'errcode': 1, 'errmsg': '{}不支持JS-SDK签名'.format(provider.label)}, status=404)
+    url = request.GET.get('url') or ''
+    if url_encode.urlsplit(url).netloc != HOME_URL:
+        return JsonResponse({'errcode': 2, 'errmsg': '只能为本站的页面签名'}, status=400)
+    _status, result = await provider.async_ops.jsapi_signature(url)
+    if not _status:
+        logger.error('[异常] JS-SDK签名失败: {}'.format(result))
+        return JsonResponse({'errcode': 3, 'errmsg': result}, status=502)
+    return JsonResponse(dict(result, errcode=0, errmsg='ok'))
+
+
+@decorator_logger(logger, log_head='Request', pretty=True, indent=2, verbose=1)
+async def index(request):
     home_url = '%s://%s' % (request.scheme, HOME_URL)
-    scan_app = scan_params.AUTH_APP
+    scan_app = get_provider().label
     global_title = TITLE
 
     if request.method == 'GET':
@@ -88,21 +103,27 @@ def index(request):
                 'button_display': "重新认证授权"
             }
             return render(request, msg_template, context)
-        # 得到AD域用户名称
-        _, username = get_name_from_email(AdOps(), username)
-        logger.error('用户名称%s' % (username))
-        # # 格式化用户名
-        # _, username = format2username(username)
-        if _ is False:
-            context = {
-                'global_title': TITLE,
-                'msg': username,
-                'button_click': "window.location.href='%s'" % '/auth',
-                'button_display': "重新认证授权"
-            }
-            return render(request, msg_template, context)
-        # 检测账号状态
-        auth_status, auth_result = AdOps().ad_auth_user(username=username, password=old_password)
+        # 同一个请求内共用一个AdOps, 查询到的用户记录可以在后续的验证、重置中复用
+        # LDAP操作在线程池中执行(utils/async_ad_ops.py), 等待域控时不占用事件循环
+        ad_ops = request_async_ad_ops()
+        try:
+            # 得到AD域用户名称
+            _, username = await ad_ops.run(get_name_from_email, ad_ops.ops, username)
+            logger.error('用户名称%s' % (username))
+            # # 格式化用户名
+            # _, username = format2username(username)
+            if _ is False:
+                context = {
+                    'global_title': TITLE,
+                    'msg': username,
+                    'button_click': "window.location.href='%s'" % '/auth',
+                    'button_display': "重新认证授权"
+                }
+                return render(request, msg_template, context)
+            # 检测账号状态
+            auth_status, auth_result = await ad_ops.ad_auth_user(username=username, password=old_password)
+        except DirectoryUnavailableError as d_e:
+            return directory_unavailable(request, msg_template, home_url, d_e)
         if not auth_status:
             context = {
                 'global_title': TITLE,
@@ -111,7 +132,7 @@ def index(request):
                 'button_display': "重新认证授权"
             }
             return render(request, msg_template, context)
-        return ops_account(AdOps(), request, msg_template, home_url, username, new_password)
+        return await ad_ops.run(ops_account, ad_ops.ops, request, msg_template, home_url, username, new_password)
     else:
         context = {
             'global_title': TITLE,
@@ -123,7 +144,7 @@ def index(request):
 
 
 @decorator_logger(logger, log_head='Request', pretty=True, indent=2, verbose=1)
-def reset_password(request):
+async def reset_password(request):
     """
     钉钉扫码并验证信息通过之后, 在重置密码页面将用户账号进行绑定
     :param request:
@@ -132,13 +153,14 @@ def reset_password(request):
     home_url = '%s://%s' % (request.scheme, HOME_URL)
     if request.method == 'GET':
         code = request.GET.get('code')
-        username = request.GET.get('username')
-        # 如果从GET路径中提取到username、code, 并且在缓存中存在username对应的code值, 说明已经认证过
-        if username and code and cache_storage.get(username) == code:
+        session = request.GET.get('session')
+        username = await sync_to_async(session_user, thread_sensitive=False)(session)
+        # 有未使用的会话凭证, 说明已经认证过(例如从解锁页面切换过来)
+        if username:
             context = {
                 'global_title': TITLE,
                 'username': username,
-                'code': code,
+                'session': session,
             }
             return render(request, 'reset_password.html', context)
         # 否则就是第一次认证, 用code换取用户信息
@@ -152,58 +174,31 @@ def reset_password(request):
                 }
                 return render(request, msg_template, context)
             try:
-                _status, user_id, user_info = code_2_user_detail(_ops, home_url, code)
+                # 同一个code的重复请求(刷新页面等)直接使用第一次的换取结果
+                async_ops = get_provider().async_ops
+                _status, result = await async_ops.run(resolve_code, async_ops.ops, home_url, code)
                 if not _status:
-                    return render(request, msg_template, user_id)
-                # 账号在企业微信或钉钉中是否是激活的
-                _, res = get_user_is_active(user_info)
-                if not _:
-                    context = {
-                        'global_title': TITLE,
-                        'msg': '🥹当前扫码的用户未激活或可能己离职, 用户信息如下: %s' % user_info,
-                        'button_click': "window.location.href='%s'" % home_url,
-                        'button_display': "返回主页"
-                    }
-                    return render(request, msg_template, context)
-                # 通过user_info拿到用户邮箱, 并格式化为username
-                _, email = get_email_from_userinfo(user_info)
-                if not _:
-                    context = {
-                        'global_title': TITLE,
-                        'msg': email,
-                        'button_click': "window.location.href='%s'" % '/auth',
-                        'button_display': "重新认证授权"
-                    }
-                    return render(request, msg_template, context)
-                # 得到AD域用户名称
-                _, username = get_name_from_email(AdOps(), email)
-                # _, username = format2username(email)
-                if _ is False:
-                    context = {
-                        'global_title': TITLE,
-                        'msg': username,
-                        'button_click': "window.location.href='%s'" % '/auth',
-                        'button_display': "重新认证授权"
-                    }
-                    return render(request, msg_template, context)
+                    return render(request, msg_template, result)
+                user_id, user_info, username = result
                 if username:
-                    cache_storage.set(username, code, ttl=300)
                     context = {
                         'global_title': TITLE,
                         'username': username,
-                        'code': code,
+                        'session': await sync_to_async(issue_session, thread_sensitive=False)(username),
                     }
                     return render(request, 'reset_password.html', context)
                 else:
                     context = {
                         'global_title': TITLE,
                         'msg': "{}, 您好, 企业{}中未能找到您账号的邮箱配置, 请联系HR完善信息~".format(
-                            user_info.get('name'), scan_params.AUTH_APP),
+                            user_info.get('name'), get_provider().label),
                         'button_click': "window.location.href='%s'" % '/auth',
                         'button_display': "重新认证授权"
                     }
                     return render(request, msg_template, context)
 
+            except DirectoryUnavailableError as d_e:
+                return directory_unavailable(request, msg_template, home_url, d_e)
             except Exception as callback_e:
                 context = {
                     'global_title': TITLE,
@@ -217,12 +212,13 @@ def reset_password(request):
     # 重置密码页面, 输入新密码后点击提交
     elif request.method == 'POST':
         username = request.POST.get('username')
-        code = request.POST.get('code')
-        if username and code and cache_storage.get(username) == code:
+        # 验证并消耗会话凭证, 同一个凭证不能重复提交
+        if await sync_to_async(consume_session, thread_sensitive=False)(request.POST.get('session'), username):
             _new_password = request.POST.get('new_password').strip()
             try:
-                return ops_account(ad_ops=AdOps(), request=request, msg_template=msg_template, home_url=home_url,
-                                   username=username, new_password=_new_password)
+                ad_ops = request_async_ad_ops()
+                return await ad_ops.run(ops_account, ad_ops=ad_ops.ops, request=request, msg_template=msg_template,
+                                        home_url=home_url, username=username, new_password=_new_password)
             except Exception as reset_e:
                 context = {
                     'global_title': TITLE,
@@ -243,7 +239,7 @@ def reset_password(request):
 
 
 @decorator_logger(logger, log_head='Request', pretty=True, indent=2, verbose=1)
-def unlock_account(request):
+async def unlock_account(request):
     """
     解锁账号
     :param request:
@@ -252,19 +248,19 @@ def unlock_account(request):
     home_url = '%s://%s' % (request.scheme, HOME_URL)
 
     if request.method == 'GET':
-        code = request.GET.get('code')
-        username = request.GET.get('username')
-        if username and code and cache_storage.get(username) == code:
+        session = request.GET.get('session')
+        username = await sync_to_async(session_user, thread_sensitive=False)(session)
+        if username:
             context = {
                 'global_title': TITLE,
                 'username': username,
-                'code': code,
+                'session': session,
             }
             return render(request, 'unlock.html', context)
         else:
             context = {
                 'global_title': TITLE,
-                'msg': "{}, 您好, 当前会话可能已经过期, 请再试一次叭~".format(username),
+                'msg': "您好, 当前会话可能已经过期, 请再试一次叭~",
                 'button_click': "window.location.href='%s'" % '/auth',
                 'button_display': "重新认证授权"
             }
@@ -272,10 +268,10 @@ def unlock_account(request):
 
     if request.method == 'POST':
         username = request.POST.get('username')
-        code = request.POST.get('code')
-        if username and code and cache_storage.get(username) == code:
+        if await sync_to_async(consume_session, thread_sensitive=False)(request.POST.get('session'), username):
             try:
-                return ops_account(AdOps(), request, msg_template, home_url, username, None)
+                ad_ops = request_async_ad_ops()
+                return await ad_ops.run(ops_account, ad_ops.ops, request, msg_template, home_url, username, None)
             except Exception as reset_e:
                 context = {
                     'global_title': TITLE,
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+基于 ldap3 MOCK_SYNC 的本地模拟AD, 用于开发调试和压测, 不需要连接真实的域控
+
+settings.LDAP_MOCK = True 时 AdOps 的所有连接都改为连接本进程内的模拟AD:
+    * BASE_DN 下生成 LDAP_MOCK_USERS 个账号(user00001 ...), 密码都是 DEFAULT_PASSWORD,
+      管理员账号使用 local_settings 中的 LDAP_LOGIN_USER / LDAP_LOGIN_USER_PWD
+    * 绑定时按AD的方式返回子错误码: 525 账号不存在, 52e 密码错误, 775 账号已锁定, 533 账号已禁用, 773 下次登录须修改密码,
+      连续输错 lockout_threshold 次密码后账号被锁定
+    * 以 MODIFY_REPLACE 修改 unicodePwd 即重置密码, 同时更新 pwdLastSet; lockoutTime 改为0即解锁
+    * 每次修改都会递增 uSNChanged 与根DSE的 highestCommittedUSN, 可以用于验证目录快照的增量同步
+    * LDAP_MOCK_LATENCY 为每次LDAP操作模拟的网络往返时间(秒)
+
+    directory = get_mock_directory()
+    directory.lock('user00001')
+    directory.expire_password('user00002')
+
+BASE_DN / LDAP_DOMAIN / LDAP_LOGIN_USER 需要是有效的值, 模拟AD直接使用它们生成账号
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2, SIMPLE, ANONYMOUS, MODIFY_REPLACE
+from ldap3.core.exceptions import LDAPInvalidCredentialsResult
+from ldap3.core.results import RESULT_SUCCESS, RESULT_INVALID_CREDENTIALS
+from ldap3.utils.ciDict import CaseInsensitiveDict
+from ldap3.utils.conv import to_raw, to_unicode
+from ldap3.utils.dn import safe_dn
+
+APP_ENV = os.getenv('APP_ENV')
+if APP_ENV == 'dev':
+    from conf.local_settings_dev import BASE_DN, LDAP_DOMAIN, LDAP_LOGIN_USER, LDAP_LOGIN_USER_PWD
+else:
+    from conf.local_settings import BASE_DN, LDAP_DOMAIN, LDAP_LOGIN_USER, LDAP_LOGIN_USER_PWD
+
+DEFAULT_PASSWORD = 'Passw0rd!'
+MAIL_DOMAIN = 'example.com'
+SERVICE_NAME = 'CN=NTDS Settings,CN=MOCK-DC,CN=Servers,CN=Default-First-Site-Name,CN=Sites,CN=Configuration,{}'
+
+# MOCK不支持空DN, 根DSE保存在这个DN下, 查询''时改为查询它
+ROOT_DSE_DN = 'CN=RootDSE'
+
+# userAccountControl 标志位
+UF_ACCOUNTDISABLE = 0x2
+UF_NORMAL_ACCOUNT = 0x200
+
+# 与AD返回的绑定错误信息格式一致, AdOps 从中解析 "data xxx" 子错误码
+AD_BIND_ERROR_MESSAGE = '80090308: LdapErr: DSID-0C09042A, comment: AcceptSecurityContext error, data {}, v3839'
+
+# 1601-01-01 到 1970-01-01 的秒数, AD的时间属性是从1601-01-01开始的100纳秒数
+FILETIME_EPOCH_OFFSET = 11644473600
+
+
+def filetime_now():
+    return int((time.time() + FILETIME_EPOCH_OFFSET) * 10 ** 7)
+
+
+def _normalize_changes(changes):
+    """
+    ldap3 的 changes 可以是 {attr: (op, values)} 或 {attr: [(op, values), ...]}, 统一为后者
+    """
+    normalized = {}
+    for attr, change in changes.items():
+        if isinstance(change, tuple):
+            change = [change]
+        normalized[attr] = [(op, list(values)) for op, values in change]
+    return normalized
+
+
+class MockAdDirectory(object):
+
+    def __init__(self, users=100, latency=0, lockout_threshold=5, password=DEFAULT_PASSWORD):
+        self.server = Server('mock-ad', get_info=OFFLINE_AD_2012_R2)
+        self.latency = latency
+        self.lockout_threshold = lockout_threshold
+        self.domain = LDAP_DOMAIN.split('.')[0].lower()
+        self.usn = 0
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._bad_pwd_count = {}
+        self._loader = Connection(self.server, client_strategy=MOCK_SYNC)
+        # 根DSE的属性不在schema里, 不能用add_entry添加
+        root_dse = CaseInsensitiveDict()
+        root_dse['objectClass'] = [b'top']
+        root_dse['dsServiceName'] = [to_raw(SERVICE_NAME.format(BASE_DN))]
+        root_dse['highestCommittedUSN'] = [b'0']
+        self.server.dit[ROOT_DSE_DN] = root_dse
+        self.add_user(LDAP_LOGIN_USER, LDAP_LOGIN_USER_PWD)
+        for i in range(1, users + 1):
+            self.add_user('user{:05d}'.format(i), password)
+
+    @staticmethod
+    def account_dn(account):
+        return safe_dn('CN={},{}'.format(account, BASE_DN))
+
+    def add_user(self, account, password, mail=None, user_account_control=UF_NORMAL_ACCOUNT):
+        dn = self.account_dn(account)
+        with self._lock:
+            self.usn += 1
+            self._loader.strategy.add_entry(dn, {
+                'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+                'sAMAccountName': account,
+                'mail': mail or '{}@{}'.format(account, MAIL_DOMAIN),
+                'userAccountControl': str(user_account_control),
+                'lockoutTime': '0',
+                'pwdLastSet': str(filetime_now()),
+                'userPassword': password,
+                'uSNChanged': str(self.usn),
+            }, validate=False)
+            self._accounts[account.lower()] = dn
+            self._set_usn(self.usn)
+        return dn
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def resolve(self, user):
+        """
+        支持 DOMAIN\\sAMAccountName、sAMAccountName@domain 和完整DN三种绑定名
+        :return: DN, 账号不存在时返回None
+        """
+        if not user:
+            return None
+        if '\\' in user:
+            domain, account = user.split('\\', 1)
+            if domain.split('.')[0].lower() != self.domain:
+                return None
+            return self._accounts.get(account.lower())
+        if '@' in user:
+            return self._accounts.get(user.split('@', 1)[0].lower())
+        dn = safe_dn(user)
+        return dn if dn in self.server.dit else None
+
+    def _get(self, dn, attr):
+        values = self.server.dit[dn].get(attr)
+        return to_unicode(values[0]) if values else None
+
+    def _get_int(self, dn, attr):
+        return int(self._get(dn, attr) or 0)
+
+    def _set(self, dn, **attributes):
+        with self.server.dit_lock:
+            entry = self.server.dit[dn]
+            for attr, value in attributes.items():
+                entry[attr] = [to_raw(str(value))]
+        self.touch(dn)
+
+    def _set_usn(self, usn):
+        self.server.dit[ROOT_DSE_DN]['highestCommittedUSN'] = [to_raw(str(usn))]
+
+    def touch(self, dn):
+        with self._lock:
+            self.usn += 1
+            self.server.dit[dn]['uSNChanged'] = [to_raw(str(self.usn))]
+            self._set_usn(self.usn)
+
+    def authenticate(self, user, password):
+        """
+        按AD的顺序检查账号状态
+        :return: (DN, 子错误码), 验证通过时子错误码为None
+        """
+        dn = self.resolve(user)
+        if dn is None:
+            return None, '525'
+        if self._get_int(dn, 'lockoutTime'):
+            return dn, '775'
+        if self._get(dn, 'userPassword') != password:
+            with self._lock:
+                count = self._bad_pwd_count.get(dn, 0) + 1
+                self._bad_pwd_count[dn] = count
+            if self.lockout_threshold and count >= self.lockout_threshold:
+                self._set(dn, lockoutTime=filetime_now())
+            return dn, '52e'
+        self._bad_pwd_count.pop(dn, None)
+        if self._get_int(dn, 'userAccountControl') & UF_ACCOUNTDISABLE:
+            return dn, '533'
+        if self._get_int(dn, 'pwdLastSet') == 0:
+            return dn, '773'
+        return dn, None
+
+    def translate_changes(self, dn, changes):
+        """
+        把AD特有的修改翻译成MOCK能处理的修改:
+            unicodePwd 替换 -> userPassword + pwdLastSet
+            pwdLastSet -1 -> 当前时间
+        """
+        translated = {}
+        for attr, operations in _normalize_changes(changes).items():
+            for op, values in operations:
+                if attr.lower() == 'unicodepwd' and op == MODIFY_REPLACE:
+                    password = values[0]
+                    if isinstance(password, bytes):
+                        password = password.decode('utf-16-le')
+                    translated.setdefault('userPassword', []).append((MODIFY_REPLACE, [password.strip('"')]))
+                    translated.setdefault('pwdLastSet', []).append((MODIFY_REPLACE, [str(filetime_now())]))
+                elif attr.lower() == 'pwdlastset' and op == MODIFY_REPLACE and str(values[0]) == '-1':
+                    translated.setdefault(attr, []).append((op, [str(filetime_now())]))
+                else:
+                    if attr.lower() == 'lockouttime' and op == MODIFY_REPLACE and str(values[0]) == '0':
+                        self._bad_pwd_count.pop(safe_dn(dn), None)
+                    translated.setdefault(attr, []).append((op, values))
+        return translated
+
+    # 以下用于构造测试场景
+    def lock(self, account):
+        self._set(self._accounts[account.lower()], lockoutTime=filetime_now())
+
+    def unlock(self, account):
+        dn = self._accounts[account.lower()]
+        self._bad_pwd_count.pop(dn, None)
+        self._set(dn, lockoutTime=0)
+
+    def disable(self, account):
+        dn = self._accounts[account.lower()]
+        self._set(dn, userAccountControl=self._get_int(dn, 'userAccountControl') | UF_ACCOUNTDISABLE)
+
+    def expire_password(self, account):
+        self._set(self._accounts[account.lower()], pwdLastSet=0)
+
+    def set_password(self, account, password):
+        self._set(self._accounts[account.lower()], userPassword=password, pwdLastSet=filetime_now())
+
+
+class MockAdConnection(Connection):
+    """
+    连接模拟AD的 Connection, 参数与 ldap3.Connection 相同, client_strategy 固定为 MOCK_SYNC
+    MOCK只支持SIMPLE绑定, 这里先按AD的规则验证账号, 再以账号的DN做SIMPLE绑定
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        kwargs['client_strategy'] = MOCK_SYNC
+        super(MockAdConnection, self).__init__(server, *args, **kwargs)
+        self.directory = get_mock_directory()
+
+    def bind(self, read_server_info=True, controls=None):
+        self.directory.delay()
+        if self.authentication == ANONYMOUS or not self.user:
+            return super(MockAdConnection, self).bind(read_server_info=False, controls=controls)
+        dn, code = self.directory.authenticate(self.user, self.password)
+        if code is not None:
+            return self._bind_failed(code)
+        user, authentication = self.user, self.authentication
+        self.user, self.authentication = dn, SIMPLE
+        try:
+            return super(MockAdConnection, self).bind(read_server_info=False, controls=controls)
+        finally:
+            self.user, self.authentication = user, authentication
+
+    def _bind_failed(self, code):
+        message = AD_BIND_ERROR_MESSAGE.format(code)
+        self.bound = False
+        self.last_error = message
+        self.result = {'result': RESULT_INVALID_CREDENTIALS, 'description': 'invalidCredentials', 'dn': '',
+                       'message': message, 'referrals': None, 'saslCreds': None, 'type': 'bindResponse'}
+        if self.raise_exceptions:
+            raise LDAPInvalidCredentialsResult(result=RESULT_INVALID_CREDENTIALS, description='invalidCredentials',
+                                               dn='', message=message, response_type='bindResponse')
+        return False
+
+    def search(self, search_base, *args, **kwargs):
+        self.directory.delay()
+        return super(MockAdConnection, self).search(search_base or ROOT_DSE_DN, *args, **kwargs)
+
+    def modify(self, dn, changes, controls=None):
+        self.directory.delay()
+        result = super(MockAdConnection, self).modify(dn, self.directory.translate_changes(dn, changes), controls)
+        if self.result and self.result['result'] == RESULT_SUCCESS:
+            self.directory.touch(safe_dn(dn))
+        return result
+
+    def extended(self, *args, **kwargs):
+        self.directory.delay()
+        return super(MockAdConnection, self).extended(*args, **kwargs)
+
+
+class MockDomainControllerSelector(object):
+    """
+    与 DomainControllerSelector 接口相同, 只有一台模拟域控
+    """
+    connection_class = MockAdConnection
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def server(self):
+        return self.directory.server
+
+    def connect(self, make_connection, bind=True):
+        conn = make_connection(self.directory.server)
+        conn.open(read_server_info=False)
+        if bind:
+            conn.bind(read_server_info=False)
+        return conn
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_mock_directory():
+    global _directory
+    with _directory_lock:
+        if _directory is None:
+            _directory = MockAdDirectory(users=settings.LDAP_MOCK_USERS, latency=settings.LDAP_MOCK_LATENCY)
+        return _directory
+
+
+def reset_mock_directory(**kwargs):
+    """
+    按参数重新生成模拟AD, 参数与 MockAdDirectory 相同; 在建立任何连接之前调用
+    """
+    global _directory
+    with _directory_lock:
+        kwargs.setdefault('users', settings.LDAP_MOCK_USERS)
+        kwargs.setdefault('latency', settings.LDAP_MOCK_LATENCY)
+        _directory = MockAdDirectory(**kwargs)
+        return _directory
+
+
+def get_mock_selector():
+    return MockDomainControllerSelector(get_mock_directory())
@@ -1,9 +1,17 @@
 from ldap3 import *
-from ldap3.core.exceptions import LDAPInvalidCredentialsResult, LDAPOperationResult, LDAPExceptionError, LDAPException, \
-    LDAPSocketOpenError
+from ldap3.core.exceptions import LDAPInvalidCredentialsResult, LDAPExceptionError, LDAPException, \
+    LDAPSocketOpenError, LDAPCommunicationError
 from ldap3.core.results import *
 from ldap3.utils.dn import safe_dn
 import os
+import re
+from django.conf import settings
+from collections import namedtuple
+from contextlib import contextmanager
+from utils.ad_pool import get_pool, LDAPPoolTimeoutError
+from utils.ad_servers import get_selector
+from utils.ad_snapshot import get_snapshot
+from utils.circuit_breaker import get_breaker, CircuitOpenError, DeadlineExceeded
 from utils.tracecalls import decorator_logger
 import logging
 
@@ -38,14 +46,95 @@ unicodePwd 属性的语法为 octet-string;但是, 目录服务预期八进制
 此修改请求应包含单个替换操作, 其中包含用引号括起的新所需密码 如果客户端具有足够的权限, 则无论旧密码是什么, 此密码都将变为新密码
 """
 
+# AD绑定失败时, 错误信息中 "data 52e" 部分是子错误码, 例如:
+# 80090308: LdapErr: DSID-0C09042A, comment: AcceptSecurityContext error, data 52e, v3839
+AD_BIND_ERROR_RE = re.compile(r'\bdata ([0-9a-f]{3,4})\b', re.IGNORECASE)
+AD_BIND_ERRORS = {
+    '52e': u'账号或旧密码不正确!',
+    '775': u'账号已锁定, 请自行解锁!',
+    '533': u'账号已禁用!',
+    '525': u'账号不存在!',
+    '532': u'密码己过期!',
+    '701': u'账号己过期!',
+    '773': u'用户登陆前必须修改密码!',
+}
+AD_BIND_ERROR_DEFAULT = u'旧密码认证失败, 请确认账号的旧密码是否正确或使用重置密码功能'
+
+AdBindResult = namedtuple('AdBindResult', ['ok', 'code', 'message'])
+
+
+class DirectoryUnavailableError(LDAPException):
+    """
+    域控无法在时间预算内响应: 连接/读取超时、连接池排队超时、熔断中或请求的时间预算己用完
+    AdOps的方法不会把它转换为 (False, msg), 由视图统一返回"目录服务暂不可用"页面
+    """
+    pass
+
+
+def parse_bind_error(message):
+    """
+    从AD返回的绑定错误信息中解析出子错误码
+    :return: 小写的子错误码, 例如 52e, 解析不到时返回None
+    """
+    matched = AD_BIND_ERROR_RE.search(message or '')
+    return matched.group(1).lower() if matched else None
+
+
+# 一次查询取回重置/解锁流程需要的全部属性, 同一个请求内复用
+USER_RECORD_ATTRIBUTES = ['sAMAccountName', 'userAccountControl', 'lockoutTime', 'pwdLastSet', 'mail']
+
+
+def _raw_first(raw, attr):
+    values = raw.get(attr.lower())
+    return values[0] if values else None
+
+
+def _raw_int(raw, attr):
+    value = _raw_first(raw, attr)
+    return int(value) if value else 0
+
+
+def _raw_text(raw, attr):
+    value = _raw_first(raw, attr)
+    return value.decode('utf-8') if value else None
+
+
+class AdUserRecord(namedtuple('AdUserRecord',
+                              ['dn', 'sAMAccountName', 'userAccountControl', 'lockoutTime', 'pwdLastSet', 'mail'])):
+    """
+    精简的用户记录, lockoutTime/pwdLastSet 保留AD中的原始FILETIME整数
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_raw(cls, dn, raw_attributes):
+        raw = {attr.lower(): values for attr, values in raw_attributes.items()}
+        return cls(dn=dn,
+                   sAMAccountName=_raw_text(raw, 'sAMAccountName'),
+                   userAccountControl=_raw_int(raw, 'userAccountControl'),
+                   lockoutTime=_raw_int(raw, 'lockoutTime'),
+                   pwdLastSet=_raw_int(raw, 'pwdLastSet'),
+                   mail=_raw_text(raw, 'mail'))
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls.from_raw(entry.entry_dn, entry.entry_raw_attributes)
+
+    @property
+    def locked(self):
+        # lockoutTime为0(即1601-01-01)说明账号未锁定
+        return self.lockoutTime > 0
+
 
 class AdOps(object):
 
     def __init__(self, auto_bind=True, use_ssl=LDAP_USE_SSL, port=LDAP_CONN_PORT, domain=LDAP_DOMAIN, user=LDAP_LOGIN_USER,
                  password=LDAP_LOGIN_USER_PWD,
-                 authentication=NTLM):
+                 authentication=NTLM, deadline=None):
         """
         AD连接器 authentication  [SIMPLE, ANONYMOUS, SASL, NTLM]
+        :param deadline: utils.circuit_breaker.Deadline, 本实例(即一次请求)内所有LDAP操作共用的时间预算, None表示不限制,
+                         每次LDAP操作的超时不超过 LDAP_RECEIVE_TIMEOUT 与剩余预算中较小的一个
         :return:
 
         """
@@ -57,37 +146,166 @@ class AdOps(object):
         self.password = password
         self.authentication = authentication
         self.auto_bind = auto_bind
+        self.deadline = deadline
         self.server = None
         self.conn = None
+        # 当前实例(即一次请求)内己查询过的用户记录, key为小写的sAMAccountName
+        self._user_records = {}
+
+    def __selector(self):
+        return get_selector(LDAP_HOST, self.port, self.use_ssl)
 
     def __server(self):
+        """
+        当前最快的可用域控, 同一个worker内共享Server对象及其DSA/Schema信息
+        """
         if self.server is None:
+            self.server = self.__selector().server()
+        return self.server
+
+    def __new_conn(self):
+        """
+        连接池的连接工厂, 新建一个己绑定的管理员连接, 域控连接失败时自动切换到下一台
+        """
+        selector = self.__selector()
+        return selector.connect(
+            lambda server: selector.connection_class(server,
+                                                     user=r'{}\{}'.format(self.domain, self.user),
+                                                     password=self.password,
+                                                     authentication=self.authentication,
+                                                     receive_timeout=settings.LDAP_RECEIVE_TIMEOUT,
+                                                     raise_exceptions=True),
+            bind=self.auto_bind)
+
+    def __timeout(self):
+        """
+        本次LDAP操作的超时时间
+        :raise DirectoryUnavailableError: 时间预算己用完
+        """
+        if self.deadline is None:
+            return settings.LDAP_RECEIVE_TIMEOUT
+        try:
+            return self.deadline.timeout(settings.LDAP_RECEIVE_TIMEOUT)
+        except DeadlineExceeded as e:
+            raise DirectoryUnavailableError(str(e))
+
+    @staticmethod
+    def __apply_timeout(conn, timeout):
+        # 连接池中的连接是长连接, 每次取出后按剩余预算重新设置socket的读超时, 超时后连接会被连接池丢弃
+        sock = getattr(conn, 'socket', None)
+        if sock is not None:
+            sock.settimeout(timeout)
+
+    @contextmanager
+    def __checkout(self, pool):
+        """
+        经过熔断器从连接池取连接, 通信失败、排队超时计入熔断器并转换为 DirectoryUnavailableError,
+        域控返回的业务错误(密码错误、对象不存在等)说明域控是可用的
+        """
+        breaker = get_breaker('ldap:{}:{}'.format(LDAP_HOST, self.port), settings.LDAP_BREAKER_FAILURE_THRESHOLD,
+                              settings.LDAP_BREAKER_RECOVERY_TIME)
+        timeout = self.__timeout()
+        try:
+            breaker.allow()
+        except CircuitOpenError as e:
+            raise DirectoryUnavailableError(str(e))
+        try:
+            with pool.connection(timeout=min(timeout, pool.checkout_timeout)) as conn:
+                self.__apply_timeout(conn, timeout)
+                yield conn
+        except (LDAPCommunicationError, LDAPPoolTimeoutError) as e:
+            breaker.record_failure()
+            raise DirectoryUnavailableError('连接域控失败或超时: {}'.format(e))
+        except DirectoryUnavailableError:
+            raise
+        except Exception:
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
+
+    @contextmanager
+    def __connection(self):
+        """
+        从当前worker的连接池中取出一个己绑定的连接, 在with块内挂到self.conn上
+        嵌套调用(例如解锁时先查询DN)复用同一个连接, 最外层退出时归还连接池
+        """
+        if self.conn is not None:
+            self.__apply_timeout(self.conn, self.__timeout())
+            yield self.conn
+            return
+        pool = get_pool(('admin', LDAP_HOST, self.port, self.use_ssl, self.domain, self.user), self.__new_conn)
+        with self.__checkout(pool) as conn:
+            self.conn = conn
             try:
-                self.server = Server(host='%s' % LDAP_HOST, connect_timeout=1, use_ssl=self.use_ssl, port=self.port, get_info=ALL)
-            except LDAPInvalidCredentialsResult as lic_e:
-                return False, LDAPOperationResult("LDAPInvalidCredentialsResult: " + str(lic_e.message))
-            except LDAPOperationResult as lo_e:
-                return False, LDAPOperationResult("LDAPOperationResult: " + str(lo_e.message))
-            except LDAPException as l_e:
-                return False, LDAPException("LDAPException: " + str(l_e))
-
-    def __conn(self):
-        if self.conn is None:
+                yield conn
+            finally:
+                self.conn = None
+
+    @contextmanager
+    def pinned(self):
+        """
+        with块内的所有方法共用同一个连接(同一台域控), 例如增量同步时uSN必须来自同一台域控
+        """
+        with self.__connection():
+            yield self
+
+    def __new_verifier(self):
+        """
+        验证用户密码的连接池的连接工厂, 只建立连接不绑定, 每次验证时以用户身份重新绑定
+        """
+        selector = self.__selector()
+        return selector.connect(lambda server: selector.connection_class(server,
+                                                                         receive_timeout=settings.LDAP_RECEIVE_TIMEOUT,
+                                                                         raise_exceptions=True),
+                                bind=False)
+
+    def __verify(self, username, password):
+        pool = get_pool(('verifier', LDAP_HOST, self.port, self.use_ssl), self.__new_verifier)
+        with self.__checkout(pool) as conn:
             try:
-                self.__server()
-                self.conn = Connection(self.server,
-                                       auto_bind=self.auto_bind, user=r'{}\{}'.format(self.domain, self.user),
-                                       password=self.password,
-                                       authentication=self.authentication,
-                                       raise_exceptions=True)
-            except LDAPInvalidCredentialsResult as lic_e:
-                return False, LDAPOperationResult("LDAPInvalidCredentialsResult: " + str(lic_e.message))
+                conn.rebind(user=r'{}\{}'.format(self.domain, username), password=password, authentication=SIMPLE,
+                            read_server_info=False)
+                return AdBindResult(True, None, '旧密码验证通过')
+            except LDAPInvalidCredentialsResult as e:
+                code = parse_bind_error(e.message)
+                return AdBindResult(False, code, AD_BIND_ERRORS.get(code, AD_BIND_ERROR_DEFAULT))
+            finally:
+                self.__reset_verifier(conn)
 
-            except LDAPOperationResult as lo_e:
-                return False, LDAPOperationResult("LDAPOperationResult: " + str(lo_e.message))
+    @staticmethod
+    def __reset_verifier(conn):
+        """
+        恢复为匿名身份再归还连接池, 连接上不残留用户的身份和密码
+        绑定失败时AD己经把连接重置为匿名, 只清除身份不重新绑定; 恢复失败时关闭连接, 连接池会丢弃它
+        """
+        conn.user, conn.password, conn.authentication = None, None, ANONYMOUS
+        if not conn.bound:
+            return
+        try:
+            conn.bind(read_server_info=False)
+        except LDAPException as e:
+            logger.warning("验证连接恢复匿名身份失败, 关闭连接: {}".format(e))
+            conn.unbind()
 
-            except LDAPException as l_e:
-                return False, LDAPException("LDAPException: " + str(l_e))
+    def ad_verify_user(self, username, password):
+        """
+        验证账号密码, 使用专门的验证连接池, 不再为每次验证新建连接
+        :param username:
+        :param password:
+        :return: AdBindResult(ok, code, message), code是AD返回的子错误码, 例如52e
+        """
+        result = self.__verify(username, password)
+        if result.code == '773':
+            # 如果仅仅使用普通凭据来绑定ldap用途, 请返回失败, 让用户通过其他途径修改密码后再来验证登陆
+            # 设置该账号下次登陆不需要更改密码, 使用连接池中的管理员连接修改, 再验证一次
+            _status, record = self.ad_get_user_record_by_account(username)
+            if not _status:
+                return AdBindResult(False, result.code, record)
+            with self.__connection():
+                self.conn.modify(record.dn, {'pwdLastSet': [(MODIFY_REPLACE, ['-1'])]})
+            result = self.__verify(username, password)
+        return result
 
     @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
     def ad_auth_user(self, username, password):
@@ -98,35 +316,10 @@ class AdOps(object):
         :return: True or False
         """
         try:
-            self.__server()
-            c_auth = Connection(server=self.server, user=r'{}\{}'.format(self.domain, username), password=password,
-                                auto_bind=True, raise_exceptions=True)
-            c_auth.unbind()
-            return True, '旧密码验证通过'
-        except LDAPInvalidCredentialsResult as e:
-            if '52e' in e.message:
-                return False, u'账号或旧密码不正确!'
-            elif '775' in e.message:
-                return False, u'账号已锁定, 请自行解锁!'
-            elif '533' in e.message:
-                return False, u'账号已禁用!'
-            elif '525' in e.message:
-                return False, u'账号不存在!'
-            elif '532' in e.message:
-                return False, u'密码己过期!'
-            elif '701' in e.message:
-                return False, u'账号己过期!'
-            elif '773' in e.message:
-                # 如果仅仅使用普通凭据来绑定ldap用途, 请返回False, 让用户通过其他途径修改密码后再来验证登陆
-                # return False, '用户登陆前必须修改密码!'
-                # 设置该账号下次登陆不需要更改密码, 再验证一次
-                self.__conn()
-                self.conn.search(search_base=BASE_DN, search_filter=SEARCH_FILTER.format(username),
-                                 attributes=['pwdLastSet'])
-                self.conn.modify(self.conn.entries[0].entry_dn, {'pwdLastSet': [(MODIFY_REPLACE, ['-1'])]})
-                return True, self.ad_auth_user(username, password)
-            else:
-                return False, u'旧密码认证失败, 请确认账号的旧密码是否正确或使用重置密码功能'
+            result = self.ad_verify_user(username, password)
+            return result.ok, result.message
+        except DirectoryUnavailableError:
+            raise
         except LDAPException as e:
             return False, "连接Ldap失败, 报错如下: {}".format(e)
 
@@ -136,12 +329,44 @@ class AdOps(object):
         :param username:
         :return: True or False
         """
+        _status, record = self.ad_get_user_record_by_account(username)
+        if not _status:
+            return False, record
+        return True, record.sAMAccountName
+
+    def _remember(self, record):
+        self._user_records[record.sAMAccountName.lower()] = record
+        return record
+
+    @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
+    def ad_get_user_record_by_account(self, username, use_snapshot=True):
+        """
+        一次查询取回用户的DN、sAMAccountName、userAccountControl、lockoutTime、pwdLastSet、mail
+        同一个AdOps实例内重复调用直接返回己查询到的记录
+        :param username:
+        :param use_snapshot: 是否允许使用本地目录快照, 随后要修改账号时应传False, 读取域控上的最新状态
+        :return: AdUserRecord
+        """
+        record = self._user_records.get(username.lower())
+        if record is not None:
+            return True, record
+        if use_snapshot:
+            record = get_snapshot().lookup_account(username)
+            if record is not None:
+                return True, record
         try:
-            self.__conn()
-            return True, self.conn.search(BASE_DN, SEARCH_FILTER.format(username), attributes=['sAMAccountName'])
+            with self.__connection():
+                self.conn.search(BASE_DN, SEARCH_FILTER.format(username), attributes=USER_RECORD_ATTRIBUTES)
+                return True, self._remember(AdUserRecord.from_entry(self.conn.entries[0]))
         except IndexError:
-            return False, "在查询用户是否在域中, 未检索到任何信息, 请与联系IT部门处理!"
+            logger.error("AdOps Exception: Connect.search未能检索到任何信息, 当前账号可能被排除在<SEARCH_FILTER>之外, 请联系管理员处理")
+            logger.error("self.conn.search({}, {}, attributes={})".format(BASE_DN, SEARCH_FILTER.format(username),
+                                                                       USER_RECORD_ATTRIBUTES))
+            return False, "在查询用户信息时, 未检索到任何信息, 请与联系IT部门处理!"
+        except DirectoryUnavailableError:
+            raise
         except Exception as e:
+            logger.error("AdOps Exception: {}".format(e))
             return False, "😱非预期错误: {}".format(e)
         
     # 新增函数, 用于企微邮箱转AD域用户名称  
@@ -153,20 +378,64 @@ class AdOps(object):
         """
         通过用户的的企业微信邮箱得到用户AD域中的sAMAccountName属性(域账号)
         :param email: 用户企微邮箱的地址
-        :return: tuple(bool, str or None) 
+        :return: tuple(bool, str or None) AD中没有该邮箱时返回 (True, None)
         """
         try:
             # 如果传进来的不是邮箱, 就不转换
             if "@" in email:
-                self.__conn()
-                self.conn.search(BASE_DN, "(mail=" + email + ")", attributes=['sAMAccountName'])
-                return True, self.conn.entries[0]['sAMAccountName']
+                record = get_snapshot().lookup_mail(email)
+                if record is not None:
+                    return True, record.sAMAccountName
+                with self.__connection():
+                    self.conn.search(BASE_DN, "(mail=" + email + ")", attributes=USER_RECORD_ATTRIBUTES)
+                    return True, self._remember(AdUserRecord.from_entry(self.conn.entries[0])).sAMAccountName
             else:
                 return True, email
-        except Exception as e:  
+        except IndexError:
+            return True, None
+        except DirectoryUnavailableError:
+            raise
+        except Exception as e:
             logger.error("self.conn.search(BASE_DN, {}, attributes=['sAMAccountName'])".format(SEARCH_FILTER.format(email)))
             return False, "😱非预期错误: {}".format(e)
         
+    def ad_get_directory_usn(self):
+        """
+        读取当前连接的域控的 dsServiceName 与 highestCommittedUSN, 用于增量同步
+        uSNChanged只在同一台域控上有意义, 请配合 pinned() 使用
+        :return: (dsServiceName, highestCommittedUSN)
+        """
+        try:
+            with self.__connection():
+                # 根DSE的属性不在schema中, 直接指定属性名会被ldap3的check_names拒绝, 所以读取全部属性
+                self.conn.search('', '(objectClass=*)', search_scope=BASE, attributes=ALL_ATTRIBUTES)
+                raw = {attr.lower(): values for attr, values in self.conn.entries[0].entry_raw_attributes.items()}
+                return True, (_raw_text(raw, 'dsServiceName'), _raw_int(raw, 'highestCommittedUSN'))
+        except DirectoryUnavailableError:
+            raise
+        except Exception as e:
+            logger.error("AdOps Exception: {}".format(e))
+            return False, "😱非预期错误: {}".format(e)
+
+    def ad_iter_users(self, search_filter=None, attributes=None, paged_size=None, search_base=None):
+        """
+        分页查询BASE_DN下的用户, 以生成器的方式逐条返回, 不会把全部结果放进conn.entries
+        生成器没有迭代完之前, 占用的连接不会归还连接池
+        :param search_filter: 默认是SEARCH_FILTER匹配的全部账号
+        :param attributes: 默认是USER_RECORD_ATTRIBUTES
+        :param paged_size: 每页条数, 默认LDAP_PAGED_SIZE
+        :param search_base: 查询的DN路径, 例如某个OU, 默认BASE_DN
+        :return: AdUserRecord 生成器
+        """
+        search_filter = search_filter or SEARCH_FILTER.format('*')
+        with self.__connection():
+            for item in self.conn.extend.standard.paged_search(search_base or BASE_DN, search_filter,
+                                                               attributes=attributes or USER_RECORD_ATTRIBUTES,
+                                                               paged_size=paged_size or settings.LDAP_PAGED_SIZE,
+                                                               generator=True):
+                if item.get('type') == 'searchResEntry':
+                    yield AdUserRecord.from_raw(item['dn'], item['raw_attributes'])
+
     @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
     def ad_get_user_dn_by_account(self, username):
         """
@@ -174,18 +443,10 @@ class AdOps(object):
         :param username:
         :return: DN
         """
-        try:
-            self.__conn()
-            self.conn.search(BASE_DN, SEARCH_FILTER.format(username),
-                             attributes=['distinguishedName'])
-            return True, str(self.conn.entries[0]['distinguishedName'])
-        except IndexError:
-            logger.error("AdOps Exception: Connect.search未能检索到任何信息, 当前账号可能被排除在<SEARCH_FILTER>之外, 请联系管理员处理2")
-            logger.error("self.conn.search(BASE_DN, {}, attributes=['distinguishedName'])".format(SEARCH_FILTER.format(username)))
-            return False, "在查询用户完整DN时, 未检索到任何信息, 请与联系IT部门处理!"
-        except Exception as e:
-            logger.error("AdOps Exception: {}".format(e))
-            return False, "😱非预期错误: {}".format(e)
+        _status, record = self.ad_get_user_record_by_account(username)
+        if not _status:
+            return False, record
+        return True, record.dn
 
     @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
     def ad_get_user_status_by_account(self, username):
@@ -194,37 +455,48 @@ class AdOps(object):
         :param username:
         :return: user_account_control code
         """
+        _status, record = self.ad_get_user_record_by_account(username)
+        if not _status:
+            return False, record
+        return True, record.userAccountControl
+
+    @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
+    def ad_unlock_user_by_account(self, username):
+        """
+        通过username解锁某个用户
+        :param username:
+        :return:
+        """
         try:
-            self.__conn()
-            self.conn.search(BASE_DN, SEARCH_FILTER.format(username), attributes=['userAccountControl'])
-            return True, self.conn.entries[0]['userAccountControl']
+            with self.__connection():
+                _status, record = self.ad_get_user_record_by_account(username)
+                if not _status:
+                    return False, record
+                result = self.conn.extend.microsoft.unlock_account(user='%s' % record.dn)
+                self._remember(record._replace(lockoutTime=0))
+                return True, result
         except IndexError:
-            logger.error("AdOps Exception: Connect.search未能检索到任何信息, 当前账号可能被排除在<SEARCH_FILTER>之外, 请联系管理员处理4")
-            logger.error("self.conn.search({}, {}, attributes=['userAccountControl'])".format(BASE_DN, SEARCH_FILTER.format(username)))
-            logger.info("self.conn.entries -- {}".format(self.conn.entries))
-            return False, "在查询用户账号状态时, 未检索到任何信息, 请与联系IT部门处理!"
+            return False, "在解锁用户时, 未检索到任何信息, 请与联系IT部门处理!"
+        except DirectoryUnavailableError:
+            raise
         except Exception as e:
             logger.error("AdOps Exception: {}".format(e))
             return False, "😱非预期错误: {}".format(e)
 
-    @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
-    def ad_unlock_user_by_account(self, username):
+    def ad_unlock_user_by_dn(self, user_dn):
         """
-        通过username解锁某个用户
-        :param username:
+        通过完整DN解锁某个用户, 批量解锁时DN己经从分页查询中拿到, 不需要再查询一次
+        :param user_dn:
         :return:
         """
-        _status, user_dn = self.ad_get_user_dn_by_account(username)
-        if _status:
-            try:
+        try:
+            with self.__connection():
                 return True, self.conn.extend.microsoft.unlock_account(user='%s' % user_dn)
-            except IndexError:
-                return False, "在解锁用户时, 未检索到任何信息, 请与联系IT部门处理!"
-            except Exception as e:
-                logger.error("AdOps Exception: {}".format(e))
-                return False, "😱非预期错误: {}".format(e)
-        else:
-            return False, user_dn
+        except DirectoryUnavailableError:
+            raise
+        except Exception as e:
+            logger.error("AdOps Exception: {}".format(e))
+            return False, "😱非预期错误: {}".format(e)
 
     @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
     def ad_reset_user_pwd_by_account(self, username, new_password):
@@ -233,55 +505,49 @@ class AdOps(object):
         :param username:
         :return:
         """
-        _status, user_dn = self.ad_get_user_dn_by_account(username)
-        if _status:
-            if self.conn.check_names:
-                user_dn = safe_dn(user_dn)
-            encoded_new_password = ('"%s"' % new_password).encode('utf-16-le')
-            result = self.conn.modify(user_dn,
-                                      {'unicodePwd': [(MODIFY_REPLACE, [encoded_new_password])]},
-                                      )
-            if not self.conn.strategy.sync:
-                _, result = self.conn.get_response(result)
-            else:
-                if self.conn.strategy.thread_safe:
-                    _, result, _, _ = result
+        with self.__connection():
+            _status, user_dn = self.ad_get_user_dn_by_account(username)
+            if _status:
+                if self.conn.check_names:
+                    user_dn = safe_dn(user_dn)
+                encoded_new_password = ('"%s"' % new_password).encode('utf-16-le')
+                result = self.conn.modify(user_dn,
+                                          {'unicodePwd': [(MODIFY_REPLACE, [encoded_new_password])]},
+                                          )
+                if not self.conn.strategy.sync:
+                    _, result = self.conn.get_response(result)
                 else:
-                    result = self.conn.result
-
-            # change successful, returns True
-            if result['result'] == RESULT_SUCCESS:
-                return True, '🎉密码己修改成功, 请妥善保管, 喵~'
-
-            # change was not successful, raises exception if raise_exception = True in connection or returns the operation result, error code is in result['result']
-            if self.conn.raise_exceptions:
-                from ldap3.core.exceptions import LDAPOperationResult
-                _msg = LDAPOperationResult(result=result['result'], description=result['description'], dn=result['dn'],
-                                           message=result['message'],
-                                           response_type=result['type'])
-                return False, _msg
-            return False, result['result']
-        else:
-            return False, user_dn
+                    if self.conn.strategy.thread_safe:
+                        _, result, _, _ = result
+                    else:
+                        result = self.conn.result
+
+                # change successful, returns True
+                if result['result'] == RESULT_SUCCESS:
+                    return True, '🎉密码己修改成功, 请妥善保管, 喵~'
+
+                # change was not successful, raises exception if raise_exception = True in connection or returns the operation result, error code is in result['result']
+                if self.conn.raise_exceptions:
+                    from ldap3.core.exceptions import LDAPOperationResult
+                    _msg = LDAPOperationResult(result=result['result'], description=result['description'], dn=result['dn'],
+                                               message=result['message'],
+                                               response_type=result['type'])
+                    return False, _msg
+                return False, result['result']
+            else:
+                return False, user_dn
 
     @decorator_logger(logger, log_head='AdOps', pretty=True, indent=2, verbose=1)
     def ad_get_user_locked_status_by_account(self, username):
         """
         通过username获取某个用户账号是否被锁定
         :param username:
-        :return: 如果结果是1601-01-01说明账号未锁定, 返回0
+        :return: 如果lockoutTime是0(1601-01-01)说明账号未锁定, 返回unlocked
         """
-        try:
-            self.__conn()
-            self.conn.search(BASE_DN, SEARCH_FILTER.format(username),
-                             attributes=['lockoutTime'])
-            locked_status = self.conn.entries[0]['lockoutTime']
-            if '1601-01-01' in str(locked_status):
-                return True, 'unlocked'
-            else:
-                return False, locked_status
-        except IndexError:
-            # return False, "AdOps Exception: Connect.search未能检索到任何信息, 当前账号可能被排除在<SEARCH_FILTER>之外, 请联系管理员处理7"
-            return False, "在检查用户账号是否被锁定时, 未检索到任何信息, 请与联系IT部门处理!"
-        except Exception as e:
-            return False, "😱非预期错误: {}".format(e)
+        _status, record = self.ad_get_user_record_by_account(username)
+        if not _status:
+            return False, record
+        if not record.locked:
+            return True, 'unlocked'
+        else:
+            return False, record.lockoutTime
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+AD(LDAP) 连接池
+
+每个uWSGI worker进程内的AdOps实例共享同一个连接池, 避免每次请求都重新做一次 TLS + NTLM 握手
+    * 连接池有上限, 超过上限时在 LDAP_POOL_CHECKOUT_TIMEOUT 内排队等待
+    * 空闲超过 LDAP_POOL_CHECK_INTERVAL 的连接取出前先做一次 whoami 健康检查, 失败则丢弃重建
+    * 空闲超过 LDAP_POOL_MAX_IDLE 的连接直接回收重建, 防止被域控或防火墙静默断开
+    * 记录取连接的排队等待时间, 可通过 stats() 查看
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPPoolTimeoutError(LDAPException):
+    pass
+
+
+class _PooledConnection(object):
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class LdapConnectionPool(object):
+
+    def __init__(self, name, connection_factory, size=None, checkout_timeout=None, max_idle=None,
+                 check_interval=None):
+        """
+        :param name: 连接池名称, 仅用于日志
+        :param connection_factory: 无参函数, 返回一个己绑定的 ldap3 Connection
+        :param size: 最大连接数
+        :param checkout_timeout: 取连接的最长等待时间(秒)
+        :param max_idle: 空闲超过该时间(秒)的连接会被回收
+        :param check_interval: 空闲超过该时间(秒)的连接在取出时做健康检查
+        """
+        self.name = name
+        self.connection_factory = connection_factory
+        self.size = size or settings.LDAP_POOL_SIZE
+        self.checkout_timeout = checkout_timeout if checkout_timeout is not None \
+            else settings.LDAP_POOL_CHECKOUT_TIMEOUT
+        self.max_idle = max_idle if max_idle is not None else settings.LDAP_POOL_MAX_IDLE
+        self.check_interval = check_interval if check_interval is not None else settings.LDAP_POOL_CHECK_INTERVAL
+        self._idle = deque()
+        self._opened = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'health_check_failed': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+    def checkout(self, timeout=None):
+        """
+        从连接池中取出一个连接, 优先使用最近归还的(最"热"的)连接
+        :param timeout: 最长等待时间(秒), 默认 checkout_timeout
+        :return: ldap3 Connection
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._opened >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._record_wait(time.monotonic() - started)
+                        raise LDAPPoolTimeoutError(
+                            'LDAP连接池[{}]在{}秒内没有可用连接, 当前连接数: {}'.format(self.name, timeout, self._opened))
+                    self._cond.wait(remaining)
+                if self._idle:
+                    item = self._idle.pop()
+                else:
+                    item = None
+                    self._opened += 1
+
+            if item is None:
+                try:
+                    item = _PooledConnection(self.connection_factory())
+                except Exception:
+                    self._forget()
+                    raise
+                self._incr('created')
+            elif not self._usable(item):
+                continue
+
+            self._record_wait(time.monotonic() - started)
+            return item
+
+    def release(self, item, discard=False):
+        """
+        归还连接, 连接己断开或调用方要求丢弃时直接关闭
+        """
+        if discard or item.conn.closed:
+            self._incr('discarded')
+            self._close(item)
+            return
+        item.last_used = time.time()
+        with self._cond:
+            self._idle.append(item)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        item = self.checkout(timeout)
+        discard = False
+        try:
+            yield item.conn
+        except LDAPCommunicationError:
+            # socket层面的错误, 这个连接己不可信, 丢弃后下次重建并重新绑定
+            discard = True
+            raise
+        finally:
+            self.release(item, discard=discard)
+
+    def stats(self):
+        with self._cond, self._stats_lock:
+            stats = dict(self._stats, opened=self._opened, idle=len(self._idle), size=self.size)
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def close_all(self):
+        with self._cond:
+            items = list(self._idle)
+            self._idle.clear()
+        for item in items:
+            self._close(item)
+
+    def _usable(self, item):
+        idle = time.time() - item.last_used
+        if item.conn.closed or idle > self.max_idle:
+            self._incr('recycled')
+            self._close(item)
+            return False
+        if idle > self.check_interval:
+            try:
+                item.conn.extend.standard.who_am_i()
+            except Exception as e:
+                logger.warning("LDAP连接池[{}]健康检查失败, 丢弃连接: {}".format(self.name, e))
+                self._incr('health_check_failed')
+                self._close(item)
+                return False
+        return True
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _record_wait(self, waited):
+        with self._stats_lock:
+            self._stats['checkouts'] += 1
+            self._stats['wait_total'] += waited
+            if waited > self._stats['wait_max']:
+                self._stats['wait_max'] = waited
+        logger.debug("LDAP连接池[{}]取连接等待 {:.2f}ms".format(self.name, waited * 1000))
+
+    def _close(self, item):
+        try:
+            item.conn.unbind()
+        except Exception:
+            pass
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, connection_factory, **kwargs):
+    """
+    取得当前worker进程中key对应的连接池, 不存在时创建
+    fork之后子进程不能复用父进程的socket, 所以按pid隔离
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = LdapConnectionPool(key[0], connection_factory, **kwargs)
+            _pools[key] = pool
+        return pool
+
+
+def pools_stats():
+    with _pools_lock:
+        return {':'.join(str(k) for k in key): pool.stats() for key, pool in _pools.items()}
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+多域控选择
+
+LDAP_HOST 可以配置多个域控(用逗号分隔), 每个worker进程内:
+    * 每台域控只创建一个 ldap3 Server 对象, DSA/Schema 信息只在第一次绑定时读取一次,
+      配置了 LDAP_SCHEMA_CACHE_DIR 时还会写入文件, 之后新建的worker直接从文件加载
+    * 后台线程每 LDAP_DC_PROBE_INTERVAL 秒对所有域控做一次TCP探测, 按响应时间排序
+    * 新建连接时优先使用响应最快的域控, 连接失败的域控标记为不可用并自动切换到下一台
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from ldap3 import Server, Connection, ALL
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+
+logger = logging.getLogger(__name__)
+
+
+class DomainController(object):
+
+    def __init__(self, host, port, use_ssl):
+        self.host = host
+        self.port = port
+        self.server = Server(host=host, connect_timeout=settings.LDAP_DC_CONNECT_TIMEOUT, use_ssl=use_ssl, port=port,
+                             get_info=ALL)
+        # 指数加权平均的响应时间(秒), None表示还没有测量过
+        self.latency = None
+        self.down_until = 0
+
+    @property
+    def available(self):
+        return time.time() >= self.down_until
+
+    def observe(self, elapsed):
+        self.latency = elapsed if self.latency is None else self.latency * 0.7 + elapsed * 0.3
+        self.down_until = 0
+
+    def mark_up(self):
+        self.down_until = 0
+
+    def mark_down(self):
+        self.down_until = time.time() + settings.LDAP_DC_DOWN_TIME
+
+    def sort_key(self):
+        return (not self.available, self.latency if self.latency is not None else float('inf'))
+
+    def probe(self):
+        started = time.monotonic()
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=settings.LDAP_DC_CONNECT_TIMEOUT)
+            sock.close()
+        except (OSError, socket.timeout) as e:
+            if self.available:
+                logger.warning("域控[{}:{}]探测失败, 暂时停用: {}".format(self.host, self.port, e))
+            self.mark_down()
+            return
+        self.observe(time.monotonic() - started)
+
+    def _info_file(self, kind):
+        return os.path.join(settings.LDAP_SCHEMA_CACHE_DIR, '{}_{}.{}.json'.format(self.host, self.port, kind))
+
+    def load_info(self):
+        """
+        从缓存文件加载DSA/Schema信息, 加载成功后绑定时不再读取
+        """
+        if not settings.LDAP_SCHEMA_CACHE_DIR:
+            return
+        try:
+            if os.path.isfile(self._info_file('schema')) and os.path.isfile(self._info_file('dsa')):
+                schema = SchemaInfo.from_file(self._info_file('schema'))
+                self.server.attach_schema_info(schema)
+                self.server.attach_dsa_info(DsaInfo.from_file(self._info_file('dsa'), schema))
+        except Exception as e:
+            logger.warning("加载域控[{}]的Schema缓存失败, 将从服务器读取: {}".format(self.host, e))
+
+    def save_info(self):
+        if not settings.LDAP_SCHEMA_CACHE_DIR or self.server.info is None or self.server.schema is None:
+            return
+        try:
+            os.makedirs(settings.LDAP_SCHEMA_CACHE_DIR, exist_ok=True)
+            self.server.schema.to_file(self._info_file('schema'))
+            self.server.info.to_file(self._info_file('dsa'))
+        except Exception as e:
+            logger.warning("写入域控[{}]的Schema缓存失败: {}".format(self.host, e))
+
+
+class DomainControllerSelector(object):
+    connection_class = Connection
+
+    def __init__(self, hosts, port, use_ssl):
+        self.controllers = [DomainController(host, port, use_ssl) for host in hosts]
+        for dc in self.controllers:
+            dc.load_info()
+        self._prober = None
+        self._lock = threading.Lock()
+
+    def ordered(self):
+        """
+        按可用性和响应时间排序的域控列表, 不可用的域控排在最后作为兜底
+        """
+        self._ensure_prober()
+        return sorted(self.controllers, key=DomainController.sort_key)
+
+    def server(self):
+        return self.ordered()[0].server
+
+    def connect(self, make_connection, bind=True):
+        """
+        依次尝试各个域控直到连接成功
+        :param make_connection: 参数为ldap3 Server, 返回未绑定的 Connection
+        :param bind: 是否立即绑定, 为False时只建立连接(例如验证用户密码的连接, 之后再以用户身份绑定)
+        :return: Connection
+        """
+        last_error = None
+        for dc in self.ordered():
+            try:
+                conn = make_connection(dc.server)
+                conn.open(read_server_info=False)
+                if bind:
+                    need_info = dc.server.info is None
+                    conn.bind(read_server_info=need_info)
+                    if need_info:
+                        dc.save_info()
+            except LDAPCommunicationError as e:
+                logger.warning("连接域控[{}]失败, 尝试下一台: {}".format(dc.host, e))
+                dc.mark_down()
+                last_error = e
+                continue
+            dc.mark_up()
+            return conn
+        if last_error is None:
+            # LDAP_HOST 为空或只有空白, 调用方按连接失败处理(DirectoryUnavailableError)
+            raise LDAPCommunicationError('没有可用的域控, 请检查 LDAP_HOST 配置')
+        raise last_error
+
+    def _ensure_prober(self):
+        if len(self.controllers) < 2 or (self._prober is not None and self._prober.is_alive()):
+            return
+        with self._lock:
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(target=self._probe_loop, name='ldap-dc-prober', daemon=True)
+                self._prober.start()
+
+    def _probe_loop(self):
+        while True:
+            for dc in self.controllers:
+                dc.probe()
+            time.sleep(settings.LDAP_DC_PROBE_INTERVAL)
+
+
+def parse_hosts(hosts):
+    return [host.strip() for host in hosts.replace(';', ',').split(',') if host.strip()]
+
+
+_selectors = {}
+_selectors_pid = None
+_selectors_lock = threading.Lock()
+
+
+def get_selector(hosts, port, use_ssl):
+    """
+    取得当前worker进程的域控选择器, fork之后按pid重新创建
+    settings.LDAP_MOCK 为True时返回本地模拟AD的选择器
+    """
+    global _selectors_pid
+    if settings.LDAP_MOCK:
+        from utils.ad_mock import get_mock_selector
+        return get_mock_selector()
+    key = (hosts, port, use_ssl)
+    with _selectors_lock:
+        if _selectors_pid != os.getpid():
+            _selectors.clear()
+            _selectors_pid = os.getpid()
+        selector = _selectors.get(key)
+        if selector is None:
+            selector = DomainControllerSelector(parse_hosts(hosts), port, use_ssl)
+            _selectors[key] = selector
+        return selector
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+本地目录快照
+
+开启 AD_SNAPSHOT_ENABLED 后, 每个worker进程在后台线程里:
+    * 启动时分页查询一次 SEARCH_FILTER 匹配的全部账号, 建立 sAMAccountName / mail 的内存索引
+    * 之后每 AD_SNAPSHOT_SYNC_INTERVAL 秒按 uSNChanged 增量同步一次
+    * uSNChanged 只在同一台域控上连续, 域控发生切换时做一次全量同步;
+      删除的账号或移出SEARCH_FILTER范围的账号增量同步查不到, 每 AD_SNAPSHOT_FULL_SYNC_INTERVAL 秒全量同步一次
+    * 同步到邮箱指向的账号变化时清除 邮箱 -> 域账号 的缓存(utils/format_username.py)
+
+AdOps 的只读查询优先使用快照, 修改密码、解锁等写操作仍然直接发到域控,
+并且在写操作之前应读取域控上的最新状态(ad_get_user_record_by_account(..., use_snapshot=False))
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+APP_ENV = os.getenv('APP_ENV')
+if APP_ENV == 'dev':
+    from conf.local_settings_dev import SEARCH_FILTER
+else:
+    from conf.local_settings import SEARCH_FILTER
+
+logger = logging.getLogger(__name__)
+
+
+class AdDirectorySnapshot(object):
+
+    def __init__(self):
+        self._by_account = {}
+        self._by_mail = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.ready = False
+        self.server_name = None
+        self.highest_usn = 0
+        self.last_full_sync = 0
+
+    def lookup_account(self, username):
+        """
+        :return: AdUserRecord, 快照未就绪或没有该账号时返回None
+        """
+        if not username:
+            return None
+        self._ensure_started()
+        return self._by_account.get(username.lower())
+
+    def lookup_mail(self, email):
+        if not email:
+            return None
+        self._ensure_started()
+        account = self._by_mail.get(email.lower())
+        return self._by_account.get(account) if account else None
+
+    def __len__(self):
+        return len(self._by_account)
+
+    def _changed_mails(self, by_mail):
+        """
+        :return: 与当前快照相比指向的账号变化了的邮箱, 第一次同步时为空
+        """
+        if not self.ready:
+            return []
+        old = self._by_mail
+        return [mail for mail in set(old) | set(by_mail) if old.get(mail) != by_mail.get(mail)]
+
+    def full_sync(self, ad_ops):
+        by_account, by_mail = {}, {}
+        with ad_ops.pinned():
+            _status, usn = ad_ops.ad_get_directory_usn()
+            if not _status:
+                raise RuntimeError(usn)
+            for record in ad_ops.ad_iter_users():
+                key = record.sAMAccountName.lower()
+                by_account[key] = record
+                if record.mail:
+                    by_mail[record.mail.lower()] = key
+        with self._lock:
+            changed_mails = self._changed_mails(by_mail)
+            self._by_account, self._by_mail = by_account, by_mail
+            self.server_name, self.highest_usn = usn
+            self.last_full_sync = time.time()
+            self.ready = True
+        _invalidate_mails(changed_mails)
+        logger.info("AD目录快照全量同步完成, 共{}个账号, 域控: {}, uSN: {}".format(
+            len(by_account), self.server_name, self.highest_usn))
+
+    def delta_sync(self, ad_ops):
+        with ad_ops.pinned():
+            _status, usn = ad_ops.ad_get_directory_usn()
+            if not _status:
+                raise RuntimeError(usn)
+            server_name, highest_usn = usn
+            if server_name != self.server_name:
+                logger.info("域控由[{}]切换到[{}], 重新全量同步AD目录快照".format(self.server_name, server_name))
+                return self.full_sync(ad_ops)
+            if highest_usn <= self.highest_usn:
+                return
+            search_filter = '(&{}(uSNChanged>={}))'.format(SEARCH_FILTER.format('*'), self.highest_usn + 1)
+            changed = list(ad_ops.ad_iter_users(search_filter=search_filter))
+        changed_mails = []
+        with self._lock:
+            for record in changed:
+                key = record.sAMAccountName.lower()
+                old = self._by_account.get(key)
+                if old is not None and old.mail and old.mail != record.mail:
+                    self._by_mail.pop(old.mail.lower(), None)
+                    changed_mails.append(old.mail)
+                self._by_account[key] = record
+                if record.mail and self._by_mail.get(record.mail.lower()) != key:
+                    self._by_mail[record.mail.lower()] = key
+                    changed_mails.append(record.mail)
+            self.highest_usn = highest_usn
+        _invalidate_mails(changed_mails)
+        if changed:
+            logger.info("AD目录快照增量同步 {} 个账号, uSN: {}".format(len(changed), highest_usn))
+
+    def sync_once(self):
+        from utils.ad_ops import AdOps
+        ad_ops = AdOps()
+        if not self.ready or time.time() - self.last_full_sync > settings.AD_SNAPSHOT_FULL_SYNC_INTERVAL:
+            self.full_sync(ad_ops)
+        else:
+            self.delta_sync(ad_ops)
+
+    def _ensure_started(self):
+        if not settings.AD_SNAPSHOT_ENABLED or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sync_loop, name='ad-snapshot', daemon=True)
+                self._thread.start()
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self.sync_once()
+            except Exception as e:
+                logger.error("AD目录快照同步失败, 读请求将直接查询域控: {}".format(e))
+            time.sleep(settings.AD_SNAPSHOT_SYNC_INTERVAL)
+
+
+def _invalidate_mails(mails):
+    """
+    邮箱指向的账号变化后清除 邮箱 -> 域账号 的缓存(utils.format_username), 失败时等缓存自然过期
+    """
+    if not mails:
+        return
+    from utils.format_username import invalidate_name_from_email
+    try:
+        invalidate_name_from_email(*mails)
+    except Exception as e:
+        logger.error("清除邮箱缓存失败: {}".format(e))
+
+
+_snapshot = None
+_snapshot_pid = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot():
+    """
+    当前worker进程的目录快照, fork之后按pid重新创建
+    """
+    global _snapshot, _snapshot_pid
+    if _snapshot is not None and _snapshot_pid == os.getpid():
+        return _snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot_pid != os.getpid():
+            _snapshot = AdDirectorySnapshot()
+            _snapshot_pid = os.getpid()
+        return _snapshot
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+本地模拟的企业微信、钉钉API服务, 用于开发调试和压测, 不需要连接 qyapi.weixin.qq.com / oapi.dingtalk.com
+
+把 settings 中的 WEWORK_API_BASE_URL、DINGTALK_API_BASE_URL 指向它即可(python manage.py mockapi):
+    * 企业微信: /cgi-bin/gettoken, /cgi-bin/auth/getuserinfo, /cgi-bin/auth/getuserdetail,
+      /cgi-bin/user/getuserinfo, /cgi-bin/user/get, /cgi-bin/department/list, /cgi-bin/user/list,
+      /cgi-bin/get_jsapi_ticket, /cgi-bin/ticket/get
+    * 钉钉: /gettoken, /user/getuserinfo, /user/get, /department/list, /user/list
+    * 生成 users 个成员(user00001 ...), 邮箱与模拟AD(utils/ad_mock.py)中的账号一致,
+      成员平均分布在 DEPARTMENTS 个部门中(部门ID 1 ~ DEPARTMENTS, 1为根部门)
+    * 临时授权码(code)格式为 "<userid>" 或 "<userid>.<任意字符>", 与真实接口一样只能使用一次, 重复使用返回40029
+    * access_token 有效期为 token_ttl 秒, 过期或未知的token返回42001
+    * latency 为每个请求的响应延迟(秒), errors 为按比例注入的错误, 例如 {'5xx': 0.01, '42001': 0.02, '40029': 0.01}
+
+    server = MockApiServer(('127.0.0.1', 8090), MockApiState(users=1000, latency=0.05))
+    server.serve_forever()
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from utils.ad_mock import MAIL_DOMAIN
+from utils.storage.kvstorage import random_string
+
+DEPARTMENTS = 10
+
+# 可以注入的错误
+INJECTABLE_ERRORS = ('5xx', '42001', '40029')
+
+ERRORS = {
+    40029: 'invalid code',
+    42001: 'access_token expired',
+    40014: 'invalid access_token',
+    60111: 'userid not found',
+    -1: 'system busy',
+}
+
+
+class MockApiState(object):
+
+    def __init__(self, users=1000, latency=0, errors=None, token_ttl=7200):
+        self.users = users
+        self.latency = latency
+        self.errors = dict(errors or {})
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.used_codes = set()
+        self.tickets = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def user_id(i):
+        return 'user{:05d}'.format(i)
+
+    def user(self, user_id):
+        """
+        :return: 成员信息, 不存在时返回None
+        """
+        if not user_id.startswith('user') or not user_id[4:].isdigit() or not 0 < int(user_id[4:]) <= self.users:
+            return None
+        i = int(user_id[4:])
+        return {
+            'userid': user_id,
+            'name': '测试用户{}'.format(i),
+            'email': '{}@{}'.format(user_id, MAIL_DOMAIN),
+            'biz_mail': '{}@{}'.format(user_id, MAIL_DOMAIN),
+            'department': [1 + i % DEPARTMENTS],
+            # 企业微信: 1己激活 2己禁用 4未激活 5退出企业; 钉钉: active
+            'status': 1,
+            'active': True,
+        }
+
+    def department_users(self, department_id):
+        return [self.user(self.user_id(i)) for i in range(1, self.users + 1) if 1 + i % DEPARTMENTS == department_id]
+
+    def count(self, path):
+        with self._lock:
+            self.stats[path] = self.stats.get(path, 0) + 1
+
+    def inject(self, name):
+        return random.random() < self.errors.get(name, 0)
+
+    def issue_token(self):
+        token = random_string(32)
+        with self._lock:
+            self.tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def token_valid(self, token):
+        with self._lock:
+            expires_at = self.tokens.get(token)
+        return expires_at is not None and time.time() < expires_at
+
+    def expire_tokens(self):
+        """
+        模拟上游提前让token失效
+        """
+        with self._lock:
+            self.tokens.clear()
+
+    def use_code(self, code):
+        """
+        :return: code对应的userid, code无效或己使用过时返回None
+        """
+        user_id = (code or '').split('.')[0]
+        with self._lock:
+            if not code or code in self.used_codes or self.user(user_id) is None:
+                return None
+            self.used_codes.add(code)
+        return user_id
+
+    def issue_ticket(self, user_id):
+        ticket = random_string(32)
+        with self._lock:
+            self.tickets[ticket] = user_id
+        return ticket
+
+    def ticket_user(self, ticket):
+        with self._lock:
+            return self.tickets.get(ticket)
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    # keep-alive, 与真实接口一样可以复用连接
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.state.count(url.path)
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if self.state.inject('5xx'):
+            self._send(503, b'Service Unavailable', 'text/plain')
+            return
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            data = {}
+        route = ROUTES.get((method, url.path))
+        if route is None:
+            self._send(404, b'Not Found', 'text/plain')
+            return
+        self._json(route(self, query, data))
+
+    def _send(self, status, content, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _json(self, result):
+        self._send(200, json.dumps(result, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    @staticmethod
+    def error(errcode):
+        return {'errcode': errcode, 'errmsg': ERRORS.get(errcode, 'error')}
+
+    def check_token(self, query):
+        """
+        :return: token无效时返回错误, 有效时返回None
+        """
+        if self.state.inject('42001') or not self.state.token_valid(query.get('access_token')):
+            return self.error(42001)
+        return None
+
+    def use_code(self, query):
+        if self.state.inject('40029'):
+            return None
+        return self.state.use_code(query.get('code'))
+
+    def gettoken(self, query, data):
+        return {'errcode': 0, 'errmsg': 'ok', 'access_token': self.state.issue_token(),
+                'expires_in': self.state.token_ttl}
+
+    def wework_jsapi_ticket(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        return {'errcode': 0, 'errmsg': 'ok', 'ticket': random_string(32), 'expires_in': self.state.token_ttl}
+
+    def wework_auth_getuserinfo(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        user_id = self.use_code(query)
+        if user_id is None:
+            return self.error(40029)
+        return {'errcode': 0, 'errmsg': 'ok', 'userid': user_id, 'user_ticket': self.state.issue_ticket(user_id),
+                'expires_in': 1800}
+
+    def wework_auth_getuserdetail(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        user = self.state.user(self.state.ticket_user(data.get('user_ticket')) or '')
+        if user is None:
+            return self.error(40029)
+        return dict(user, errcode=0, errmsg='ok')
+
+    def wework_user_getuserinfo(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        user_id = self.use_code(query)
+        if user_id is None:
+            return self.error(40029)
+        return {'errcode': 0, 'errmsg': 'ok', 'UserId': user_id}
+
+    def dingtalk_user_getuserinfo(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        user_id = self.use_code(query)
+        if user_id is None:
+            return self.error(40029)
+        return {'errcode': 0, 'errmsg': 'ok', 'userid': user_id, 'is_sys': False, 'sys_level': 0}
+
+    def user_get(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        user = self.state.user(query.get('userid') or '')
+        if user is None:
+            return self.error(60111)
+        return dict(user, errcode=0, errmsg='ok')
+
+    def wework_department_list(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        return {'errcode': 0, 'errmsg': 'ok', 'department': [
+            {'id': i, 'name': '部门{}'.format(i), 'parentid': 0 if i == 1 else 1} for i in range(1, DEPARTMENTS + 1)]}
+
+    def wework_user_list(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        return {'errcode': 0, 'errmsg': 'ok', 'userlist': self.state.department_users(int(query.get('department_id', 1)))}
+
+    def dingtalk_department_list(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        # 与钉钉一样不包含根部门本身
+        return {'errcode': 0, 'errmsg': 'ok', 'department': [
+            {'id': i, 'name': '部门{}'.format(i), 'parentid': 1} for i in range(2, DEPARTMENTS + 1)]}
+
+    def dingtalk_user_list(self, query, data):
+        error = self.check_token(query)
+        if error:
+            return error
+        users = self.state.department_users(int(query.get('department_id', 1)))
+        offset, size = int(query.get('offset', 0)), int(query.get('size', 100))
+        return {'errcode': 0, 'errmsg': 'ok', 'userlist': users[offset:offset + size],
+                'hasMore': offset + size < len(users)}
+
+
+# (method, path) -> handler方法
+ROUTES = {
+    ('GET', '/cgi-bin/gettoken'): MockApiHandler.gettoken,
+    ('GET', '/cgi-bin/auth/getuserinfo'): MockApiHandler.wework_auth_getuserinfo,
+    ('POST', '/cgi-bin/auth/getuserdetail'): MockApiHandler.wework_auth_getuserdetail,
+    ('GET', '/cgi-bin/user/getuserinfo'): MockApiHandler.wework_user_getuserinfo,
+    ('GET', '/cgi-bin/user/get'): MockApiHandler.user_get,
+    ('GET', '/cgi-bin/department/list'): MockApiHandler.wework_department_list,
+    ('GET', '/cgi-bin/user/list'): MockApiHandler.wework_user_list,
+    ('GET', '/cgi-bin/get_jsapi_ticket'): MockApiHandler.wework_jsapi_ticket,
+    ('GET', '/cgi-bin/ticket/get'): MockApiHandler.wework_jsapi_ticket,
+    ('GET', '/gettoken'): MockApiHandler.gettoken,
+    ('GET', '/user/getuserinfo'): MockApiHandler.dingtalk_user_getuserinfo,
+    ('GET', '/user/get'): MockApiHandler.user_get,
+    ('GET', '/department/list'): MockApiHandler.dingtalk_department_list,
+    ('GET', '/user/list'): MockApiHandler.dingtalk_user_list,
+}
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, state):
+        super().__init__(address, MockApiHandler)
+        self.state = state
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+def start_mock_api(state, host='127.0.0.1', port=0):
+    """
+    在后台线程中启动模拟服务, port为0时随机选择端口
+    :return: MockApiServer, 用 server.base_url 取得地址, server.shutdown() 停止
+    """
+    server = MockApiServer((host, port), state)
+    threading.Thread(target=server.serve_forever, name='mock-api', daemon=True).start()
+    return server
+
+
+def parse_errors(value):
+    """
+    '5xx=0.01,42001=0.02' -> {'5xx': 0.01, '42001': 0.02}
+    :raise ValueError: 格式错误或不支持的错误类型
+    """
+    errors = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition('=')
+        name = name.strip()
+        if name not in INJECTABLE_ERRORS:
+            raise ValueError('不支持的错误类型: {}, 可选: {}'.format(name, ', '.join(INJECTABLE_ERRORS)))
+        errors[name] = float(rate)
+    return errors
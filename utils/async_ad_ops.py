@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+AdOps 的异步版本, 供异步视图(resetpwd/views.py)使用, ASGI部署见 pwdselfservice/asgi.py
+
+ldap3的异步策略需要自己处理消息ID和响应, 和现有的连接池(utils/ad_pool.py)、域控切换都不兼容,
+所以这里用线程池执行同步的AdOps方法: 事件循环不会被域控的网络往返阻塞,
+线程池的大小与LDAP连接池一致(LDAP_POOL_SIZE), 不会出现线程在排队等连接的情况
+
+    ad_ops = AsyncAdOps(deadline=Deadline(settings.LDAP_REQUEST_DEADLINE))
+    _, record = await ad_ops.ad_get_user_record_by_account(username)
+    _, msg = await ad_ops.ad_reset_user_pwd_by_account(username, new_password)
+    # 由多次LDAP操作组成的同步流程整体放到线程池中执行
+    response = await ad_ops.run(ops_account, ad_ops.ops, request, ...)
+
+注意: 同一个AsyncAdOps实例内的方法请依次await, 不要并发调用(它们共用同一个AdOps和用户记录缓存)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from utils.ad_ops import AdOps
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    当前worker进程的LDAP线程池, fork之后按pid重新创建
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=settings.LDAP_POOL_SIZE, thread_name_prefix='ldap')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class AsyncAdOps(object):
+
+    def __init__(self, *args, **kwargs):
+        """
+        参数与AdOps相同
+        """
+        self.ops = AdOps(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在LDAP线程池中执行同步函数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def ad_verify_user(self, username, password):
+        return await self.run(self.ops.ad_verify_user, username, password)
+
+    async def ad_auth_user(self, username, password):
+        return await self.run(self.ops.ad_auth_user, username, password)
+
+    async def ad_ensure_user_by_account(self, username):
+        return await self.run(self.ops.ad_ensure_user_by_account, username)
+
+    async def ad_get_user_record_by_account(self, username, use_snapshot=True):
+        return await self.run(self.ops.ad_get_user_record_by_account, username, use_snapshot=use_snapshot)
+
+    async def ad_get_get_sAMAccountName_by_email(self, email):
+        return await self.run(self.ops.ad_get_get_sAMAccountName_by_email, email)
+
+    async def ad_get_user_dn_by_account(self, username):
+        return await self.run(self.ops.ad_get_user_dn_by_account, username)
+
+    async def ad_get_user_status_by_account(self, username):
+        return await self.run(self.ops.ad_get_user_status_by_account, username)
+
+    async def ad_get_user_locked_status_by_account(self, username):
+        return await self.run(self.ops.ad_get_user_locked_status_by_account, username)
+
+    async def ad_unlock_user_by_account(self, username):
+        return await self.run(self.ops.ad_unlock_user_by_account, username)
+
+    async def ad_reset_user_pwd_by_account(self, username, new_password):
+        return await self.run(self.ops.ad_reset_user_pwd_by_account, username, new_password)
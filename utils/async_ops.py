@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信/钉钉客户端的异步版本, 供异步视图(resetpwd/views.py)使用
+
+方法名和返回值与同步客户端(WeWorkOps/DingDingOps)相同, 每次调用在线程池中执行同步客户端的方法:
+    * 超时、重试与退避(utils/http_policy.py)、access_token的跨worker刷新(utils/storage/token.py)、
+      长连接池(utils/http_session.py)都与同步客户端共用, 不需要另外安装异步HTTP库
+    * 线程池的大小与HTTP连接池一致(HTTP_POOL_MAXSIZE), 线程不会在排队等连接
+    * 等待上游响应时不占用事件循环, 一个进程可以同时处理大量扫码回调
+
+    async_ops = get_provider().async_ops
+    _status, user_id, user_info = await async_ops.get_user_detail(code, home_url)
+    # 由多次调用和缓存读写组成的同步流程整体放到线程池中执行
+    _status, result = await async_ops.run(resolve_code, async_ops.ops, home_url, code)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    当前worker进程调用企业微信/钉钉API的线程池, fork之后按pid重新创建
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=settings.HTTP_POOL_MAXSIZE, thread_name_prefix='api')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class AsyncOps(object):
+
+    def __init__(self, ops):
+        """
+        :param ops: 同步客户端, 例如 WeWorkOps
+        """
+        self.ops = ops
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在API线程池中执行同步函数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def get_user_detail(self, code, home_url, directory=None):
+        return await self.run(self.ops.get_user_detail, code, home_url, directory=directory)
+
+    async def access_token(self):
+        return await self.run(self.ops.access_token)
+
+
+class AsyncWeWorkOps(AsyncOps):
+
+    async def get_user_ticket_by_code_with_oauth2(self, code):
+        return await self.run(self.ops.get_user_ticket_by_code_with_oauth2, code)
+
+    async def get_user_info_by_ticket_with_oauth2(self, user_ticket):
+        return await self.run(self.ops.get_user_info_by_ticket_with_oauth2, user_ticket)
+
+    async def jsapi_signature(self, url):
+        return await self.run(self.ops.jsapi_signature, url)
+
+
+class AsyncDingDingOps(AsyncOps):
+
+    async def get_user_id_by_code(self, code):
+        return await self.run(self.ops.get_user_id_by_code, code)
+
+    async def get_user_detail_by_user_id(self, user_id):
+        return await self.run(self.ops.get_user_detail_by_user_id, user_id)
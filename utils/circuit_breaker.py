@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+熔断器与请求时间预算
+
+CircuitBreaker:
+    * closed: 正常放行, 连续失败 failure_threshold 次后进入 open
+    * open: 直接拒绝(抛出 CircuitOpenError), 不再等待超时, recovery_time 秒后进入 half-open
+    * half-open: 只放行一个探测请求, 成功则恢复 closed, 失败则重新 open
+      探测请求超过 recovery_time 仍没有结果时(例如调用方没有记录结果), 允许下一个请求重新探测
+
+Deadline: 一次请求内所有外部调用共用的时间预算, 每次调用的超时不超过剩余时间
+
+    breaker = get_breaker('ldap:dc1')
+    deadline = Deadline(15)
+    breaker.allow()
+    conn.socket.settimeout(deadline.timeout(10))
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+
+    def __init__(self, seconds):
+        """
+        :param seconds: 时间预算(秒), None表示不限制
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    @property
+    def remaining(self):
+        """
+        剩余时间(秒), 不限制时为None
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired:
+            raise DeadlineExceeded('请求己超过{}秒的时间预算'.format(self.seconds))
+
+    def timeout(self, default=None):
+        """
+        本次调用可用的超时时间: 剩余时间与default中较小的一个
+        :raise DeadlineExceeded: 预算己用完
+        """
+        self.check()
+        remaining = self.remaining
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_threshold, recovery_time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_started = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        请求前调用, 熔断时抛出 CircuitOpenError
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.recovery_time:
+                    raise CircuitOpenError('[{}]己熔断, {:.0f}秒后重试'.format(
+                        self.name, self.recovery_time - (now - self.opened_at)))
+                self.state = HALF_OPEN
+                self.probe_started = now
+                logger.info("[{}]熔断恢复探测".format(self.name))
+                return
+            # half-open: 同一时间只放行一个探测请求
+            if now - self.probe_started < self.recovery_time:
+                raise CircuitOpenError('[{}]正在恢复探测, 请稍后重试'.format(self.name))
+            self.probe_started = now
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("[{}]熔断恢复".format(self.name))
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.error("[{}]连续失败{}次, 熔断{}秒".format(self.name, self.failures, self.recovery_time))
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
+
+
+_breakers = {}
+_breakers_pid = None
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, failure_threshold, recovery_time):
+    """
+    取得当前worker进程中name对应的熔断器, 不存在时创建, fork之后按pid重新创建
+    """
+    global _breakers_pid
+    with _breakers_lock:
+        if _breakers_pid != os.getpid():
+            _breakers.clear()
+            _breakers_pid = os.getpid()
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, failure_threshold, recovery_time)
+            _breakers[name] = breaker
+        return breaker
+
+
+def breakers_stats():
+    with _breakers_lock:
+        return {name: breaker.stats() for name, breaker in _breakers.items()}
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+from django.conf import settings
 from dingtalk.client import AppKeyClient
 from pwdselfservice import cache_storage
+from utils.http_policy import PolicySession
+from utils.org_directory import indexed_user_usable
+from utils.http_session import get_session
 
 import os
 
@@ -25,6 +29,14 @@ class DingDingOps(AppKeyClient):
         self.mo_app_id = mo_app_id
         self.mo_app_secret = mo_app_secret
         self.storage = storage
+        self.API_BASE_URL = settings.DINGTALK_API_BASE_URL
+
+    @property
+    def _http(self):
+        """
+        SDK默认所有实例共用一个没有超时的Session, 这里换成当前worker进程的长连接池, 并按接口应用超时与重试策略
+        """
+        return PolicySession(get_session('dingtalk'))
 
     def get_user_id_by_code(self, code):
         """
@@ -52,9 +64,30 @@ class DingDingOps(AppKeyClient):
         except (KeyError, IndexError) as k_error:
             return False, 'get_user_detail_by_user_id: %s' % str(k_error)
 
-    def get_user_detail(self, code, home_url):
+    def iter_directory_users(self):
+        """
+        逐个部门分页读取通讯录成员, 同一个成员在多个部门时只返回一次
+        :return: 成员详情生成器
+        :raise DingTalkClientException: 上游返回错误
+        """
+        department_ids = [1] + [department['id'] for department in self.department.list(fetch_child=True)]
+        seen = set()
+        for department_id in department_ids:
+            offset = 0
+            while True:
+                result = self.user.list(department_id, offset=offset, size=100)
+                for user in result.get('userlist', []):
+                    if user.get('userid') not in seen:
+                        seen.add(user.get('userid'))
+                        yield user
+                if not result.get('hasMore'):
+                    break
+                offset += 100
+
+    def get_user_detail(self, code, home_url, directory=None):
         """
         临时授权码换取userinfo
+        :param directory: func(user_id), 从本地通讯录索引(utils/org_directory.py)中查找成员, 找到时不再请求成员详情
         """
         _status, user_id = self.get_user_id_by_code(code)
         # 判断 user_id 在本企业钉钉/微信中是否存在
@@ -66,6 +99,9 @@ class DingDingOps(AppKeyClient):
                 'button_display': "返回主页"
             }
             return False, context, user_id
+        user_info = directory(user_id) if directory else None
+        if indexed_user_usable(user_info):
+            return True, user_id, user_info
         detail_status, user_info = self.get_user_detail_by_user_id(user_id)
         if not detail_status:
             context = {
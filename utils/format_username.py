@@ -11,7 +11,15 @@
 # @Author:         邢传真
 # @Mail:           chuanzhen.xing@oebiotech.com
 import re
-from utils.ad_ops import AdOps
+from django.conf import settings
+from pwdselfservice import cache_storage
+from utils.ad_ops import AdOps, DirectoryUnavailableError
+from utils.storage.cache import AdCache
+
+# 邮箱 -> 域账号 的映射几乎不会变化, 缓存起来避免每次扫码、登录都查询一次域控
+ad_cache = AdCache(cache_storage, 'ad')
+# AD中不存在的邮箱也缓存一小段时间(空字符串), 防止反复查询
+_NOT_FOUND = ''
 
 
 def get_email_from_userinfo(user_info):
@@ -30,16 +38,61 @@ def get_email_from_userinfo(user_info):
 def get_name_from_email(ad_ops, account):
     """
     查询用户的域账号名称, 如 chuanzhen.xing,
+    查询结果缓存AD_EMAIL_CACHE_TTL秒, 查不到的邮箱缓存AD_EMAIL_NEGATIVE_CACHE_TTL秒
     :param accout: 用户企微邮箱
     :return : 域用户名称
     """
     if account is None:
         return False, NameError(
             "🥹传入的用户账号为空!".format(account))
+    if "@" not in account:
+        return True, account
+    cache_key = account.lower()
+    cached = ad_cache.account_by_email.get(cache_key)
+    if cached == _NOT_FOUND:
+        return False, NameError("🥹AD中未找到邮箱[{}]对应的域账号, 请联系IT部门处理!".format(account))
+    if cached is not None:
+        return True, cached
     try:
-        return True, ad_ops.ad_get_get_sAMAccountName_by_email(account)[1]
+        _status, username = ad_ops.ad_get_get_sAMAccountName_by_email(account)
+    except DirectoryUnavailableError:
+        raise
     except Exception as e:
         return False, NameError("🥹查询失败, 错误信息[{}]".format(e))
+    if not _status:
+        return False, NameError("🥹查询失败, 错误信息[{}]".format(username))
+    if username is None:
+        ad_cache.account_by_email.set(cache_key, _NOT_FOUND, ttl=settings.AD_EMAIL_NEGATIVE_CACHE_TTL)
+        return False, NameError("🥹AD中未找到邮箱[{}]对应的域账号, 请联系IT部门处理!".format(account))
+    ad_cache.account_by_email.set(cache_key, username, ttl=settings.AD_EMAIL_CACHE_TTL)
+    # 反向记录 域账号 -> 邮箱, 账号在AD中查不到时按账号清除缓存(invalidate_account)
+    account_key = username.lower()
+    emails = ad_cache.emails_by_account.get(account_key) or []
+    if cache_key not in emails:
+        emails = emails + [cache_key]
+    ad_cache.emails_by_account.set(account_key, emails, ttl=settings.AD_EMAIL_CACHE_TTL)
+    return True, username
+
+
+def invalidate_name_from_email(*emails):
+    """
+    清除邮箱 -> 域账号的缓存, AD目录快照同步到邮箱变化时调用(utils/ad_snapshot.py)
+    :param emails: 一个或多个邮箱
+    """
+    keys = [email.lower() for email in emails if email]
+    if keys:
+        ad_cache.account_by_email.delete_many(keys)
+
+
+def invalidate_account(username):
+    """
+    清除指向这个域账号的邮箱缓存, 账号在AD中查不到(改名或删除)时调用(resetpwd.utils.ops_account)
+    """
+    if not username:
+        return
+    account_key = username.lower()
+    invalidate_name_from_email(*(ad_cache.emails_by_account.get(account_key) or []))
+    ad_cache.emails_by_account.delete(account_key)
 
 # 弃用函数
 def format2username(account):
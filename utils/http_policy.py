@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信、钉钉等上游API的超时与重试策略
+
+每个接口一个 CallPolicy, 默认值来自 settings 中的 HTTP_* 配置, 可以在 HTTP_POLICY_OVERRIDES 中按接口覆盖:
+    * 每次请求的连接超时/读取超时, 且不超过整个调用剩余的时间预算(deadline)
+    * 暂时性失败最多重试 retries 次, 第n次重试前随机等待 0 ~ min(backoff_max, backoff_base * 2**n) 秒,
+      剩余时间预算不够等待时不再重试
+    * 连接没有建立(连接超时、连接被拒绝)时请求没有发出, 总是可以重试
+    * 读取超时、连接中断、5xx/429、上游返回"系统繁忙"的错误码时请求可能己经被处理, 只有幂等的接口才重试,
+      GET默认幂等, POST默认不幂等, 可以用 idempotent 覆盖
+
+    policy = get_policy('USER_GET', 'GET')
+    response = policy.execute(lambda timeout: session.get(url, timeout=timeout))
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from urllib3.exceptions import NewConnectionError
+
+from utils.circuit_breaker import Deadline
+from utils.http_session import default_timeout
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# 可能是暂时性的网络错误
+TRANSIENT_ERRORS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError)
+CONNECT_ERRORS = (requests.exceptions.ConnectTimeout,)
+
+
+def _connect_failed(e):
+    """
+    请求是否在建立连接时就失败了(请求没有发出)
+    """
+    if isinstance(e, CONNECT_ERRORS):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', e.args[0]), NewConnectionError)
+    return False
+
+
+class CallPolicy(object):
+
+    def __init__(self, name, connect_timeout, read_timeout, retries, backoff_base, backoff_max, deadline,
+                 idempotent, retry_errcodes=()):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.idempotent = idempotent
+        self.retry_errcodes = tuple(retry_errcodes)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _transient_response(self, response):
+        """
+        :return: 需要重试的原因, 不需要重试时返回None
+        """
+        if response.status_code in RETRY_STATUS_CODES:
+            return 'HTTP {}'.format(response.status_code)
+        if self.retry_errcodes and response.status_code == 200:
+            try:
+                errcode = response.json().get('errcode')
+            except (ValueError, AttributeError):
+                return None
+            if errcode in self.retry_errcodes:
+                return 'errcode {}'.format(errcode)
+        return None
+
+    def execute(self, send):
+        """
+        :param send: func(timeout), 发出一次请求并返回 requests.Response, timeout 为 (连接超时, 读取超时)
+        :return: 最后一次请求的 Response, 不检查状态码
+        :raise requests.RequestException: 重试后仍然失败或者不可以重试
+        """
+        deadline = Deadline(self.deadline)
+        attempt = 0
+        while True:
+            try:
+                response = send(self._timeout(deadline))
+            except TRANSIENT_ERRORS as e:
+                delay = self._retry_delay(_connect_failed(e) or self.idempotent, attempt, deadline, e)
+                if delay is None:
+                    raise
+            else:
+                reason = self._transient_response(response)
+                delay = None if reason is None else self._retry_delay(self.idempotent, attempt, deadline, reason)
+                if delay is None:
+                    return response
+            time.sleep(delay)
+            attempt += 1
+
+    def _timeout(self, deadline):
+        return deadline.timeout(self.connect_timeout), deadline.timeout(self.read_timeout)
+
+    def _retry_delay(self, retryable, attempt, deadline, reason):
+        """
+        :return: 重试前需要等待的秒数, 不再重试时返回None
+        """
+        if not retryable or attempt >= self.retries:
+            return None
+        delay = self.backoff(attempt)
+        remaining = deadline.remaining
+        if remaining is not None and remaining <= delay:
+            return None
+        logger.warning("[{}]第{}次请求失败({}), {:.2f}秒后重试".format(self.name, attempt + 1, reason, delay))
+        return delay
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(name, method):
+    """
+    :param name: 接口名, 企业微信为 CORP_API_TYPE 中的键, 钉钉为请求路径(例如 /user/getuserinfo)
+    :param method: GET/POST, 决定默认是否幂等
+    """
+    key = (name, method)
+    policy = _policies.get(key)
+    if policy is not None:
+        return policy
+    connect_timeout, read_timeout = default_timeout()
+    conf = {
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'retries': settings.HTTP_RETRIES,
+        'backoff_base': settings.HTTP_BACKOFF_BASE,
+        'backoff_max': settings.HTTP_BACKOFF_MAX,
+        'deadline': settings.HTTP_CALL_DEADLINE,
+        'idempotent': method.upper() == 'GET',
+        'retry_errcodes': settings.HTTP_RETRY_ERRCODES,
+    }
+    conf.update(settings.HTTP_POLICY_OVERRIDES.get(name, {}))
+    policy = CallPolicy(name, **conf)
+    with _policies_lock:
+        return _policies.setdefault(key, policy)
+
+
+class PolicySession(object):
+    """
+    给第三方SDK(钉钉)使用的 Session, request() 按请求路径应用超时与重试策略
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, method, url, **kwargs):
+        # SDK传入的timeout默认为None, 由策略决定
+        kwargs.pop('timeout', None)
+        policy = get_policy(urlparse(url).path, method)
+        return policy.execute(lambda timeout: self.session.request(method, url, timeout=timeout, **kwargs))
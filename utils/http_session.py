@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP长连接池
+
+每个worker进程为每个上游(例如企业微信)维护一个 requests.Session:
+    * 同一个上游的请求复用 keep-alive 连接, 不再为每次调用重新做 DNS 解析、TCP 与 TLS 握手
+    * 连接池大小为 HTTP_POOL_MAXSIZE, 建议不小于uwsgi.ini中threads的数量
+    * 默认超时为 (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), 上游无响应时不会一直占用worker线程
+    * sessions_stats() 返回每个连接池的请求数、新建连接数和连接复用率
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+def default_timeout():
+    return settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT
+
+
+def new_session():
+    session = requests.Session()
+    # 重试由调用方控制, 连接池层面不重试
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_session(name):
+    """
+    取得当前worker进程中name对应的Session, fork之后子进程不能复用父进程的socket, 所以按pid重新创建
+    """
+    global _sessions_pid
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(name)
+        if session is None:
+            session = new_session()
+            _sessions[name] = session
+        return session
+
+
+def sessions_stats():
+    """
+    :return: {name: {host: {requests, connections, reuse_ratio, idle}}}
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for name, session in sessions:
+        hosts = {}
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts['{}://{}:{}'.format(pool.scheme, pool.host, pool.port)] = {
+                    'requests': pool.num_requests,
+                    'connections': pool.num_connections,
+                    'reuse_ratio': 1 - pool.num_connections / pool.num_requests if pool.num_requests else 0.0,
+                    # 队列中的None是还没有建立的连接槽位
+                    'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                }
+        stats[name] = hosts
+    return stats
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+本地通讯录索引
+
+定时从企业微信/钉钉读取全部成员(python manage.py orgsync, 建议用crontab每小时执行一次),
+在 cache_storage 中为每个成员保存一条 userid -> {userid, name, email, biz_mail, active, username} 的记录:
+    * email/biz_mail 与上游返回的一致, active 为成员是否在职且己激活
+    * username 为按邮箱在AD中找到的 sAMAccountName, 找不到时为None, 扫码时再按邮箱查询AD
+    * 记录的有效期为 ORG_DIRECTORY_TTL, 离职成员的记录在下一次同步之后自然过期
+
+开启 ORG_DIRECTORY_ENABLED 后, 扫码回调只需要用code换取userid, 成员详情和域账号直接使用索引中的记录,
+索引中没有的成员(例如刚入职还没有同步)、未激活或己禁用的成员、没有关联到域账号的成员
+(例如成员列表中没有返回邮箱)仍然按原来的方式请求成员详情并按邮箱查询AD
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from pwdselfservice import cache_storage
+from utils.storage.cache import OrgCache
+
+APP_ENV = os.getenv('APP_ENV')
+if APP_ENV == 'dev':
+    from conf.local_settings_dev import INTEGRATION_APP_TYPE
+else:
+    from conf.local_settings import INTEGRATION_APP_TYPE
+
+logger = logging.getLogger(__name__)
+
+# 同步时每批写入的成员数
+SYNC_BATCH_SIZE = 500
+
+
+def user_active(user):
+    """
+    企业微信的status: 1己激活 2己禁用 4未激活 5退出企业; 钉钉的成员列表只包含在职成员, 用active表示是否己激活
+    """
+    if 'status' in user:
+        return user.get('status') == 1
+    return bool(user.get('active', True))
+
+
+def indexed_user_usable(entry):
+    """
+    索引记录可以直接代替成员详情: 成员己激活且己关联到域账号
+    """
+    return bool(entry and entry.get('active') and entry.get('username'))
+
+
+class OrgDirectory(object):
+
+    def __init__(self, storage, prefix):
+        self.cache = OrgCache(storage, prefix)
+
+    def lookup(self, user_id):
+        """
+        :return: 成员记录, 没有同步过或者没有该成员时返回None
+        """
+        return self.cache.user.get(user_id)
+
+    def synced_at(self):
+        return self.cache.synced_at.get()
+
+    def sync(self, ops, ad_ops):
+        """
+        全量同步一次
+        :param ops: WeWorkOps 或 DingDingOps, 需要有 iter_directory_users()
+        :param ad_ops: AdOps, 一次分页查询建立 邮箱 -> 域账号 的映射
+        :return: {'users': 成员数, 'resolved': 找到域账号的成员数, 'inactive': 未激活或己禁用的成员数}
+        """
+        accounts = {}
+        for record in ad_ops.ad_iter_users():
+            if record.mail and record.sAMAccountName:
+                accounts[record.mail.lower()] = record.sAMAccountName
+        stats = {'users': 0, 'resolved': 0, 'inactive': 0}
+        batch = {}
+        for user in ops.iter_directory_users():
+            entry = self.entry(user, accounts)
+            batch[entry['userid']] = entry
+            if len(batch) >= SYNC_BATCH_SIZE:
+                self.cache.user.set_many(batch, ttl=settings.ORG_DIRECTORY_TTL)
+                batch = {}
+            stats['users'] += 1
+            stats['resolved'] += 1 if entry['username'] else 0
+            stats['inactive'] += 0 if entry['active'] else 1
+        if batch:
+            self.cache.user.set_many(batch, ttl=settings.ORG_DIRECTORY_TTL)
+        self.cache.synced_at.set(value=time.time(), ttl=settings.ORG_DIRECTORY_TTL)
+        logger.info("通讯录索引同步完成: {}".format(stats))
+        return stats
+
+    @staticmethod
+    def entry(user, accounts):
+        email, biz_mail = user.get('email') or None, user.get('biz_mail') or None
+        username = None
+        for mail in (email, biz_mail):
+            if mail and mail.lower() in accounts:
+                username = accounts[mail.lower()]
+                break
+        return {
+            'userid': user.get('userid'),
+            'name': user.get('name'),
+            'email': email,
+            'biz_mail': biz_mail,
+            'active': user_active(user),
+            'username': username,
+        }
+
+
+def get_org_directory():
+    return OrgDirectory(cache_storage, 'org:{}'.format(INTEGRATION_APP_TYPE.lower()))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+身份提供方(扫码认证的应用)注册表
+
+每个身份提供方只登记名称、显示名、客户端类的导入路径和页面需要的参数, 客户端模块(requests、dingtalk SDK等)
+在第一次使用时才导入, 每个worker进程只创建一次, 不会在worker启动时就加载全部的SDK:
+
+    provider = get_provider()            # local_settings 中 INTEGRATION_APP_TYPE 对应的身份提供方
+    provider.label                       # '企微'
+    provider.ops.get_user_detail(...)    # 第一次访问时导入并创建 WeWorkOps
+    await provider.async_ops.get_user_detail(...)   # 异步视图使用, 包装同一个 WeWorkOps
+
+新增身份提供方时调用 register(), 客户端类需要实现 get_user_detail(code, home_url, directory=None),
+async_ops_path 的类用同步客户端构造(见 utils/async_ops.py)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import importlib
+import os
+import threading
+
+APP_ENV = os.getenv('APP_ENV')
+if APP_ENV == 'dev':
+    from conf.local_settings_dev import INTEGRATION_APP_TYPE, DING_CORP_ID, DING_MO_APP_ID, WEWORK_CORP_ID, \
+        WEWORK_AGENT_ID
+else:
+    from conf.local_settings import INTEGRATION_APP_TYPE, DING_CORP_ID, DING_MO_APP_ID, WEWORK_CORP_ID, \
+        WEWORK_AGENT_ID
+
+
+class Provider(object):
+
+    def __init__(self, name, label, ops_path, corp_id=None, app_id=None, agent_id=None,
+                 async_ops_path='utils.async_ops.AsyncOps'):
+        """
+        :param name: INTEGRATION_APP_TYPE 中使用的名称, 例如 WEWORK
+        :param label: 页面上显示的名称
+        :param ops_path: 客户端类的导入路径, 例如 utils.wework_ops.WeWorkOps, 类用无参构造
+        :param async_ops_path: 异步客户端类的导入路径, 例如 utils.async_ops.AsyncWeWorkOps, 类用同步客户端构造
+        :param corp_id/app_id/agent_id: 扫码页面(auth.html)需要的参数
+        """
+        self.name = name
+        self.label = label
+        self.ops_path = ops_path
+        self.corp_id = corp_id
+        self.app_id = app_id
+        self.agent_id = agent_id
+        self.async_ops_path = async_ops_path
+        self._ops = None
+        self._async_ops = None
+        self._lock = threading.Lock()
+
+    @property
+    def ops(self):
+        if self._ops is None:
+            with self._lock:
+                if self._ops is None:
+                    module_name, class_name = self.ops_path.rsplit('.', 1)
+                    self._ops = getattr(importlib.import_module(module_name), class_name)()
+        return self._ops
+
+    @property
+    def async_ops(self):
+        if self._async_ops is None:
+            ops = self.ops
+            with self._lock:
+                if self._async_ops is None:
+                    module_name, class_name = self.async_ops_path.rsplit('.', 1)
+                    self._async_ops = getattr(importlib.import_module(module_name), class_name)(ops)
+        return self._async_ops
+
+
+# name -> 创建Provider的参数
+_registry = {}
+_providers = {}
+_providers_pid = None
+_providers_lock = threading.Lock()
+
+
+def register(name, label, ops_path, corp_id=None, app_id=None, agent_id=None,
+             async_ops_path='utils.async_ops.AsyncOps'):
+    _registry[name] = dict(name=name, label=label, ops_path=ops_path, corp_id=corp_id, app_id=app_id,
+                           agent_id=agent_id, async_ops_path=async_ops_path)
+
+
+def get_provider(name=None):
+    """
+    取得当前worker进程中name对应的身份提供方, fork之后按pid重新创建
+    :param name: 默认为 INTEGRATION_APP_TYPE
+    :raise KeyError: 没有注册
+    """
+    global _providers_pid
+    name = name or INTEGRATION_APP_TYPE
+    with _providers_lock:
+        if _providers_pid != os.getpid():
+            _providers.clear()
+            _providers_pid = os.getpid()
+        provider = _providers.get(name)
+        if provider is None:
+            if name not in _registry:
+                raise KeyError('未注册的身份提供方: {}, 可选: {}'.format(name, ', '.join(_registry)))
+            provider = Provider(**_registry[name])
+            _providers[name] = provider
+        return provider
+
+
+register('WEWORK', '企微', 'utils.wework_ops.WeWorkOps', app_id=WEWORK_CORP_ID, agent_id=WEWORK_AGENT_ID,
+         async_ops_path='utils.async_ops.AsyncWeWorkOps')
+register('DING', '钉钉', 'utils.dingding_ops.DingDingOps', corp_id=DING_CORP_ID, app_id=DING_MO_APP_ID,
+         async_ops_path='utils.async_ops.AsyncDingDingOps')
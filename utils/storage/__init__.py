@@ -13,6 +13,43 @@ class BaseStorage(object):
     def delete(self, key):
         raise NotImplementedError()
 
+    def add(self, key, value, ttl=None):
+        """
+        key不存在时才写入, 用于跨进程的互斥锁
+        :return: 是否写入成功
+        """
+        raise NotImplementedError()
+
+    def consume(self, key, expected):
+        """
+        值等于expected时删除key, 比较和删除是原子的, 用于一次性的凭证
+        :return: 是否匹配并删除成功
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """
+        批量读取, 子类可以用一次往返实现
+        :return: {key: value}, 只包含存在的key
+        """
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        """
+        批量写入, 所有key使用同一个有效期
+        """
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
     def __getitem__(self, key):
         self.get(key)
 
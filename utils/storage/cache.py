@@ -34,6 +34,22 @@ class CacheItem(object):
     def delete(self, key=None):
         return self.cache.storage.delete(self.key_name(key))
 
+    def consume(self, key=None, expected=None):
+        return self.cache.storage.consume(self.key_name(key), expected)
+
+    def get_many(self, keys):
+        """
+        :return: {key: value}, 只包含存在的key
+        """
+        names = {self.key_name(key): key for key in keys}
+        return {names[name]: value for name, value in self.cache.storage.get_many(list(names)).items()}
+
+    def set_many(self, mapping, ttl=None):
+        return self.cache.storage.set_many({self.key_name(key): value for key, value in mapping.items()}, ttl)
+
+    def delete_many(self, keys):
+        return self.cache.storage.delete_many([self.key_name(key) for key in keys])
+
 
 class BaseCache(object):
 
@@ -54,9 +70,27 @@ class BaseCache(object):
 
 class WeWorkCache(BaseCache):
     access_token = CacheItem()
+    jsapi_ticket = CacheItem()
+    agent_jsapi_ticket = CacheItem()
 
 
 class DingDingCache(BaseCache):
     access_token = CacheItem()
 
 
+class AdCache(BaseCache):
+    account_by_email = CacheItem()
+    emails_by_account = CacheItem()
+
+
+class OAuthCache(BaseCache):
+    user_by_code = CacheItem()
+
+
+class SessionCache(BaseCache):
+    otp = CacheItem()
+
+
+class OrgCache(BaseCache):
+    user = CacheItem()
+    synced_at = CacheItem()
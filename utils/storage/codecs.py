@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+KvStorage 的序列化方式
+
+    storage = KvStorage(redis_conn, codec=get_codec('orjson', compress_threshold=1024))
+
+    * json: 标准库json, 默认, 不加标记, 与旧版本写入的数据完全一致
+    * orjson / msgpack: 更快或更小, 需要另外安装 orjson / msgpack
+    * raw: 不序列化, 只能保存 str/bytes, 读出来是 str (不是utf-8时为bytes)
+    * 除json外, 写入的数据以两个字节的标记开头(\x00 + 一个字母, 见各 Codec.marker), json数据不可能以\x00开头
+    * compress_threshold: 序列化后超过这么多字节时用zlib压缩, None为不压缩; 压缩的数据以 COMPRESSED_MAGIC 开头,
+      解压后仍按标记解析; token、code等短数据不压缩
+    * 读取时按标记选择解析方式, 不按当前的方式试着解析(例如msgpack会把json写入的 b'5' 解析成53),
+      没有标记的按json解析; 所以切换序列化方式不需要清空Redis, 旧数据会随过期时间自然淘汰
+
+注意: cache_storage 直接使用Redis连接(get_redis_connection), settings.CACHES 中的 COMPRESSOR 对它不起作用
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MARKER_PREFIX = b'\x00'
+COMPRESSED_MAGIC = MARKER_PREFIX + b'z'
+
+
+class Codec(object):
+    name = None
+    # 写在数据开头的标记, 空为不加标记
+    marker = b''
+
+    def __init__(self, compress_threshold=None, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value):
+        """
+        :return: 写入Redis的bytes
+        """
+        data = self.marker + self.dumps(value)
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            return COMPRESSED_MAGIC + zlib.compress(data, self.compress_level)
+        return data
+
+    def decode(self, data):
+        """
+        :param data: 从Redis读取的bytes或str
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data.startswith(COMPRESSED_MAGIC):
+            data = zlib.decompress(data[len(COMPRESSED_MAGIC):])
+        marker = data[:len(COMPRESSED_MAGIC)] if data.startswith(MARKER_PREFIX) else b''
+        if marker == self.marker:
+            return self.loads(data[len(marker):])
+        # 切换序列化方式之前写入的数据
+        return _decoder(marker).loads(data[len(marker):])
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class OrjsonCodec(Codec):
+    name = 'orjson'
+    marker = MARKER_PREFIX + b'o'
+
+    def dumps(self, value):
+        return orjson.dumps(value)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    marker = MARKER_PREFIX + b'm'
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawCodec(Codec):
+    name = 'raw'
+    marker = MARKER_PREFIX + b'r'
+
+    def dumps(self, value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        raise TypeError('raw只能保存str或bytes, 不支持: {}'.format(type(value).__name__))
+
+    def loads(self, data):
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgpack': MsgpackCodec,
+    'raw': RawCodec,
+}
+
+
+def available_codecs():
+    """
+    :return: 当前环境中可以使用的序列化方式名称
+    """
+    missing = {'orjson': orjson is None, 'msgpack': msgpack is None}
+    return [name for name in CODECS if not missing.get(name)]
+
+
+def get_codec(name='json', compress_threshold=None):
+    """
+    :raise ValueError: 未知的序列化方式或者没有安装对应的库
+    """
+    if name not in CODECS:
+        raise ValueError('未知的序列化方式: {}, 可选: {}'.format(name, ', '.join(CODECS)))
+    if name not in available_codecs():
+        raise ValueError('序列化方式{}需要安装{}'.format(name, name))
+    return CODECS[name](compress_threshold=compress_threshold)
+
+
+_decoders = {}
+
+
+def _decoder(marker):
+    """
+    :return: 用于解析带这个标记的数据的Codec
+    :raise ValueError: 未知的标记或者没有安装对应的库
+    """
+    decoder = _decoders.get(marker)
+    if decoder is None:
+        names = [name for name, cls in CODECS.items() if cls.marker == marker]
+        if not names:
+            raise ValueError('未知的数据标记: {!r}'.format(marker))
+        decoder = _decoders[marker] = get_codec(names[0])
+    return decoder
@@ -1,13 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-import json
 import random
 import string
-import json
 import six
 
 from utils.storage import BaseStorage
+from utils.storage.codecs import JsonCodec
 
 
 def to_text(value, encoding='utf-8'):
@@ -52,13 +51,29 @@ def byte2int(c):
     return c
 
 
+# 值相等时删除, 一次往返完成比较和删除
+CONSUME_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
 class KvStorage(BaseStorage):
+    # 批量操作时每个pipeline/MGET最多包含的key数量, 避免单个命令过大阻塞Redis
+    batch_size = 500
 
-    def __init__(self, kvdb, prefix='client'):
+    def __init__(self, kvdb, prefix='client', codec=None):
+        """
+        :param codec: utils.storage.codecs 中的序列化方式, 默认为标准库json
+        """
         for method_name in ('get', 'set', 'delete'):
             assert hasattr(kvdb, method_name)
         self.kvdb = kvdb
         self.prefix = prefix
+        self.codec = codec or JsonCodec()
+        self._consume_script = None
 
     def key_name(self, key):
         return '{0}:{1}'.format(self.prefix, key)
@@ -68,15 +83,85 @@ class KvStorage(BaseStorage):
         value = self.kvdb.get(key)
         if value is None:
             return default
-        return json.loads(to_text(value))
+        return self.codec.decode(value)
+
+    def get_with_ttl(self, key, default=None):
+        """
+        一次往返同时取得值和剩余有效期
+        :return: (值, 剩余秒数), 不存在时为 (default, None), 没有过期时间时剩余秒数为 -1
+        """
+        key = self.key_name(key)
+        pipe = self.kvdb.pipeline()
+        pipe.get(key)
+        pipe.pttl(key)
+        value, pttl = pipe.execute()
+        if value is None:
+            return default, None
+        return self.codec.decode(value), pttl / 1000.0 if pttl >= 0 else -1
+
+    def consume(self, key, expected):
+        if expected is None:
+            return False
+        if self._consume_script is None:
+            # register_script 使用EVALSHA, 脚本不在Redis中时自动改用EVAL
+            self._consume_script = self.kvdb.register_script(CONSUME_SCRIPT)
+        return bool(self._consume_script(keys=[self.key_name(key)], args=[self.codec.encode(expected)]))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = {}
+        for start in range(0, len(keys), self.batch_size):
+            chunk = keys[start:start + self.batch_size]
+            for key, value in zip(chunk, self.kvdb.mget([self.key_name(key) for key in chunk])):
+                if value is not None:
+                    result[key] = self.codec.decode(value)
+        return result
+
+    def get_many_with_ttl(self, keys):
+        """
+        :return: {key: (值, 剩余秒数)}, 只包含存在的key, 剩余秒数与 get_with_ttl 相同
+        """
+        keys = list(keys)
+        result = {}
+        for start in range(0, len(keys), self.batch_size):
+            chunk = keys[start:start + self.batch_size]
+            pipe = self.kvdb.pipeline(transaction=False)
+            for key in chunk:
+                pipe.get(self.key_name(key))
+                pipe.pttl(self.key_name(key))
+            replies = pipe.execute()
+            for key, value, pttl in zip(chunk, replies[0::2], replies[1::2]):
+                if value is not None:
+                    result[key] = (self.codec.decode(value), pttl / 1000.0 if pttl >= 0 else -1)
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        items = [(key, value) for key, value in mapping.items() if value is not None]
+        for start in range(0, len(items), self.batch_size):
+            pipe = self.kvdb.pipeline(transaction=False)
+            for key, value in items[start:start + self.batch_size]:
+                pipe.set(self.key_name(key), self.codec.encode(value), ttl)
+            pipe.execute()
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), self.batch_size):
+            chunk = keys[start:start + self.batch_size]
+            if chunk:
+                self.kvdb.delete(*[self.key_name(key) for key in chunk])
 
     def set(self, key, value, ttl=None):
         if value is None:
             return
         key = self.key_name(key)
-        value = json.dumps(value)
+        value = self.codec.encode(value)
         self.kvdb.set(key, value, ttl)
 
     def delete(self, key):
         key = self.key_name(key)
         self.kvdb.delete(key)
+
+    def add(self, key, value, ttl=None):
+        key = self.key_name(key)
+        value = self.codec.encode(value)
+        return bool(self.kvdb.set(key, value, ex=ttl, nx=True))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+延迟创建的存储, 以及后台健康检查
+
+    storage = LazyStorage(build, probe=lambda: redis_conn.ping(), interval=10)
+    storage.get('key')      # 第一次使用时才调用 build() 创建真正的存储(KvStorage等)
+    storage.ready()         # 最近一次健康检查是否通过
+    storage.health()        # {'ready', 'checked_at', 'latency_ms', 'error'}
+
+    * worker启动时不连接Redis, Redis暂时不可用时worker也能正常启动, 请求中的读写按原来的方式抛出异常
+    * build() 失败时不保存结果, 下一次使用时重试
+    * 每个worker进程有一个后台线程每 interval 秒调用一次 probe(), fork之后在子进程中重新启动
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+from utils.storage import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+class LazyStorage(BaseStorage):
+
+    def __init__(self, build, probe, interval=10):
+        """
+        :param build: 无参函数, 返回真正的存储
+        :param probe: 无参函数, 检查后端是否可用, 不可用时抛出异常
+        :param interval: 健康检查间隔(秒)
+        """
+        self.build = build
+        self.probe = probe
+        self.interval = interval
+        self._storage = None
+        self._lock = threading.Lock()
+        self._health = {'ready': None, 'checked_at': None, 'latency_ms': None, 'error': None}
+        self._prober_pid = None
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    self._storage = self.build()
+        self._ensure_prober()
+        return self._storage
+
+    def get(self, key, default=None):
+        return self.storage.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        return self.storage.set(key, value, ttl)
+
+    def delete(self, key):
+        return self.storage.delete(key)
+
+    def add(self, key, value, ttl=None):
+        return self.storage.add(key, value, ttl)
+
+    def consume(self, key, expected):
+        return self.storage.consume(key, expected)
+
+    def get_many(self, keys):
+        return self.storage.get_many(keys)
+
+    def set_many(self, mapping, ttl=None):
+        return self.storage.set_many(mapping, ttl)
+
+    def delete_many(self, keys):
+        return self.storage.delete_many(keys)
+
+    def __getattr__(self, name):
+        # 其它方法(get_with_ttl、stats等)交给真正的存储
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def ready(self):
+        """
+        :return: 最近一次健康检查是否通过, 还没有检查过时立即检查一次
+        """
+        self._ensure_prober()
+        if self._health['ready'] is None:
+            self.check()
+        return bool(self._health['ready'])
+
+    def health(self):
+        self.ready()
+        return dict(self._health)
+
+    def check(self):
+        started = time.perf_counter()
+        try:
+            self.probe()
+        except Exception as e:
+            if self._health['ready'] is not False:
+                logger.error("存储不可用: {}".format(e))
+            self._health = {'ready': False, 'checked_at': time.time(), 'latency_ms': None, 'error': str(e)}
+            return False
+        if self._health['ready'] is False:
+            logger.info("存储己恢复")
+        self._health = {'ready': True, 'checked_at': time.time(),
+                        'latency_ms': (time.perf_counter() - started) * 1000, 'error': None}
+        return True
+
+    def _ensure_prober(self):
+        if self._prober_pid == os.getpid():
+            return
+        with self._lock:
+            if self._prober_pid == os.getpid():
+                return
+            self._prober_pid = os.getpid()
+            # fork之前的检查结果不代表子进程的连接
+            self._health = {'ready': None, 'checked_at': None, 'latency_ms': None, 'error': None}
+            threading.Thread(target=self._run_prober, name='storage-health', daemon=True).start()
+
+    def _run_prober(self):
+        pid = os.getpid()
+        while self._prober_pid == pid:
+            self.check()
+            time.sleep(self.interval)
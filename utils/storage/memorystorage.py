@@ -1,32 +1,183 @@
 # -*- coding: utf-8 -*-
+"""
+进程内的缓存, 不需要Redis, 也用作 TieredStorage 的L1
+
+    storage = MemoryStorage(max_entries=10000, max_bytes=64 * 1024 * 1024)
+
+    * ttl为None时不过期; 超过 max_entries 条或 max_bytes 字节(按JSON序列化后的长度估算)时淘汰最久未使用的
+    * 过期时间放在小顶堆中, 每次写入时清理己过期的记录, 开销只与过期的记录数有关; 读取时过期的记录直接丢弃
+    * 多个线程共用一个实例; 多个worker进程之间不共享, add 实现的锁只在进程内有效
+"""
 from __future__ import absolute_import, unicode_literals
 
+import heapq
+import json
+import threading
 import time
+from collections import OrderedDict
 
 from utils.storage import BaseStorage
 
 
+class _Entry(object):
+    __slots__ = ('value', 'expires_at', 'size')
+
+    def __init__(self, value, expires_at, size):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+
 class MemoryStorage(BaseStorage):
 
-    def __init__(self):
-        self._data = {}
+    def __init__(self, max_entries=None, max_bytes=None):
+        """
+        :param max_entries: 最大记录数, None为不限制
+        :param max_bytes: 最大字节数(估算), None为不限制
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        # (过期时间, key), 记录被覆盖或删除后堆中的旧项在弹出时跳过
+        self._expiry = []
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def get(self, key, default=None):
-        ret = self._data.get(key, None)
-        if ret is None or len(ret) != 2:
-            return default
-        else:
-            value = ret[0]
-            expires_at = ret[1]
-            if expires_at is None or expires_at > time.time():
-                return value
-            else:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
                 return default
+            if entry.expires_at is not None and entry.expires_at <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.value
 
-    def set(self, key, value, ttl=3600):
+    def set(self, key, value, ttl=None):
         if value is None:
             return
-        self._data[key] = (value, int(time.time()) + ttl)
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            self._put(key, value, ttl, now)
 
     def delete(self, key):
-        self._data.pop(key, None)
+        with self._lock:
+            self._remove(key)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            entry = self._data.get(key)
+            if entry is not None and (entry.expires_at is None or entry.expires_at > now):
+                return False
+            self._put(key, value, ttl, now)
+            return True
+
+    def consume(self, key, expected):
+        with self._lock:
+            if expected is None or self.get(key) != expected:
+                return False
+            self._remove(key)
+            return True
+
+    def get_many(self, keys):
+        result = {}
+        with self._lock:
+            for key in keys:
+                value = self.get(key)
+                if value is not None:
+                    result[key] = value
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            for key, value in mapping.items():
+                if value is not None:
+                    self._put(key, value, ttl, now)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expiry = []
+            self._bytes = 0
+
+    def sweep(self):
+        """
+        清理己过期的记录
+        :return: 清理的记录数
+        """
+        with self._lock:
+            return self._sweep(time.time())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+    def _put(self, key, value, ttl, now):
+        self._remove(key)
+        expires_at = now + ttl if ttl is not None else None
+        size = self._sizeof(key, value) if self.max_bytes is not None else 0
+        self._data[key] = _Entry(value, expires_at, size)
+        self._bytes += size
+        if expires_at is not None:
+            heapq.heappush(self._expiry, (expires_at, key))
+            # 同一个key反复写入时堆中积累旧项, 超过记录数的两倍时重建
+            if len(self._expiry) > 2 * len(self._data) + 64:
+                self._expiry = [(e.expires_at, k) for k, e in self._data.items() if e.expires_at is not None]
+                heapq.heapify(self._expiry)
+        while self._data and ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                              (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _sweep(self, now):
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._data.get(key)
+            if entry is not None and entry.expires_at == expires_at:
+                self._remove(key)
+                self.expirations += 1
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _sizeof(key, value):
+        try:
+            return len(key) + len(json.dumps(value, ensure_ascii=False))
+        except (TypeError, ValueError):
+            return len(key) + len(repr(value))
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+存储层的一次性凭证(consume)、过期、淘汰和L1失效通知
+
+    python -m unittest utils.storage.tests
+
+需要 fakeredis (consume 的Lua脚本还需要 lupa), 没有安装时跳过Redis相关的用例
+"""
+from __future__ import absolute_import, unicode_literals
+
+import time
+import unittest
+from unittest import mock
+
+from utils.storage.kvstorage import KvStorage
+from utils.storage.memorystorage import MemoryStorage
+from utils.storage.tieredstorage import TieredStorage
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis 执行Lua脚本需要
+except ImportError:
+    fakeredis = None
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+class ConsumeMixin(object):
+    """
+    同样的用例在各个存储上运行, 子类实现 make_storage
+    """
+
+    def make_storage(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.storage = self.make_storage()
+
+    def test_consume_match(self):
+        self.storage.set('session:otp:n1', 'zhangsan', ttl=60)
+        self.assertTrue(self.storage.consume('session:otp:n1', 'zhangsan'))
+        self.assertIsNone(self.storage.get('session:otp:n1'))
+
+    def test_consume_mismatch(self):
+        self.storage.set('session:otp:n2', 'zhangsan', ttl=60)
+        self.assertFalse(self.storage.consume('session:otp:n2', 'lisi'))
+        self.assertFalse(self.storage.consume('session:otp:n2', None))
+        # 不匹配时不删除
+        self.assertEqual(self.storage.get('session:otp:n2'), 'zhangsan')
+
+    def test_consume_twice(self):
+        self.storage.set('session:otp:n3', 'zhangsan', ttl=60)
+        self.assertTrue(self.storage.consume('session:otp:n3', 'zhangsan'))
+        self.assertFalse(self.storage.consume('session:otp:n3', 'zhangsan'))
+
+    def test_consume_missing(self):
+        self.assertFalse(self.storage.consume('session:otp:missing', 'zhangsan'))
+
+    def test_add_lock(self):
+        self.assertTrue(self.storage.add('oauth:user_by_code:c1:lock', 'a', ttl=60))
+        self.assertFalse(self.storage.add('oauth:user_by_code:c1:lock', 'b', ttl=60))
+        self.assertFalse(self.storage.consume('oauth:user_by_code:c1:lock', 'b'))
+        self.assertTrue(self.storage.consume('oauth:user_by_code:c1:lock', 'a'))
+        self.assertTrue(self.storage.add('oauth:user_by_code:c1:lock', 'b', ttl=60))
+
+
+class MemoryStorageTest(ConsumeMixin, unittest.TestCase):
+
+    def make_storage(self):
+        return MemoryStorage()
+
+    def test_expiry(self):
+        now = time.time()
+        with mock.patch('utils.storage.memorystorage.time.time', return_value=now):
+            self.storage.set('k', 'v', ttl=10)
+            self.storage.set('forever', 'v')
+        with mock.patch('utils.storage.memorystorage.time.time', return_value=now + 11):
+            self.assertIsNone(self.storage.get('k'))
+            self.assertFalse(self.storage.consume('k', 'v'))
+            self.assertEqual(self.storage.get('forever'), 'v')
+            # 过期的锁可以重新获得
+            self.storage.set('lock', 'a', ttl=10)
+        with mock.patch('utils.storage.memorystorage.time.time', return_value=now + 22):
+            self.assertTrue(self.storage.add('lock', 'b', ttl=10))
+
+    def test_eviction_order(self):
+        storage = MemoryStorage(max_entries=3)
+        for key in ('a', 'b', 'c'):
+            storage.set(key, key)
+        # 读取过的记录不会被先淘汰
+        storage.get('a')
+        storage.set('d', 'd')
+        self.assertIsNone(storage.get('b'))
+        storage.set('e', 'e')
+        self.assertIsNone(storage.get('c'))
+        self.assertEqual(sorted(storage.get_many(['a', 'b', 'c', 'd', 'e'])), ['a', 'd', 'e'])
+        self.assertEqual(storage.stats()['evictions'], 2)
+
+    def test_max_bytes(self):
+        storage = MemoryStorage(max_bytes=100)
+        storage.set('a', 'x' * 40)
+        storage.set('b', 'x' * 40)
+        storage.set('c', 'x' * 40)
+        self.assertIsNone(storage.get('a'))
+        self.assertLessEqual(storage.stats()['bytes'], 100)
+
+
+@unittest.skipIf(fakeredis is None, '需要安装 fakeredis 和 lupa')
+class KvStorageTest(ConsumeMixin, unittest.TestCase):
+
+    def make_storage(self):
+        self.redis_conn = fakeredis.FakeRedis()
+        return KvStorage(self.redis_conn)
+
+    def test_expiry(self):
+        self.storage.set('session:otp:n4', 'zhangsan', ttl=1)
+        value, ttl = self.storage.get_with_ttl('session:otp:n4')
+        self.assertEqual(value, 'zhangsan')
+        self.assertTrue(0 < ttl <= 1)
+        time.sleep(1.1)
+        self.assertIsNone(self.storage.get('session:otp:n4'))
+        self.assertFalse(self.storage.consume('session:otp:n4', 'zhangsan'))
+
+
+@unittest.skipIf(fakeredis is None, '需要安装 fakeredis 和 lupa')
+class TieredStorageTest(ConsumeMixin, unittest.TestCase):
+
+    def make_storage(self, server=None):
+        self.server = server or fakeredis.FakeServer()
+        redis_conn = fakeredis.FakeRedis(server=self.server)
+        return TieredStorage(KvStorage(redis_conn), redis_conn, max_entries=3, max_ttl=30,
+                             channel='test:l1:invalidate')
+
+    def test_cross_instance_invalidation(self):
+        other = self.make_storage(self.server)
+        self.storage.set('org:user:u1', {'name': 'a'})
+        self.assertEqual(other.get('org:user:u1'), {'name': 'a'})
+        self.assertEqual(other.stats()['entries'], 1)
+
+        self.storage.set('org:user:u1', {'name': 'b'})
+        self.assertTrue(wait_until(lambda: other.stats()['entries'] == 0))
+        self.assertEqual(other.get('org:user:u1'), {'name': 'b'})
+
+        self.storage.delete('org:user:u1')
+        self.assertTrue(wait_until(lambda: other.get('org:user:u1') is None))
+
+    def test_consumed_in_other_instance(self):
+        other = self.make_storage(self.server)
+        self.storage.set('session:otp:n5', 'zhangsan', ttl=60)
+        self.assertEqual(other.get('session:otp:n5'), 'zhangsan')
+        self.assertTrue(self.storage.consume('session:otp:n5', 'zhangsan'))
+        # 一次性凭证不进入L1, 另一个worker立即看到己被使用
+        self.assertIsNone(other.get('session:otp:n5'))
+        self.assertFalse(other.consume('session:otp:n5', 'zhangsan'))
+
+    def test_invalidated_while_loading(self):
+        self.storage.set('org:user:u2', 'old')
+        message = {'type': 'message', 'data': '{"origin": "other", "keys": ["org:user:u2"]}'}
+
+        def invalidated_after(method):
+            def wrapper(*args):
+                result = method(*args)
+                # 读到旧值之后、写入L1之前, 另一个worker修改了这个key
+                self.storage._on_message(message)
+                return result
+            return wrapper
+
+        backend = self.storage.backend
+        with mock.patch.object(backend, 'get_with_ttl', invalidated_after(backend.get_with_ttl)), \
+                mock.patch.object(backend, 'get_many_with_ttl', invalidated_after(backend.get_many_with_ttl)):
+            self.assertEqual(self.storage.get('org:user:u2'), 'old')
+            self.assertEqual(self.storage.get_many(['org:user:u2']), {'org:user:u2': 'old'})
+        self.assertEqual(self.storage.stats()['entries'], 0)
+
+    def test_lock_keys_bypass_local(self):
+        self.assertTrue(self.storage.add('wework:corp_id:c:access_token:refresh_lock', 'a', ttl=60))
+        self.assertEqual(self.storage.get('wework:corp_id:c:access_token:refresh_lock'), 'a')
+        self.assertEqual(self.storage.stats()['entries'], 0)
+
+    def test_eviction_order(self):
+        for key in ('a', 'b', 'c'):
+            self.storage.set(key, key)
+            self.storage.get(key)
+        self.storage.get('a')
+        self.storage.set('d', 'd')
+        self.storage.get('d')
+        # L1只淘汰最久未使用的b, Redis中的值仍然可以读取
+        self.assertEqual(self.storage.stats()['evictions'], 1)
+        self.assertEqual(self.storage.stats()['entries'], 3)
+        self.assertEqual(self.storage.get('b'), 'b')
+        self.assertEqual(self.storage.stats()['evictions'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
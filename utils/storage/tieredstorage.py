@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+两级缓存: 每个worker进程内的LRU(L1) + Redis(KvStorage)
+
+    storage = TieredStorage(KvStorage(redis_conn), redis_conn)
+
+    * get 先查L1, 未命中时一次往返从Redis取得值和剩余有效期, L1中的记录不会晚于Redis中的过期,
+      最长保留 max_ttl 秒, 最多保留 max_entries 条, 超出时淘汰最久未使用的
+    * set/delete/add 直接写Redis, 再通过Redis的pub/sub通知所有worker删除L1中的这个key;
+      订阅断开期间可能漏掉通知, 重新订阅时清空L1
+    * 跨进程的锁(以 :lock / :refresh_lock 结尾)和一次性凭证(session:otp:)按key的命名不进入L1,
+      状态必须每次从Redis读取; 其它用 add/consume 的key需要加入 bypass_prefixes/bypass_suffixes
+    * 返回的值在L1中共用, 调用方不能修改
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+from utils.storage import BaseStorage
+from utils.storage.kvstorage import random_string, to_text
+from utils.storage.memorystorage import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+class TieredStorage(BaseStorage):
+
+    def __init__(self, backend, redis_conn, max_entries=1024, max_ttl=30, channel='pwdselfservice:l1:invalidate',
+                 bypass_prefixes=('session:otp:',), bypass_suffixes=(':lock', ':refresh_lock')):
+        """
+        :param backend: KvStorage
+        :param redis_conn: 用于订阅失效通知的Redis连接
+        :param max_entries: L1的最大记录数
+        :param max_ttl: L1中的记录最长保留多少秒, 收不到失效通知时最多读到这么久以前的值
+        :param channel: 失效通知的频道
+        :param bypass_prefixes: 以这些前缀开头的key不进入L1
+        :param bypass_suffixes: 以这些后缀结尾的key不进入L1
+        """
+        self.backend = backend
+        self.redis_conn = redis_conn
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.channel = channel
+        self.bypass_prefixes = tuple(bypass_prefixes)
+        self.bypass_suffixes = tuple(bypass_suffixes)
+        self._local = MemoryStorage(max_entries=max_entries)
+        self._lock = threading.RLock()
+        self._origin = None
+        # 正在从Redis读取的key -> [读取中的线程数, 读取期间是否失效过], 失效过时不写入L1, 避免写入旧值
+        self._loading = {}
+        self._subscriber_pid = None
+
+    def get(self, key, default=None):
+        if self.bypass_local(key):
+            return self.backend.get(key, default)
+        self._ensure_subscriber()
+        with self._lock:
+            value = self._local.get(key)
+            if value is not None:
+                return value
+            loading = self._loading.setdefault(key, [0, False])
+            loading[0] += 1
+        value = ttl = None
+        try:
+            value, ttl = self.backend.get_with_ttl(key)
+        finally:
+            # 结束读取和写入L1在同一次加锁中完成, 中间到达的失效通知不会漏掉
+            with self._lock:
+                if not self._finish_loading(key, loading) and value is not None:
+                    self._store_local(key, value, ttl)
+        return default if value is None else value
+
+    def get_many(self, keys):
+        self._ensure_subscriber()
+        result = {}
+        missing = []
+        bypassed = []
+        with self._lock:
+            for key in keys:
+                if self.bypass_local(key):
+                    bypassed.append(key)
+                    continue
+                value = self._local.get(key)
+                if value is not None:
+                    result[key] = value
+                else:
+                    missing.append(key)
+            loadings = []
+            for key in missing:
+                loading = self._loading.setdefault(key, [0, False])
+                loading[0] += 1
+                loadings.append(loading)
+        fetched = {}
+        try:
+            if missing:
+                fetched = self.backend.get_many_with_ttl(missing)
+        finally:
+            with self._lock:
+                for key, loading in zip(missing, loadings):
+                    if not self._finish_loading(key, loading) and key in fetched:
+                        self._store_local(key, *fetched[key])
+        for key, (value, _ttl) in fetched.items():
+            result[key] = value
+        if bypassed:
+            result.update(self.backend.get_many(bypassed))
+        return result
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl)
+        self._invalidate([key])
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self._invalidate([key])
+
+    def set_many(self, mapping, ttl=None):
+        self.backend.set_many(mapping, ttl)
+        self._invalidate(list(mapping))
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self.backend.delete_many(keys)
+        self._invalidate(keys)
+
+    def add(self, key, value, ttl=None):
+        added = self.backend.add(key, value, ttl)
+        if added:
+            self._invalidate([key])
+        return added
+
+    def consume(self, key, expected):
+        consumed = self.backend.consume(key, expected)
+        if consumed:
+            self._invalidate([key])
+        return consumed
+
+    def bypass_local(self, key):
+        """
+        :return: 这个key是否不进入L1, 每次都从Redis读取
+        """
+        return key.startswith(self.bypass_prefixes) or key.endswith(self.bypass_suffixes)
+
+    def clear_local(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[1] = True
+            self._local.clear()
+
+    def stats(self):
+        return self._local.stats()
+
+    def _invalidate(self, keys):
+        self._ensure_subscriber()
+        for key in keys:
+            self._evict(key)
+        try:
+            # 一次通知可以包含多个key
+            self.redis_conn.publish(self.channel, json.dumps({'origin': self._origin, 'keys': keys}))
+        except Exception as e:
+            # 其它worker的L1最多在 max_ttl 秒后过期
+            logger.error("L1缓存失效通知发送失败: {}".format(e))
+
+    def _ensure_subscriber(self):
+        """
+        每个worker进程一个订阅线程, fork之后在子进程中重新启动
+        """
+        if self._subscriber_pid == os.getpid():
+            return
+        with self._lock:
+            if self._subscriber_pid == os.getpid():
+                return
+            self._local.clear()
+            self._origin = '{}:{}'.format(os.getpid(), random_string())
+            self._subscriber_pid = os.getpid()
+            ready = threading.Event()
+            threading.Thread(target=self._subscribe, args=(ready,), name='l1-invalidation', daemon=True).start()
+        # 订阅成功之前的写入通知会丢失, 稍等订阅建立
+        ready.wait(1)
+
+    def _subscribe(self, ready):
+        while True:
+            pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # 断开期间可能漏掉通知
+                self.clear_local()
+                ready.set()
+                for message in pubsub.listen():
+                    self._on_message(message)
+            except Exception as e:
+                logger.error("L1缓存失效通知订阅断开, 稍后重试: {}".format(e))
+                self.clear_local()
+                time.sleep(1)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+    def _on_message(self, message):
+        if message.get('type') != 'message':
+            return
+        try:
+            data = json.loads(to_text(message['data']))
+        except ValueError:
+            return
+        if data.get('origin') == self._origin:
+            return
+        for key in data.get('keys') or []:
+            self._evict(key)
+
+    def _finish_loading(self, key, loading):
+        """
+        结束一次读取, 调用方持有 self._lock
+        :return: 读取期间这个key是否失效过
+        """
+        invalidated = loading[1]
+        loading[0] -= 1
+        if loading[0] == 0:
+            self._loading.pop(key, None)
+        return invalidated
+
+    def _store_local(self, key, value, ttl):
+        """
+        写入L1, 不晚于Redis中的过期时间, 调用方持有 self._lock
+        """
+        self._local.set(key, value, ttl=self.max_ttl if ttl < 0 else min(ttl, self.max_ttl))
+
+    def _evict(self, key):
+        with self._lock:
+            if key in self._loading:
+                self._loading[key][1] = True
+            self._local.delete(key)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+access_token 等有过期时间的凭证的刷新协调
+
+多个线程、多个worker进程共用缓存中的同一个凭证:
+    * 缓存中保存 {'value': 凭证, 'expires_at': 过期时间戳}, 兼容旧版本直接保存的凭证字符串
+    * 同一进程内只有一个线程去刷新, 多个进程之间用 storage.add 实现的锁保证只有一个worker去刷新,
+      其它worker在凭证未过期时继续使用旧凭证, 过期时最多等待 TOKEN_REFRESH_WAIT 秒拿到新凭证
+    * 每个worker有一个后台线程, 在过期前 TOKEN_REFRESH_AHEAD 秒提前续期, 用户请求不需要等待获取凭证
+      (只有第一次获取或者凭证被上游判定失效时需要等待)
+
+    token = TokenCoordinator(cache.access_token, fetch)  # fetch() 返回 (凭证, 有效期秒数)
+    token.get()
+    token.invalidate()  # 上游返回凭证失效的错误码时调用
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from utils.storage.kvstorage import random_string
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCoordinator(object):
+
+    def __init__(self, item, fetch, refresh_ahead=None, lock_ttl=None, wait_timeout=None):
+        """
+        :param item: 保存凭证的 CacheItem
+        :param fetch: 无参函数, 向上游获取新凭证, 返回 (凭证, 有效期秒数)
+        :param refresh_ahead: 过期前多少秒开始续期, 默认 TOKEN_REFRESH_AHEAD
+        :param lock_ttl: 跨进程刷新锁的过期时间(秒), 持有锁的worker异常退出时锁会自动释放, 默认 TOKEN_REFRESH_LOCK_TTL
+        :param wait_timeout: 没有可用凭证且其它worker正在刷新时的最长等待时间(秒), 默认 TOKEN_REFRESH_WAIT
+        """
+        self.item = item
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead if refresh_ahead is not None else settings.TOKEN_REFRESH_AHEAD
+        self.lock_ttl = lock_ttl or settings.TOKEN_REFRESH_LOCK_TTL
+        self.wait_timeout = wait_timeout if wait_timeout is not None else settings.TOKEN_REFRESH_WAIT
+        self.name = item.key_name(None)
+        self._lock = threading.Lock()
+        self._renewer_lock = threading.Lock()
+        self._renewer = None
+        self._renewer_pid = None
+        # 是否己有后台线程在提前续期, 每个worker同时最多一个
+        self._refreshing = False
+        self._refreshing_lock = threading.Lock()
+
+    def get(self):
+        self._ensure_renewer()
+        entry = self._load()
+        if self._valid(entry):
+            if not self._valid(entry, self.refresh_ahead):
+                self._refresh_async()
+            return entry['value']
+        return self._refresh(stale_ok=False)
+
+    def invalidate(self):
+        self.item.delete()
+
+    def _load(self):
+        entry = self.item.get()
+        if entry is None:
+            return None
+        if not isinstance(entry, dict):
+            # 旧版本直接保存的凭证字符串, 不知道过期时间, 继续使用并尽快续期
+            return {'value': entry, 'expires_at': time.time() + self.refresh_ahead / 2}
+        return entry
+
+    @staticmethod
+    def _valid(entry, margin=0):
+        """
+        凭证在margin秒之后是否仍然有效
+        """
+        return entry is not None and time.time() < entry['expires_at'] - margin
+
+    def _refresh(self, stale_ok):
+        """
+        :param stale_ok: 为True时是提前续期, 有未过期的旧凭证就可以返回; 为False时必须拿到未过期的凭证
+        """
+        # 同一进程内的线程在这里排队, 拿到锁时可能别的线程己经刷新过了
+        with self._lock:
+            entry = self._load()
+            if self._valid(entry, self.refresh_ahead if stale_ok else 0):
+                return entry['value']
+            lock_value = self._acquire()
+            if lock_value is not None:
+                try:
+                    return self._fetch_and_store()
+                finally:
+                    self._release(lock_value)
+            # 其它worker正在刷新, 有未过期的旧凭证就先用旧的
+            if self._valid(entry):
+                return entry['value']
+            started = time.monotonic()
+            while time.monotonic() - started < self.wait_timeout:
+                time.sleep(0.05)
+                entry = self._load()
+                if self._valid(entry):
+                    return entry['value']
+            # 持有锁的worker可能己经异常退出, 不再等待
+            logger.warning("[{}]等待其它worker刷新超时, 直接获取".format(self.name))
+            return self._fetch_and_store()
+
+    def _acquire(self):
+        """
+        获取跨worker的刷新锁, 成功时返回锁的值, 其它worker正在刷新时返回None
+        """
+        lock_value = random_string()
+        if self.item.cache.storage.add(self.item.key_name('refresh_lock'), lock_value, ttl=self.lock_ttl):
+            return lock_value
+        return None
+
+    def _release(self, lock_value):
+        self.item.cache.storage.consume(self.item.key_name('refresh_lock'), lock_value)
+
+    def _fetch_and_store(self):
+        return self._store(*self.fetch())
+
+    def _store(self, value, expires_in):
+        self.item.set(value={'value': value, 'expires_at': time.time() + expires_in}, ttl=expires_in)
+        logger.info("[{}]己刷新, 有效期{}秒".format(self.name, expires_in))
+        return value
+
+    def _refresh_quietly(self):
+        try:
+            self._refresh(stale_ok=True)
+        except Exception as e:
+            logger.error("[{}]续期失败: {}".format(self.name, e))
+
+    def _refresh_async(self):
+        with self._refreshing_lock:
+            if self._refreshing or self._lock.locked():
+                return
+            self._refreshing = True
+        try:
+            threading.Thread(target=self._refresh_in_background, name='token-refresh', daemon=True).start()
+        except Exception:
+            self._refreshing = False
+            raise
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh_quietly()
+        finally:
+            self._refreshing = False
+
+    def _ensure_renewer(self):
+        if self._renewer is not None and self._renewer_pid == os.getpid() and self._renewer.is_alive():
+            return
+        with self._renewer_lock:
+            if self._renewer is None or self._renewer_pid != os.getpid() or not self._renewer.is_alive():
+                self._renewer = threading.Thread(target=self._renew_loop, name='token-renewer', daemon=True)
+                self._renewer_pid = os.getpid()
+                self._renewer.start()
+
+    def _renew_loop(self):
+        while True:
+            entry = self._load()
+            if not self._valid(entry, self.refresh_ahead):
+                self._refresh_quietly()
+                entry = self._load()
+            wake = entry['expires_at'] - self.refresh_ahead if entry is not None else time.time() + 5
+            # 各worker错开几秒再去抢锁; 最多睡60秒, 凭证被其它worker刷新或删除后能及时跟上
+            time.sleep(min(max(wake - time.time() + random.uniform(0, 3), 1), 60))
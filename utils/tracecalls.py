@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os.path
 import re
 import sys
@@ -119,6 +120,27 @@ class TraceFuncContext:
 def decorator_logger(logger, log_head='Run function', debug_flag_name=None, verbose=1, check_calls=None,
                      pretty=False, indent=0):
     def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            # 协程在await时会让出线程, sys.settrace 会跟踪到同一线程中的其它协程, 只记录进入、退出和异常
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                func_consts = func.__code__.co_consts
+                logger.debug("{4} [{0}] entering trace with --- consts-{3}, args-{1}, kwargs-{2}...".format(
+                    func.__name__, args, kwargs, func_consts, log_head))
+                try:
+                    func_res = await func(*args, **kwargs)
+                    logger.debug("{4} [{0}] exiting trace with --- consts-{3}, args-{1}, kwargs-{2}...".format(
+                        func.__name__, args, kwargs, func_consts, log_head))
+                    return func_res
+                except Exception as e:
+                    logger.error(
+                        "{4} [{0}] has exception, trace with --- consts-{3}, args-{1}, kwargs-{2}. Trackback as "
+                        "following: ".format(
+                            func.__name__, args, kwargs, func_consts, log_head))
+                    logger.error(format_exc())
+                    raise e
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             func_consts = func.__code__.co_consts
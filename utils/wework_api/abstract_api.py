@@ -4,6 +4,10 @@
 import json
 
 import requests
+from django.conf import settings
+
+from utils.http_policy import get_policy
+from utils.http_session import get_session
 
 DEBUG = False
 
@@ -15,24 +19,40 @@ class ApiException(Exception):
 
 
 class AbstractApi(object):
+    # 同名的API共用当前worker进程内的同一个长连接池
+    session_name = 'wework'
+    # short_url -> 接口名, 用于按接口名查找超时与重试策略(HTTP_POLICY_OVERRIDES)
+    api_names = {}
+
     def __init__(self):
         return
 
+    @property
+    def session(self):
+        return get_session(self.session_name)
+
     def access_token(self):
         raise NotImplementedError
 
+    def refresh_access_token(self):
+        """
+        上游返回access_token失效时调用, 子类应丢弃缓存的access_token
+        """
+        self.access_token()
+
     def http_call(self, url_type, args=None):
         short_url = url_type[0]
         method = url_type[1]
+        policy = get_policy(self.api_names.get(short_url, short_url), method)
         response = {}
         for retryCnt in range(0, 3):
             if 'POST' == method:
                 url = self.__make_url(short_url)
-                response = self.__http_post(url, args)
+                response = self.__http_post(url, args, policy)
             elif 'GET' == method:
                 url = self.__make_url(short_url)
                 url = self.__append_args(url, args)
-                response = self.__http_get(url)
+                response = self.__http_get(url, policy)
             else:
                 raise ApiException(-1, "unknown method type")
 
@@ -60,7 +80,7 @@ class AbstractApi(object):
 
     @staticmethod
     def __make_url(short_url):
-        base = "https://qyapi.weixin.qq.com"
+        base = settings.WEWORK_API_BASE_URL.rstrip('/')
         if short_url[0] == '/':
             return base + short_url
         else:
@@ -72,21 +92,27 @@ class AbstractApi(object):
         else:
             return url
 
-    def __http_post(self, url, args):
+    def __http_post(self, url, args, policy):
         real_url = self.__append_token(url)
 
         if DEBUG is True:
             print(real_url, args)
 
-        return requests.post(real_url, data=json.dumps(args, ensure_ascii=False).encode('utf-8')).json()
+        data = json.dumps(args, ensure_ascii=False).encode('utf-8')
+        return self.__decode(policy.execute(lambda timeout: self.session.post(real_url, data=data, timeout=timeout)))
 
-    def __http_get(self, url):
+    def __http_get(self, url, policy):
         real_url = self.__append_token(url)
 
         if DEBUG is True:
             print(real_url)
 
-        return requests.get(real_url).json()
+        return self.__decode(policy.execute(lambda timeout: self.session.get(real_url, timeout=timeout)))
+
+    @staticmethod
+    def __decode(response):
+        response.raise_for_status()
+        return response.json()
 
     def __post_file(self, url, media_file):
         return requests.post(url, file=media_file).json()
@@ -110,4 +136,4 @@ class AbstractApi(object):
 
     def __refresh_token(self, url):
         if 'ACCESS_TOKEN' in url:
-            self.access_token()
+            self.refresh_access_token()
@@ -7,10 +7,19 @@
 # @Date:           2021/5/18 16:55
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
 import os
+import time
+from urllib.parse import urldefrag
+
+from django.conf import settings
 
 from pwdselfservice import cache_storage
+from utils.storage.kvstorage import random_string
 from utils.storage.cache import WeWorkCache
+from utils.storage.memorystorage import MemoryStorage
+from utils.org_directory import indexed_user_usable
+from utils.storage.token import TokenCoordinator
 from utils.wework_api.abstract_api import *
 
 APP_ENV = os.getenv('APP_ENV')
@@ -78,8 +87,12 @@ CORP_API_TYPE = {
     'MINIPROGRAM_CODE_TO_SESSION_KEY': ['/cgi-bin/miniprogram/jscode2session?access_token=ACCESS_TOKEN', 'GET'],
 }
 
+CORP_API_NAMES = {value[0]: name for name, value in CORP_API_TYPE.items()}
+
 
 class WeWorkOps(AbstractApi):
+    api_names = CORP_API_NAMES
+
     def __init__(self, corp_id=WEWORK_CORP_ID, agent_id=WEWORK_AGENT_ID, agent_secret=WEWORK_AGNET_SECRET,
                  storage=cache_storage, prefix='wework'):
         super().__init__()
@@ -88,15 +101,23 @@ class WeWorkOps(AbstractApi):
         self.agent_secret = agent_secret
         self.storage = storage
         self.cache = WeWorkCache(self.storage, "%s:%s" % (prefix, "corp_id:%s" % self.corp_id))
+        # 多个线程、worker共用一个access_token, 只有一个worker去刷新, 并在过期前提前续期
+        self.token = TokenCoordinator(self.cache.access_token, self.__fetch_access_token)
+        # JS-SDK 的企业jsapi_ticket(wx.config)和应用jsapi_ticket(wx.agentConfig), 与access_token一样统一刷新
+        self.jsapi_ticket = TokenCoordinator(self.cache.jsapi_ticket, self.__fetch_jsapi_ticket)
+        self.agent_jsapi_ticket = TokenCoordinator(self.cache.agent_jsapi_ticket, self.__fetch_agent_jsapi_ticket)
+        # 签名接口不需要登录, URL可以任意构造, 签名只缓存在进程内并限制条数, 不写入Redis
+        self.jsapi_signatures = MemoryStorage(max_entries=settings.JSAPI_SIGNATURE_MAX_ENTRIES)
 
     def access_token(self):
-        access_token = self.cache.access_token.get()
-        if access_token is None:
-            ret = self.get_access_token()
-            access_token = ret['access_token']
-            expires_in = ret.get('expires_in', 7200)
-            self.cache.access_token.set(value=access_token, ttl=expires_in)
-        return access_token
+        return self.token.get()
+
+    def refresh_access_token(self):
+        self.token.invalidate()
+
+    def __fetch_access_token(self):
+        ret = self.get_access_token()
+        return ret['access_token'], ret.get('expires_in', 7200)
 
     def get_access_token(self):
         return self.http_call(
@@ -106,6 +127,59 @@ class WeWorkOps(AbstractApi):
                 'corpsecret': self.agent_secret,
             })
 
+    def __fetch_jsapi_ticket(self):
+        ret = self.http_call(CORP_API_TYPE['GET_JSAPI_TICKET'])
+        return ret['ticket'], ret.get('expires_in', 7200)
+
+    def __fetch_agent_jsapi_ticket(self):
+        ret = self.http_call(
+            CORP_API_TYPE['GET_TICKET'],
+            {
+                'type': 'agent_config',
+            })
+        return ret['ticket'], ret.get('expires_in', 7200)
+
+    def jsapi_signature(self, url):
+        """
+        JS-SDK 的签名, 企业内打开页面时前端用它调用 wx.config / wx.agentConfig, 不需要再跳转一次OAuth2授权页
+        同一个页面URL的签名在进程内缓存 JSAPI_SIGNATURE_TTL 秒, 最多 JSAPI_SIGNATURE_MAX_ENTRIES 条, ticket刷新之后重新计算
+        :param url: 调用JS-SDK的页面的完整URL, #及其后面的部分不参与签名
+        :return: (True, {'corpid', 'agentid', 'config': {...}, 'agent_config': {...}}) 或 (False, 错误信息)
+        """
+        url = urldefrag(url)[0]
+        try:
+            tickets = self.jsapi_ticket.get(), self.agent_jsapi_ticket.get()
+        except ApiException as e:
+            return False, "jsapi_signature: {}-{}".format(e.errCode, e.errMsg)
+        except Exception as e:
+            return False, "jsapi_signature: {}".format(e)
+        url_key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        cached = self.jsapi_signatures.get(url_key)
+        if cached is None or cached.get('tickets') != list(tickets):
+            cached = {
+                'tickets': list(tickets),
+                'config': self.__sign(tickets[0], url),
+                'agent_config': self.__sign(tickets[1], url),
+            }
+            self.jsapi_signatures.set(url_key, cached, ttl=settings.JSAPI_SIGNATURE_TTL)
+        return True, {
+            'corpid': self.corp_id,
+            'agentid': self.agent_id,
+            'config': cached['config'],
+            'agent_config': cached['agent_config'],
+        }
+
+    @staticmethod
+    def __sign(ticket, url):
+        nonce_str = random_string()
+        timestamp = int(time.time())
+        plain = 'jsapi_ticket={}&noncestr={}&timestamp={}&url={}'.format(ticket, nonce_str, timestamp, url)
+        return {
+            'timestamp': timestamp,
+            'nonceStr': nonce_str,
+            'signature': hashlib.sha1(plain.encode('utf-8')).hexdigest(),
+        }
+
     def get_user_id_by_code(self, code):
         try:
             return True, self.http_call(
@@ -130,6 +204,27 @@ class WeWorkOps(AbstractApi):
         except Exception as e:
             return False, "get_user_detail_by_user_id: {}".format(e)
 
+    def iter_directory_users(self):
+        """
+        逐个部门读取通讯录成员(USER_LIST), 同一个成员在多个部门时只返回一次
+        需要应用有通讯录的读取权限
+        :return: 成员详情生成器
+        :raise ApiException: 上游返回错误
+        """
+        departments = self.http_call(CORP_API_TYPE['DEPARTMENT_LIST']).get('department', [])
+        seen = set()
+        for department in departments:
+            users = self.http_call(
+                CORP_API_TYPE['USER_LIST'],
+                {
+                    'department_id': str(department['id']),
+                    'fetch_child': '0',
+                }).get('userlist', [])
+            for user in users:
+                if user.get('userid') not in seen:
+                    seen.add(user.get('userid'))
+                    yield user
+
     def get_user_ticket_by_code_with_oauth2(self, code):
         try:
             return True, self.http_call(
@@ -154,9 +249,10 @@ class WeWorkOps(AbstractApi):
         except Exception as e:
             return False, "get_user_info_by_ticket_with_oauth2: {}".format(e)
 
-    def get_user_detail(self, code, home_url):
+    def get_user_detail(self, code, home_url, directory=None):
         """
         临时授权码换取userinfo
+        :param directory: func(user_id), 从本地通讯录索引(utils/org_directory.py)中查找成员, 找到时不再请求成员详情
         """
         _status, ticket_data = self.get_user_ticket_by_code_with_oauth2(code)
         # 判断 user_ticket 是否存在
@@ -174,6 +270,11 @@ class WeWorkOps(AbstractApi):
             return False, context, ticket_data
 
         user_id = ticket_data.get('userid')
+        # 本地通讯录索引中有这个成员且己关联到域账号时不需要user_ticket
+        user_info = directory(user_id) if directory and user_id else None
+        if indexed_user_usable(user_info):
+            return True, user_id, user_info
+
         if ticket_data.get('user_ticket') is None:
             context = {
                 'global_title': TITLE,
@@ -189,9 +290,9 @@ class WeWorkOps(AbstractApi):
         if not detail_status:
             context = {
                 'global_title': TITLE,
-                'msg': '获取用户信息失败, 错误信息: {}'.format(user_id),
+                'msg': '获取用户信息失败, 错误信息: {}'.format(user_info),
                 'button_click': "window.location.href='%s'" % '/auth',
                 'button_display': "重新认证授权"
             }
-            return False, context
+            return False, context, user_info
         return True, user_id, user_info